@@ -0,0 +1,25 @@
+"""Atomic replacement of json files, shared by the session backend and the user store.
+
+The content goes to a uniquely named temp file in the same directory which
+is then fsynced and renamed over the real file, so readers only ever see a
+complete file and concurrent writers never share a temp file.
+"""
+import json
+import os
+import tempfile
+
+
+def write_json_atomically(file_path: str, content, **dump_options):
+    """Replace file_path with content encoded by json.dump(content, fp, **dump_options). Blocking."""
+    directory = os.path.dirname(os.path.abspath(file_path))
+    fd, tmp_file_path = tempfile.mkstemp(dir=directory, prefix=f"{os.path.basename(file_path)}.", suffix='.tmp')
+    try:
+        with os.fdopen(fd, 'w') as fp:
+            json.dump(content, fp, **dump_options)
+            fp.flush()
+            os.fsync(fp.fileno())
+        os.replace(tmp_file_path, file_path)
+    except BaseException:
+        if os.path.exists(tmp_file_path):
+            os.remove(tmp_file_path)
+        raise
@@ -0,0 +1,305 @@
+"""Throughput and latency benchmark for the login, status, logout and protected resources endpoints.
+
+For every session population size the session store is seeded with that many
+existing sessions, then each endpoint is driven with a fixed number of
+requests at the given concurrency. The app is either driven in-process through
+httpx's ASGI transport, or over HTTP against a uvicorn server started on a
+local port (driven with aiohttp, since httpx's pool becomes the bottleneck at
+high concurrency). Results (p50/p90/p99 latency, mean, requests per second) are
+printed as a table and optionally written as json so runs can be diffed.
+
+Run from backend/python:
+
+    python benchmarks/endpoints_benchmark.py --populations 10,10000 --requests 2000 --concurrency 50
+    python benchmarks/endpoints_benchmark.py --mode uvicorn --output after.json --baseline before.json
+
+The session backend is selected with the usual SESSION_BACKEND settings. The
+'memory://' redis stand-in only works in-process.
+"""
+import argparse
+import asyncio
+import json
+import logging
+import os
+import platform
+import shutil
+import socket
+import subprocess
+import sys
+import tempfile
+import time
+from datetime import datetime, timezone
+from http.cookiejar import CookieJar, DefaultCookiePolicy
+
+APP_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, APP_DIR)
+
+import aiohttp
+import httpx
+
+# Every request comes from one client, keep the login rate limits out of the numbers
+os.environ.setdefault('RATE_LIMITS', '')
+# All sessions belong to the same user, keep the per-user session limit from evicting them
+os.environ.setdefault('MAX_SESSIONS_PER_USER', '0')
+
+import main
+
+ENDPOINTS = ('login', 'login_status', 'get_all_resources', 'logout')
+
+
+def no_cookies_jar() -> CookieJar:
+    """A cookie jar that keeps nothing, so concurrent requests stay independent."""
+    return CookieJar(policy=DefaultCookiePolicy(allowed_domains=[]))
+
+
+def percentile(sorted_values, fraction: float) -> float:
+    if not sorted_values:
+        return 0.0
+    index = min(len(sorted_values) - 1, max(0, int(round(fraction * len(sorted_values) + 0.5)) - 1))
+    return sorted_values[index]
+
+
+def summarize(latencies, elapsed: float, errors: int) -> dict:
+    latencies = sorted(latencies)
+    return {
+        'requests': len(latencies),
+        'errors': errors,
+        'rps': len(latencies) / elapsed if elapsed else 0.0,
+        'mean_ms': 1000 * sum(latencies) / len(latencies) if latencies else 0.0,
+        'p50_ms': 1000 * percentile(latencies, 0.50),
+        'p90_ms': 1000 * percentile(latencies, 0.90),
+        'p99_ms': 1000 * percentile(latencies, 0.99),
+    }
+
+
+async def seed_sessions(backend, population: int, chunk_size: int = 1000) -> list:
+    """Put population valid sessions into the backend and return their (session_id, csrf_token) pairs."""
+    expires_at = time.time() + 3600
+    sessions = [(main.get_uuid(), main.get_uuid()) for _ in range(population)]
+    for start in range(0, population, chunk_size):
+        await asyncio.gather(*(backend.put(session_id, {'username': main._DEFAULT_ADMIN_USERNAME,
+                                                        'csrfToken': csrf_token,
+                                                        'expires_at': expires_at})
+                               for session_id, csrf_token in sessions[start:start + chunk_size]))
+    return sessions
+
+
+def build_request(endpoint: str, session):
+    session_id, csrf_token = session if session is not None else (None, None)
+    if endpoint == 'login':
+        return 'POST', '/api/v1/login', {}, {'username': main._DEFAULT_ADMIN_USERNAME,
+                                              'password': main._DEFAULT_ADMIN_PASSWORD}
+    headers = {'Cookie': f"session_id={session_id}"}
+    if endpoint == 'login_status':
+        return 'GET', '/api/v1/login/status', headers, None
+    if endpoint == 'logout':
+        return 'GET', '/api/v1/logout', headers, None
+    headers['X-CSRF-TOKEN'] = csrf_token
+    return 'GET', '/api/v1/protected/resources', headers, None
+
+
+def httpx_sender(client: httpx.AsyncClient):
+    async def send(method: str, url: str, headers: dict, body) -> int:
+        response = await client.request(method, url, headers=headers, json=body)
+        return response.status_code
+    return send
+
+
+def aiohttp_sender(session: aiohttp.ClientSession):
+    async def send(method: str, url: str, headers: dict, body) -> int:
+        async with session.request(method, url, headers=headers, json=body) as response:
+            await response.read()
+            return response.status
+    return send
+
+
+async def drive_endpoint(send, endpoint: str, sessions: list, requests: int, concurrency: int) -> dict:
+    latencies = []
+    errors = 0
+    next_request = 0
+
+    async def worker():
+        nonlocal next_request, errors
+        while next_request < requests:
+            index = next_request
+            next_request += 1
+            session = sessions[index % len(sessions)] if sessions else None
+            method, url, headers, body = build_request(endpoint, session)
+            start = time.perf_counter()
+            status_code = await send(method, url, headers, body)
+            latencies.append(time.perf_counter() - start)
+            if status_code != 200:
+                errors += 1
+
+    start = time.perf_counter()
+    await asyncio.gather(*(worker() for _ in range(concurrency)))
+    return summarize(latencies, time.perf_counter() - start, errors)
+
+
+async def run_endpoints(send, backend, population: int, requests: int, concurrency: int) -> dict:
+    """Drive every endpoint once the store holds population existing sessions.
+
+    Status and protected requests cycle over the seeded sessions. Logout needs
+    a fresh live session per request, so those are seeded separately.
+    """
+    sessions = await seed_sessions(backend, population)
+    results = {}
+    for endpoint in ENDPOINTS:
+        if endpoint == 'logout':
+            endpoint_sessions = await seed_sessions(backend, requests)
+        else:
+            endpoint_sessions = sessions
+        results[endpoint] = await drive_endpoint(send, endpoint, endpoint_sessions, requests, concurrency)
+    return results
+
+
+async def run_in_process(population: int, requests: int, concurrency: int) -> dict:
+    main.session_backend = main.create_session_backend()
+    # Everything built at import time around the old backend has to follow it
+    main.token_revocation_list = main.create_token_revocation_list()
+    main.session_validator = main.create_session_validator()
+    main.rate_limiter = main.create_rate_limiter()
+    main.session_validation_cache.clear()
+    await main.startup_event_handler()
+    try:
+        transport = httpx.ASGITransport(app=main.app)
+        async with httpx.AsyncClient(transport=transport, base_url='http://benchmark', cookies=no_cookies_jar()) as client:
+            return await run_endpoints(httpx_sender(client), main.session_backend, population, requests, concurrency)
+    finally:
+        await main.shutdown_event_handler()
+
+
+def free_port() -> int:
+    with socket.socket() as sock:
+        sock.bind(('127.0.0.1', 0))
+        return sock.getsockname()[1]
+
+
+async def wait_until_listening(base_url: str, process: subprocess.Popen, timeout: float = 30.0):
+    deadline = time.monotonic() + timeout
+    async with httpx.AsyncClient(base_url=base_url) as client:
+        while time.monotonic() < deadline:
+            if process.poll() is not None:
+                raise RuntimeError(f"uvicorn exited early with code {process.returncode}")
+            try:
+                await client.get('/api/v1/login/status')
+                return
+            except httpx.TransportError:
+                await asyncio.sleep(0.1)
+    raise RuntimeError("uvicorn did not start in time")
+
+
+async def run_over_uvicorn(population: int, requests: int, concurrency: int) -> dict:
+    """Seed the store from this process, then benchmark a separate uvicorn server over HTTP.
+
+    The server shares the store through the working directory (json, sqlite)
+    or the configured redis server.
+    """
+    if main._SESSION_BACKEND == 'redis' and main._SESSIONS_REDIS_URL.startswith('memory://'):
+        raise SystemExit("The memory:// redis stand-in cannot be shared with a uvicorn process")
+    seed_backend = main.create_session_backend()
+    await seed_backend.open()
+    port = free_port()
+    base_url = f"http://127.0.0.1:{port}"
+    process = None
+    try:
+        # Seed before starting the server so the json backend loads the sessions on startup
+        sessions = await seed_sessions(seed_backend, population)
+        logout_sessions = await seed_sessions(seed_backend, requests)
+        await seed_backend.close()
+        process = subprocess.Popen([sys.executable, '-m', 'uvicorn', 'main:app', '--app-dir', APP_DIR,
+                                    '--host', '127.0.0.1', '--port', str(port), '--log-level', 'warning'],
+                                   stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+        await wait_until_listening(base_url, process)
+        results = {}
+        async with aiohttp.ClientSession(base_url, connector=aiohttp.TCPConnector(limit=concurrency),
+                                         cookie_jar=aiohttp.DummyCookieJar()) as session:
+            for endpoint in ENDPOINTS:
+                endpoint_sessions = logout_sessions if endpoint == 'logout' else sessions
+                results[endpoint] = await drive_endpoint(aiohttp_sender(session), endpoint, endpoint_sessions,
+                                                         requests, concurrency)
+        return results
+    finally:
+        if process is not None:
+            process.terminate()
+            process.wait(timeout=30)
+
+
+def print_results(run: dict, baseline: dict = None):
+    baseline_index = {}
+    for result in (baseline or {}).get('results', []):
+        baseline_index[(result['population'], result['endpoint'])] = result
+    print(f"{'population':>10} {'endpoint':<18} {'rps':>9} {'p50 ms':>8} {'p90 ms':>8} {'p99 ms':>8} {'errors':>6}"
+          + (f" {'rps vs base':>12} {'p99 vs base':>12}" if baseline else ''))
+    for result in run['results']:
+        line = (f"{result['population']:>10} {result['endpoint']:<18} {result['rps']:>9.0f} {result['p50_ms']:>8.2f} "
+                f"{result['p90_ms']:>8.2f} {result['p99_ms']:>8.2f} {result['errors']:>6}")
+        base = baseline_index.get((result['population'], result['endpoint']))
+        if base:
+            line += (f" {100 * (result['rps'] / base['rps'] - 1):>+11.1f}% "
+                     f"{100 * (result['p99_ms'] / base['p99_ms'] - 1):>+11.1f}%")
+        print(line)
+
+
+async def run(args) -> dict:
+    logging.getLogger('main').setLevel(args.app_log_level)
+    logging.getLogger('session_backends').setLevel(args.app_log_level)
+    runner = run_in_process if args.mode == 'inprocess' else run_over_uvicorn
+    results = []
+    original_directory = os.getcwd()
+    for population in args.populations:
+        work_directory = tempfile.mkdtemp(prefix='endpoints-benchmark-')
+        os.chdir(work_directory)
+        try:
+            print(f"Running population={population} mode={args.mode} backend={main._SESSION_BACKEND} ...", file=sys.stderr)
+            endpoint_results = await runner(population, args.requests, args.concurrency)
+        finally:
+            os.chdir(original_directory)
+            shutil.rmtree(work_directory, ignore_errors=True)
+        for endpoint, summary in endpoint_results.items():
+            results.append({'population': population, 'endpoint': endpoint, **summary})
+    return {
+        'timestamp': datetime.now(timezone.utc).isoformat(),
+        'python': platform.python_version(),
+        'platform': platform.platform(),
+        'config': {
+            'mode': args.mode,
+            'requests': args.requests,
+            'concurrency': args.concurrency,
+            'session_backend': main._SESSION_BACKEND,
+            'session_mode': main._SESSION_MODE,
+            'persistence_mode': main._SESSIONS_PERSISTENCE_MODE,
+        },
+        'results': results,
+    }
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--mode', choices=('inprocess', 'uvicorn'), default='inprocess')
+    parser.add_argument('--populations', type=lambda value: [int(v) for v in value.split(',')], default=[10, 10000],
+                        help='comma separated numbers of pre-existing sessions, e.g. 10,10000,1000000')
+    parser.add_argument('--requests', type=int, default=2000, help='requests per endpoint and population')
+    parser.add_argument('--concurrency', type=int, default=50, help='requests in flight')
+    parser.add_argument('--output', help='write results as json to this file')
+    parser.add_argument('--baseline', help='json results of an earlier run to compare against')
+    parser.add_argument('--app-log-level', default='WARNING', help='log level of the in-process app')
+    return parser.parse_args()
+
+
+if __name__ == '__main__':
+    args = parse_args()
+    run_results = asyncio.run(run(args))
+    baseline = None
+    if args.baseline:
+        with open(args.baseline) as fp:
+            baseline = json.load(fp)
+    print_results(run_results, baseline)
+    if args.output:
+        with open(args.output, 'w') as fp:
+            json.dump(run_results, fp, indent=2)
+    failed = [f"{result['endpoint']} (population {result['population']}): {result['errors']}/{args.requests}"
+              for result in run_results['results'] if result['errors']]
+    if failed:
+        # Timings of failed requests do not measure the endpoint, do not let them pass for a result
+        raise SystemExit(f"Benchmark invalid, requests failed: {', '.join(failed)}")
@@ -0,0 +1,200 @@
+"""Per-response CPU cost of building response bodies: FastAPI's default path against FAST_JSON_RESPONSES.
+
+Each case builds the same payload both ways, without any I/O or routing:
+
+- default: the handler returns a pydantic model; FastAPI runs it through
+  serialize_response (jsonable_encoder) and JSONResponse encodes it with
+  json.dumps. Errors go through FastAPI's http_exception_handler and
+  resource pages through a catalog encoding with json.dumps.
+- fast: main.api_response / static_api_response with FAST_JSON_RESPONSES on,
+  fast_json.http_exception_handler, and a catalog built with
+  fast_json.dumps and pre_encode.
+
+Cases:
+
+- login: the login response.
+- login_status: a logged in status.
+- logged_out_status: the logged out status, a static payload.
+- session_page: an admin page of 100 session summaries.
+- error_401: a prebuilt 401 from session validation.
+- resources_page: a json page of 100 resources.
+- resources_projected: the same page projected on name,properties.k1.
+
+Times are process CPU time, the best of --repeat rounds of --iterations
+responses. The fast path uses orjson when it is installed; --no-orjson
+measures its json.dumps fallback.
+
+Run from backend/python:
+
+    python benchmarks/serialization_benchmark.py
+    python benchmarks/serialization_benchmark.py --no-orjson --output stdlib.json
+"""
+import argparse
+import asyncio
+import json
+import os
+import platform
+import sys
+import time
+from datetime import datetime, timezone
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+CASES = ('login', 'login_status', 'logged_out_status', 'session_page', 'error_401', 'resources_page',
+         'resources_projected')
+VARIANTS = ('default', 'fast')
+
+
+def build_resources(count: int) -> list:
+    return [{'name': f"resource{index:06d}",
+             'properties': {'k1': f"value{index % 97}", 'k2': index, 'k3': index % 2 == 0, 'k4': index / 7}}
+            for index in range(count)]
+
+
+def build_cases(main, fast_json, sub_response, request):
+    """Map (case, variant) to an async function building one response body."""
+    from fastapi import exception_handlers
+    from fastapi.responses import JSONResponse
+    from fastapi.routing import serialize_response
+
+    async def default_response(schema, **fields):
+        main._FAST_JSON_RESPONSES = False
+        model = main.api_response(schema, sub_response, **fields)
+        response = JSONResponse(await serialize_response(response_content=model, is_coroutine=True))
+        response.headers.raw.extend(sub_response.headers.raw)
+        return response.body
+
+    async def fast_response(schema, **fields):
+        main._FAST_JSON_RESPONSES = True
+        return main.api_response(schema, sub_response, **fields).body
+
+    async def default_static_response(schema, payload):
+        main._FAST_JSON_RESPONSES = False
+        model = main.static_api_response(schema, sub_response, payload)
+        response = JSONResponse(await serialize_response(response_content=model, is_coroutine=True))
+        response.headers.raw.extend(sub_response.headers.raw)
+        return response.body
+
+    async def fast_static_response(schema, payload):
+        main._FAST_JSON_RESPONSES = True
+        return main.static_api_response(schema, sub_response, payload).body
+
+    login = {'message': "Logged in user: admin successfully", 'sessionId': main.get_uuid(), 'csrfToken': main.get_uuid(),
+             'expiresIn': float(main._SESSION_DURATION_SECONDS)}
+    login_status = {'isLoggedIn': True, 'sessionId': main.get_uuid(), 'csrfToken': main.get_uuid(),
+                    'expiresIn': float(main._SESSION_DURATION_SECONDS)}
+    session_page = {'items': [main.session_summary(main.get_uuid(), {'username': f"user{index}", 'expires_at': time.time()})
+                              for index in range(100)],
+                    'nextCursor': main.get_uuid()}
+    error = main._PROTECTED_API_ERRORS[main.session_validation.INVALID].exception()
+
+    resources = build_resources(10000)
+    default_catalog = main.ResourceCatalog(resources)
+    fast_catalog = main.ResourceCatalog(resources, dumps=fast_json.dumps, pre_encode=True)
+    positions, next_cursor = default_catalog.select(limit=100)
+    projection = main.parse_fields('name,properties.k1')
+
+    def page(catalog, fields):
+        async def build():
+            return b''.join([chunk async for chunk in catalog.stream_json(positions, fields, next_cursor)])
+        return build
+
+    return {
+        ('login', 'default'): lambda: default_response(main.LoginResponseSchema, **login),
+        ('login', 'fast'): lambda: fast_response(main.LoginResponseSchema, **login),
+        ('login_status', 'default'): lambda: default_response(main.LoginStatusResponseSchema, **login_status),
+        ('login_status', 'fast'): lambda: fast_response(main.LoginStatusResponseSchema, **login_status),
+        ('logged_out_status', 'default'): lambda: default_static_response(main.LoginStatusResponseSchema,
+                                                                          main._LOGGED_OUT_STATUS),
+        ('logged_out_status', 'fast'): lambda: fast_static_response(main.LoginStatusResponseSchema,
+                                                                    main._LOGGED_OUT_STATUS),
+        ('session_page', 'default'): lambda: default_response(main.GetAllSessionsResponseSchema, **session_page),
+        ('session_page', 'fast'): lambda: fast_response(main.GetAllSessionsResponseSchema, **session_page),
+        ('error_401', 'default'): lambda: exception_handlers.http_exception_handler(request, error),
+        ('error_401', 'fast'): lambda: fast_json.http_exception_handler(request, error),
+        ('resources_page', 'default'): page(default_catalog, None),
+        ('resources_page', 'fast'): page(fast_catalog, None),
+        ('resources_projected', 'default'): page(default_catalog, projection),
+        ('resources_projected', 'fast'): page(fast_catalog, projection),
+    }
+
+
+async def measure(build, iterations: int, repeat: int) -> dict:
+    best = None
+    for _ in range(repeat):
+        start = time.process_time()
+        for _ in range(iterations):
+            await build()
+        elapsed = time.process_time() - start
+        best = elapsed if best is None else min(best, elapsed)
+    body = await build()
+    if not isinstance(body, bytes):
+        body = body.body
+    return {'cpu_us_per_response': 1e6 * best / iterations, 'body_bytes': len(body)}
+
+
+async def run(args) -> dict:
+    import main
+    import fast_json
+    from fastapi import Request, Response
+
+    sub_response = Response()
+    del sub_response.headers['content-length']
+    sub_response.set_cookie('session_id', main.get_uuid(), httponly=True, samesite='lax')
+    request = Request({'type': 'http', 'method': 'GET', 'path': '/', 'query_string': b'', 'headers': []})
+    cases = build_cases(main, fast_json, sub_response, request)
+    results = []
+    for case in args.cases:
+        for variant in VARIANTS:
+            print(f"Running case={case} variant={variant} encoder={fast_json.ENCODER} ...", file=sys.stderr)
+            result = await measure(cases[(case, variant)], args.iterations, args.repeat)
+            results.append({'case': case, 'variant': variant, **result})
+    return {
+        'timestamp': datetime.now(timezone.utc).isoformat(),
+        'python': platform.python_version(),
+        'platform': platform.platform(),
+        'config': {
+            'encoder': fast_json.ENCODER,
+            'iterations': args.iterations,
+            'repeat': args.repeat,
+        },
+        'results': results,
+    }
+
+
+def print_results(results: list):
+    by_key = {(result['case'], result['variant']): result for result in results}
+    print(f"{'case':<20} {'variant':<8} {'cpu us':>9} {'bytes':>7} {'vs default':>11}")
+    for case in CASES:
+        default = by_key.get((case, 'default'))
+        for variant in VARIANTS:
+            result = by_key.get((case, variant))
+            if result is None:
+                continue
+            line = f"{case:<20} {variant:<8} {result['cpu_us_per_response']:>9.2f} {result['body_bytes']:>7}"
+            if variant != 'default' and default:
+                line += f" {100 * (result['cpu_us_per_response'] / default['cpu_us_per_response'] - 1):>+10.1f}%"
+            print(line)
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--iterations', type=int, default=2000, help='responses per round')
+    parser.add_argument('--repeat', type=int, default=5, help='rounds per case and variant; the best one is kept')
+    parser.add_argument('--cases', type=lambda value: value.split(','), default=list(CASES),
+                        help=f"comma separated subset of {','.join(CASES)}")
+    parser.add_argument('--no-orjson', action='store_true', help='measure the fast path with its json.dumps fallback')
+    parser.add_argument('--output', help='write results as json to this file')
+    return parser.parse_args()
+
+
+if __name__ == '__main__':
+    args = parse_args()
+    if args.no_orjson:
+        # Makes 'import orjson' fail in fast_json, as if it was not installed
+        sys.modules['orjson'] = None
+    run_results = asyncio.run(run(args))
+    print_results(run_results['results'])
+    if args.output:
+        with open(args.output, 'w') as fp:
+            json.dump(run_results, fp, indent=2)
@@ -0,0 +1,105 @@
+"""Concurrent login/logout stress test for the session layer.
+
+Fires thousands of concurrent logins against the in-process backend app, logs
+out a share of them while other logins are still in flight, and then checks
+that exactly the sessions that were not logged out survive, both in the
+session backend and, for the json backend, in sessions.json after shutdown.
+
+Run from backend/python:
+
+    python benchmarks/session_stress.py --logins 5000 --concurrency 500
+
+The session backend is selected with the usual SESSION_BACKEND settings.
+"""
+import argparse
+import asyncio
+import os
+import sys
+import time
+from http.cookiejar import CookieJar, DefaultCookiePolicy
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import httpx
+
+# Every login comes from one client, keep the login rate limits from rejecting them
+os.environ.setdefault('RATE_LIMITS', '')
+# All sessions belong to the same user, keep the per-user session limit from evicting them
+os.environ.setdefault('MAX_SESSIONS_PER_USER', '0')
+
+import main
+
+
+def no_cookies_jar() -> CookieJar:
+    """A cookie jar that keeps nothing, so concurrent requests stay independent."""
+    return CookieJar(policy=DefaultCookiePolicy(allowed_domains=[]))
+
+
+async def login_and_maybe_logout(client: httpx.AsyncClient, semaphore: asyncio.Semaphore, index: int, logout_every: int):
+    async with semaphore:
+        response = await client.post('/api/v1/login', json={'username': main._DEFAULT_ADMIN_USERNAME,
+                                                            'password': main._DEFAULT_ADMIN_PASSWORD})
+        response.raise_for_status()
+        session_id = response.cookies.get('session_id')
+    if logout_every and index % logout_every == 0:
+        async with semaphore:
+            response = await client.get('/api/v1/logout', headers={'Cookie': f"session_id={session_id}"})
+            response.raise_for_status()
+        return session_id, False
+    return session_id, True
+
+
+async def count_sessions(session_ids) -> int:
+    found = 0
+    for session_id in session_ids:
+        if await main.get_session_by_session_id(session_id=session_id) is not None:
+            found += 1
+    return found
+
+
+async def run(logins: int, concurrency: int, logout_every: int) -> bool:
+    await main.startup_event_handler()
+    transport = httpx.ASGITransport(app=main.app)
+    semaphore = asyncio.Semaphore(concurrency)
+    start = time.perf_counter()
+    async with httpx.AsyncClient(transport=transport, base_url='http://stress', cookies=no_cookies_jar()) as client:
+        results = await asyncio.gather(*(login_and_maybe_logout(client, semaphore, index, logout_every)
+                                         for index in range(logins)))
+    elapsed = time.perf_counter() - start
+
+    kept = [session_id for session_id, is_kept in results if is_kept]
+    removed = [session_id for session_id, is_kept in results if not is_kept]
+    kept_found = await count_sessions(kept)
+    removed_found = await count_sessions(removed)
+    await main.shutdown_event_handler()
+
+    ok = kept_found == len(kept) and removed_found == 0
+    print(f"backend={main.session_backend.name} logins={logins} logouts={len(removed)} "
+          f"concurrency={concurrency} elapsed={elapsed:.2f}s requests/s={(logins + len(removed)) / elapsed:.0f}")
+    print(f"live sessions: expected={len(kept)} found={kept_found} lost={len(kept) - kept_found}")
+    print(f"logged out sessions still present: {removed_found}")
+
+    if main.session_backend.name == 'json':
+        reloaded = main.create_session_backend()
+        await reloaded.open()
+        persisted_kept = sum(1 for session_id in kept if session_id in reloaded.sessions)
+        persisted_removed = sum(1 for session_id in removed if session_id in reloaded.sessions)
+        await reloaded.close()
+        print(f"after restart: expected={len(kept)} found={persisted_kept} resurrected={persisted_removed}")
+        ok = ok and persisted_kept == len(kept) and persisted_removed == 0
+
+    print("PASS" if ok else "FAIL")
+    return ok
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--logins', type=int, default=5000, help='number of concurrent logins')
+    parser.add_argument('--concurrency', type=int, default=500, help='maximum requests in flight')
+    parser.add_argument('--logout-every', type=int, default=2, help='log out every Nth session, 0 to never log out')
+    return parser.parse_args()
+
+
+if __name__ == '__main__':
+    args = parse_args()
+    sys.exit(0 if asyncio.run(run(args.logins, args.concurrency, args.logout_every)) else 1)
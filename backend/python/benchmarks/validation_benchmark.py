@@ -0,0 +1,280 @@
+"""Per-request overhead of protected route validation: the session_validation engine against the previous inline code.
+
+By default each variant is called directly as a dependency with a prebuilt
+request, one call at a time, which isolates the validation code. With
+--through router both guard the same protected router, mounted on two
+otherwise identical in-process apps and driven through httpx's ASGI
+transport, which adds the framework's per-request cost on top. The previous
+implementation is reproduced below as legacy_validate_protected_api_request.
+
+Every scenario is run against both apps with a fresh store:
+
+- valid: valid session and CSRF token.
+- valid_uncached: the same with the session validation cache disabled, so every request reads the store.
+- csrf_mismatch: a wrong X-CSRF-TOKEN header.
+- expired: sessions past their expiry; the old code deleted them inline.
+- unknown: a session id that is not in the store.
+
+Besides latency, the session store calls per request are counted.
+
+Run from backend/python:
+
+    python benchmarks/validation_benchmark.py --requests 5000
+    python benchmarks/validation_benchmark.py --through router --app-log-level WARNING
+    SESSION_BACKEND=sqlite python benchmarks/validation_benchmark.py --output after.json
+"""
+import argparse
+import asyncio
+import json
+import logging
+import os
+import platform
+import shutil
+import sys
+import tempfile
+import time
+from datetime import datetime, timezone
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import httpx
+from fastapi import Depends, FastAPI, HTTPException, Request, Response, status
+
+# Every request comes from one client, keep the rate limits out of the numbers
+os.environ.setdefault('RATE_LIMITS', '')
+
+import main
+from main import delete_session_by_session_id, enforce_rate_limit, logger, refresh_session_expiry, timed
+
+SCENARIOS = ('valid', 'valid_uncached', 'csrf_mismatch', 'expired', 'unknown')
+VARIANTS = ('legacy', 'engine')
+
+
+@timed('validate_protected_api_request')
+async def legacy_validate_protected_api_request(request: Request, response: Response):
+    """validate_protected_api_request as it was before session_validation.py, server mode only."""
+    logger.info("Validating protected api request")
+    await enforce_rate_limit('protected', request)
+    session_id = request.cookies.get('session_id')
+    if session_id is None:
+        logger.error("No session_id cookie found in request")
+        raise HTTPException(status_code=status.HTTP_401_UNAUTHORIZED,
+                            detail="No session_id cookie found in request")
+    logger.info("Found session_id=%s cookie in request", session_id)
+    existing_session = None
+    if main.session_validation_cache.enabled:
+        existing_session = main.session_validation_cache.get(session_id)
+    if existing_session is None:
+        existing_session = await main.session_backend.get(session_id)
+    if existing_session is None:
+        logger.warning("Could not find a session record in db for session_id=%s", session_id)
+        raise HTTPException(status_code=status.HTTP_401_UNAUTHORIZED,
+                            detail="Invalid session_id cookie")
+    logger.info("Found a session record in db for session_id=%s", session_id)
+    csrf_token_header = request.headers.get('X-CSRF-TOKEN')
+    if csrf_token_header is None:
+        logger.error("No csrf token header found in request")
+        raise HTTPException(status_code=status.HTTP_401_UNAUTHORIZED,
+                            detail="No csrf token header found in request")
+    session_expires_at = existing_session.get('expires_at')
+    username = existing_session.get('username')
+    csrf_token = existing_session.get('csrfToken')
+    if session_expires_at is None or csrf_token is None or username is None:
+        logger.warning("Deleting the corrupted session record in db")
+        await delete_session_by_session_id(session_id=session_id)
+        raise HTTPException(status_code=status.HTTP_500_INTERNAL_SERVER_ERROR,
+                            detail="Corrupted session record found in db")
+    if csrf_token != csrf_token_header:
+        logger.error("csrf token validation failed")
+        raise HTTPException(status_code=status.HTTP_401_UNAUTHORIZED,
+                            detail="csrf token validation failed")
+    logger.info("csrf token validation successfull")
+    logger.info("Found a valid session record in db for session_id:%s", session_id)
+    logger.info("Checking if session is still valid or not")
+    if time.time() < session_expires_at + main._SESSION_CLOCK_SKEW_TOLERANCE_SECONDS:
+        logger.info("Session is valid.")
+        main.session_validation_cache.put(session_id, existing_session)
+        await refresh_session_expiry(session_id, session_expires_at, response)
+        request.state.username = username
+        request.state.session_id = session_id
+        request.state.session = existing_session
+        return
+    logger.info("Session is expired.")
+    logger.info("Deleting the expired session record in db")
+    await delete_session_by_session_id(session_id=session_id)
+    raise HTTPException(status_code=status.HTTP_401_UNAUTHORIZED,
+                        detail=f"session expired for session_id={session_id}")
+
+
+def create_app(dependency) -> FastAPI:
+    app = FastAPI()
+    app.include_router(router=main.protected_api_router, dependencies=[Depends(dependency)])
+    return app
+
+
+class CountingBackend:
+    """Forwards to a session backend and counts the calls made through it."""
+
+    def __init__(self, backend):
+        self.backend = backend
+        self.calls = 0
+
+    def __getattr__(self, name):
+        attribute = getattr(self.backend, name)
+        if name in ('get', 'put', 'delete', 'expire') and callable(attribute):
+            async def counted(*args, **kwargs):
+                self.calls += 1
+                return await attribute(*args, **kwargs)
+            return counted
+        return attribute
+
+
+async def seed_sessions(backend, count: int, expires_at: float) -> list:
+    sessions = [(main.get_uuid(), main.get_uuid()) for _ in range(count)]
+    await asyncio.gather(*(backend.put(session_id, {'username': main._DEFAULT_ADMIN_USERNAME,
+                                                    'csrfToken': csrf_token,
+                                                    'expires_at': expires_at})
+                           for session_id, csrf_token in sessions))
+    return sessions
+
+
+def build_request(headers: dict) -> Request:
+    scope = {'type': 'http', 'method': 'GET', 'path': '/api/v1/protected/resources', 'query_string': b'',
+             'headers': [(name.lower().encode(), value.encode()) for name, value in headers.items()],
+             'client': ('127.0.0.1', 50000), 'state': {}}
+    return Request(scope)
+
+
+def dependency_sender(dependency):
+    async def send(headers: dict):
+        try:
+            await dependency(build_request(headers), Response())
+        except HTTPException:
+            pass
+    return send
+
+
+def router_sender(client: httpx.AsyncClient):
+    async def send(headers: dict):
+        await client.get('/api/v1/protected/resources', headers=headers)
+    return send
+
+
+def build_headers(scenario: str, session_id: str, csrf_token: str) -> dict:
+    if scenario == 'unknown':
+        session_id = main.get_uuid()
+    if scenario == 'csrf_mismatch':
+        csrf_token = 'not-the-csrf-token'
+    return {'Cookie': f"session_id={session_id}", 'X-CSRF-TOKEN': csrf_token}
+
+
+async def run_scenario(variant: str, scenario: str, requests: int, distinct_sessions: int, through: str) -> dict:
+    backend = main.create_session_backend()
+    counting_backend = CountingBackend(backend)
+    main.session_backend = counting_backend
+    main.session_validation_cache = main.SessionValidationCache(
+        max_size=0 if scenario == 'valid_uncached' else main._SESSION_CACHE_MAX_SIZE,
+        max_ttl=main._SESSION_CACHE_TTL_SECONDS)
+    main.session_validator = main.create_session_validator()
+    await backend.open()
+    try:
+        expires_at = time.time() + (-3600 if scenario == 'expired' else 3600)
+        # Expired sessions are deleted by the old code, so give every request its own
+        sessions = await seed_sessions(backend, requests if scenario == 'expired' else distinct_sessions, expires_at)
+        dependency = legacy_validate_protected_api_request if variant == 'legacy' else main.validate_protected_api_request
+        transport = httpx.ASGITransport(app=create_app(dependency))
+        latencies = []
+        async with httpx.AsyncClient(transport=transport, base_url='http://benchmark') as client:
+            send = router_sender(client) if through == 'router' else dependency_sender(dependency)
+            counting_backend.calls = 0
+            for index in range(requests):
+                session_id, csrf_token = sessions[index % len(sessions)]
+                headers = build_headers(scenario, session_id, csrf_token)
+                start = time.perf_counter()
+                await send(headers)
+                latencies.append(time.perf_counter() - start)
+        latencies.sort()
+        return {
+            'variant': variant,
+            'scenario': scenario,
+            'requests': requests,
+            'mean_us': 1e6 * sum(latencies) / len(latencies),
+            'p50_us': 1e6 * latencies[len(latencies) // 2],
+            'p99_us': 1e6 * latencies[min(len(latencies) - 1, int(len(latencies) * 0.99))],
+            'store_calls_per_request': counting_backend.calls / requests,
+        }
+    finally:
+        await backend.close()
+
+
+def print_results(results: list):
+    by_key = {(result['scenario'], result['variant']): result for result in results}
+    print(f"{'scenario':<16} {'variant':<8} {'mean us':>9} {'p50 us':>9} {'p99 us':>9} {'store calls':>12} {'mean vs legacy':>15}")
+    for scenario in SCENARIOS:
+        legacy = by_key.get((scenario, 'legacy'))
+        for variant in VARIANTS:
+            result = by_key.get((scenario, variant))
+            if result is None:
+                continue
+            line = (f"{scenario:<16} {variant:<8} {result['mean_us']:>9.1f} {result['p50_us']:>9.1f} "
+                    f"{result['p99_us']:>9.1f} {result['store_calls_per_request']:>12.2f}")
+            if variant != 'legacy' and legacy:
+                line += f" {100 * (result['mean_us'] / legacy['mean_us'] - 1):>+14.1f}%"
+            print(line)
+
+
+async def run(args) -> dict:
+    logging.getLogger('main').setLevel(args.app_log_level)
+    logging.getLogger('session_backends').setLevel(args.app_log_level)
+    results = []
+    original_directory = os.getcwd()
+    for scenario in args.scenarios:
+        for variant in VARIANTS:
+            work_directory = tempfile.mkdtemp(prefix='validation-benchmark-')
+            os.chdir(work_directory)
+            try:
+                print(f"Running scenario={scenario} variant={variant} backend={main._SESSION_BACKEND} ...", file=sys.stderr)
+                # One untimed warm-up pass, then the measured one
+                await run_scenario(variant, scenario, min(200, args.requests), args.sessions, args.through)
+                results.append(await run_scenario(variant, scenario, args.requests, args.sessions, args.through))
+            finally:
+                os.chdir(original_directory)
+                shutil.rmtree(work_directory, ignore_errors=True)
+    return {
+        'timestamp': datetime.now(timezone.utc).isoformat(),
+        'python': platform.python_version(),
+        'platform': platform.platform(),
+        'config': {
+            'through': args.through,
+            'requests': args.requests,
+            'sessions': args.sessions,
+            'session_backend': main._SESSION_BACKEND,
+            'app_log_level': args.app_log_level,
+        },
+        'results': results,
+    }
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--through', choices=('dependency', 'router'), default='dependency',
+                        help='call the dependency directly, or send requests through the app')
+    parser.add_argument('--requests', type=int, default=2000, help='requests per scenario and variant')
+    parser.add_argument('--sessions', type=int, default=1000, help='distinct sessions the requests cycle through')
+    parser.add_argument('--scenarios', type=lambda value: value.split(','), default=list(SCENARIOS),
+                        help=f"comma separated subset of {','.join(SCENARIOS)}")
+    parser.add_argument('--output', help='write results as json to this file')
+    parser.add_argument('--app-log-level', default='CRITICAL',
+                        help='log level of the in-process app; failures log a line each, which would dominate')
+    return parser.parse_args()
+
+
+if __name__ == '__main__':
+    args = parse_args()
+    if main._SESSION_MODE == 'signed':
+        raise SystemExit("The previous implementation is only reproduced for server-side sessions")
+    run_results = asyncio.run(run(args))
+    print_results(run_results['results'])
+    if args.output:
+        with open(args.output, 'w') as fp:
+            json.dump(run_results, fp, indent=2)
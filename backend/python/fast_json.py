@@ -0,0 +1,117 @@
+"""Fast json responses, used when FAST_JSON_RESPONSES is on.
+
+By default a handler returns a pydantic model and FastAPI turns it into a
+response in two passes: jsonable_encoder walks the model into plain python
+values, then JSONResponse encodes those with json.dumps. The payloads of
+this app are built from values it produced itself (strings, numbers,
+booleans and None, in lists and dicts), which need neither validation nor
+conversion. In fast mode handlers pass a plain dict to json_response(),
+which encodes it once, with orjson when it is installed and with compact
+json.dumps otherwise.
+
+Payloads that never change are encoded once (StaticJSONPayload,
+PreEncodedHTTPError) and every response shares the same bytes.
+"""
+import json
+from typing import Optional
+
+from fastapi import HTTPException, Request, Response
+from fastapi.responses import JSONResponse
+
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+ENCODER = 'orjson' if orjson is not None else 'json'
+
+
+def stdlib_dumps(content) -> bytes:
+    return json.dumps(content, ensure_ascii=False, allow_nan=False, separators=(',', ':')).encode('utf-8')
+
+
+def dumps(content) -> bytes:
+    """Encode trusted content as compact json bytes."""
+    if orjson is not None:
+        return orjson.dumps(content)
+    return stdlib_dumps(content)
+
+
+class FastJSONResponse(JSONResponse):
+    """JSONResponse encoded with dumps()."""
+
+    def render(self, content) -> bytes:
+        return dumps(content)
+
+
+class EncodedJSONResponse(Response):
+    """Response whose json body is already encoded."""
+
+    media_type = 'application/json'
+
+
+def with_headers_of(response: Response, sub_response: Response) -> Response:
+    """Copy the headers (e.g. Set-Cookie) set on a handler's Response parameter.
+
+    FastAPI only merges them into responses it builds itself, not into a
+    Response returned by the handler.
+    """
+    response.headers.raw.extend(sub_response.headers.raw)
+    if sub_response.status_code:
+        response.status_code = sub_response.status_code
+    return response
+
+
+def json_response(content: dict, sub_response: Response) -> Response:
+    return with_headers_of(FastJSONResponse(content), sub_response)
+
+
+class StaticJSONPayload:
+    """A response payload that never changes, encoded once."""
+
+    __slots__ = ('content', 'body')
+
+    def __init__(self, content: dict):
+        self.content = content
+        self.body = dumps(content)
+
+    def response(self, sub_response: Response) -> Response:
+        return with_headers_of(EncodedJSONResponse(self.body), sub_response)
+
+
+class PreEncodedHTTPException(HTTPException):
+    """HTTPException that carries its {"detail": ...} body, for errors raised with the same detail every time."""
+
+    def __init__(self, status_code: int, detail: str, body: Optional[bytes] = None):
+        super().__init__(status_code=status_code, detail=detail)
+        self.body = body if body is not None else dumps({'detail': detail})
+
+
+class PreEncodedHTTPError:
+    """An error raised with the same status and detail every time, its body encoded once.
+
+    exception() makes a new PreEncodedHTTPException per raise, sharing the
+    body: a raised exception collects the traceback and context of the
+    request that raised it, so one instance must not be reused across requests.
+    """
+
+    __slots__ = ('status_code', 'detail', 'body')
+
+    def __init__(self, status_code: int, detail: str):
+        self.status_code = status_code
+        self.detail = detail
+        self.body = dumps({'detail': detail})
+
+    def exception(self) -> PreEncodedHTTPException:
+        return PreEncodedHTTPException(self.status_code, self.detail, self.body)
+
+
+async def http_exception_handler(request: Request, exc: HTTPException) -> Response:
+    """Like FastAPI's default handler, but reuses the body of a PreEncodedHTTPException and encodes others with dumps()."""
+    headers = getattr(exc, 'headers', None)
+    if exc.status_code < 200 or exc.status_code in (204, 304):
+        return Response(status_code=exc.status_code, headers=headers)
+    body = getattr(exc, 'body', None)
+    if body is None:
+        body = dumps({'detail': exc.detail})
+    return EncodedJSONResponse(body, status_code=exc.status_code, headers=headers)
@@ -0,0 +1,61 @@
+"""Leader election between the worker processes of one host, with a file lock.
+
+Every worker calls LeaderLock.try_acquire() before doing maintenance that
+must run in one process only (e.g. sweeping expired sessions). The first
+one to ask takes an exclusive flock on the lock file and keeps it while it
+lives, so it stays the leader. The kernel drops the lock when that process
+exits, even if it crashes, and the next worker to ask takes over.
+
+The file is opened on first use, never before workers are forked: children
+of a process holding the lock would share its open file and all think they
+are the leader. Without fcntl (Windows) there is one process and it always leads.
+"""
+import os
+from typing import Optional
+
+from logging_setup import get_logger
+
+try:
+    import fcntl
+except ImportError:
+    fcntl = None
+
+logger = get_logger(__name__)
+
+
+class LeaderLock:
+
+    def __init__(self, file_path: str):
+        self.file_path = file_path
+        self._fd: Optional[int] = None
+        self._pid: Optional[int] = None
+        self.is_leader = False
+
+    def try_acquire(self) -> bool:
+        """Return whether this process is the leader, taking the lock if it is free. Never blocks."""
+        if self.is_leader and self._pid == os.getpid():
+            return True
+        if fcntl is None:
+            self.is_leader = True
+            return True
+        if self._fd is None or self._pid != os.getpid():
+            self._fd = os.open(self.file_path, os.O_RDWR | os.O_CREAT, 0o644)
+            self._pid = os.getpid()
+            self.is_leader = False
+        try:
+            fcntl.flock(self._fd, fcntl.LOCK_EX | fcntl.LOCK_NB)
+        except BlockingIOError:
+            return False
+        os.ftruncate(self._fd, 0)
+        os.write(self._fd, f"{self._pid}\n".encode())
+        self.is_leader = True
+        logger.info("Process %s is now the leader for %s", self._pid, self.file_path)
+        return True
+
+    def release(self):
+        if self._fd is not None and self._pid == os.getpid():
+            # Closing the file drops the lock
+            os.close(self._fd)
+        self._fd = None
+        self._pid = None
+        self.is_leader = False
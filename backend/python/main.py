@@ -1,29 +1,79 @@
-from fastapi import FastAPI, Request, HTTPException, status, Response, Depends
+from fastapi import FastAPI, Request, HTTPException, status, Response, Depends, Query
 from fastapi.routing import APIRouter
 from fastapi.middleware.cors import CORSMiddleware
+from fastapi.responses import PlainTextResponse, StreamingResponse
+from starlette.exceptions import HTTPException as StarletteHTTPException
 from pydantic import BaseModel
 import os
-import logging
-from aiofile import AIOFile
-import json
 from uuid import uuid4
 import time
-from typing import Optional, List
+import math
+import asyncio
+from typing import Optional, List, Dict, Type
+from logging_setup import get_logger, LogContextMiddleware
+from session_backends import SessionBackend, JsonFileSessionBackend, SqliteSessionBackend, RedisSessionBackend, InstrumentedSessionBackend, StripedAsyncLock, seconds_until
+from session_cache import SessionValidationCache
+import session_validation
+from session_validation import SessionValidator, SignedSessionValidator, SessionValidationResult
+from signed_tokens import SessionTokenSigner, TokenRevocationList, parse_signing_keys
+from metrics import MetricsMiddleware, registry as metrics_registry, timed, span
+from user_store import UserStore, JsonFileUserStore, SqliteUserStore, PasswordHasher
+from rate_limiter import RateLimiter, parse_rate_limits
+from resource_catalog import ResourceCatalog, load_resource_catalog, parse_fields, parse_where_filter
+import fast_json
+from fast_json import FastJSONResponse, PreEncodedHTTPError, StaticJSONPayload
+from leader_lock import LeaderLock
+import secrets
 
 _DEFAULT_ADMIN_USERNAME = 'admin'
 _DEFAULT_ADMIN_PASSWORD = 'P@ssword9'
 _SESSIONS_JSON_FILE_PATH = 'sessions.json'
-
-logLevel = logging.INFO
-logger = logging.getLogger(__name__)
-logger.setLevel(logLevel)
-ch = logging.StreamHandler()
-ch.setLevel(logLevel)
-formatter = logging.Formatter('%(asctime)s - %(name)s - %(levelname)s - %(message)s')
-ch.setFormatter(formatter)
-logger.addHandler(ch)
-
-
+_SESSIONS_FLUSH_INTERVAL_SECONDS = float(os.environ.get('SESSIONS_FLUSH_INTERVAL_SECONDS', '1.0'))
+_SESSIONS_PERSISTENCE_MODE = os.environ.get('SESSIONS_PERSISTENCE_MODE', 'snapshot')
+_SESSIONS_JOURNAL_FILE_PATH = os.environ.get('SESSIONS_JOURNAL_FILE_PATH', 'sessions.journal')
+_SESSIONS_JOURNAL_COMPACT_THRESHOLD_BYTES = int(os.environ.get('SESSIONS_JOURNAL_COMPACT_THRESHOLD_BYTES', str(1024 * 1024)))
+_SESSION_DURATION_SECONDS = int(os.environ.get('SESSION_DURATION_SECONDS', '60'))
+_SESSION_CLOCK_SKEW_TOLERANCE_SECONDS = float(os.environ.get('SESSION_CLOCK_SKEW_TOLERANCE_SECONDS', '2'))
+_SESSION_SLIDING_EXPIRATION = os.environ.get('SESSION_SLIDING_EXPIRATION', 'false').lower() in ('1', 'true', 'yes')
+_SESSION_REFRESH_INTERVAL_SECONDS = float(os.environ.get('SESSION_REFRESH_INTERVAL_SECONDS', '15'))
+_SESSION_MODE = os.environ.get('SESSION_MODE', 'server')
+_SESSION_SIGNING_KEYS = os.environ.get('SESSION_SIGNING_KEYS', '')
+_SESSION_CACHE_MAX_SIZE = int(os.environ.get('SESSION_CACHE_MAX_SIZE', '10000'))
+_SESSION_CACHE_TTL_SECONDS = float(os.environ.get('SESSION_CACHE_TTL_SECONDS', '5'))
+_SESSION_LOCK_STRIPES = int(os.environ.get('SESSION_LOCK_STRIPES', '64'))
+_SESSIONS_SWEEP_INTERVAL_SECONDS = float(os.environ.get('SESSIONS_SWEEP_INTERVAL_SECONDS', '30'))
+_MAINTENANCE_LOCK_FILE_PATH = os.environ.get('MAINTENANCE_LOCK_FILE_PATH', 'maintenance.lock')
+_SESSION_BACKEND = os.environ.get('SESSION_BACKEND', 'json')
+_SESSIONS_SQLITE_DB_PATH = os.environ.get('SESSIONS_SQLITE_DB_PATH', 'sessions.db')
+_SESSIONS_REDIS_URL = os.environ.get('SESSIONS_REDIS_URL', 'redis://localhost:6379/0')
+_SESSIONS_REDIS_KEY_PREFIX = os.environ.get('SESSIONS_REDIS_KEY_PREFIX', 'session:')
+_METRICS_ENABLED = os.environ.get('METRICS_ENABLED', 'true').lower() in ('1', 'true', 'yes')
+_USER_STORE = os.environ.get('USER_STORE', 'json')
+_USERS_JSON_FILE_PATH = os.environ.get('USERS_JSON_FILE_PATH', 'users.json')
+_USERS_SQLITE_DB_PATH = os.environ.get('USERS_SQLITE_DB_PATH', 'users.db')
+_PASSWORD_SCRYPT_N = int(os.environ.get('PASSWORD_SCRYPT_N', str(2 ** 14)))
+_PASSWORD_SCRYPT_R = int(os.environ.get('PASSWORD_SCRYPT_R', '8'))
+_PASSWORD_SCRYPT_P = int(os.environ.get('PASSWORD_SCRYPT_P', '1'))
+_PASSWORD_HASH_WORKERS = int(os.environ.get('PASSWORD_HASH_WORKERS', '0')) or None
+_PASSWORD_VERIFY_CACHE_TTL_SECONDS = float(os.environ.get('PASSWORD_VERIFY_CACHE_TTL_SECONDS', '30'))
+_PASSWORD_VERIFY_CACHE_MAX_SIZE = int(os.environ.get('PASSWORD_VERIFY_CACHE_MAX_SIZE', '10000'))
+_RATE_LIMITS = os.environ.get('RATE_LIMITS', 'login.ip=20/60,login.username=10/60')
+_RATE_LIMIT_STORE = os.environ.get('RATE_LIMIT_STORE', 'local')
+_RATE_LIMIT_MAX_KEYS = int(os.environ.get('RATE_LIMIT_MAX_KEYS', '100000'))
+_RATE_LIMIT_TRUST_FORWARDED_FOR = os.environ.get('RATE_LIMIT_TRUST_FORWARDED_FOR', 'false').lower() in ('1', 'true', 'yes')
+_RATE_LIMIT_TRUSTED_PROXY_COUNT = int(os.environ.get('RATE_LIMIT_TRUSTED_PROXY_COUNT', '1'))
+_MAX_SESSIONS_PER_USER = int(os.environ.get('MAX_SESSIONS_PER_USER', '10'))
+_RESOURCES_FILE_PATH = os.environ.get('RESOURCES_FILE_PATH', '')
+_RESOURCES_PAGE_MAX_SIZE = int(os.environ.get('RESOURCES_PAGE_MAX_SIZE', '1000'))
+_RESOURCES_STREAM_MAX_SIZE = int(os.environ.get('RESOURCES_STREAM_MAX_SIZE', '100000'))
+_ADMIN_SESSIONS_PAGE_MAX_SIZE = int(os.environ.get('ADMIN_SESSIONS_PAGE_MAX_SIZE', '1000'))
+_FAST_JSON_RESPONSES = os.environ.get('FAST_JSON_RESPONSES', 'false').lower() in ('1', 'true', 'yes')
+
+logger = get_logger(__name__)
+
+
+# The response schemas document the payloads. With FAST_JSON_RESPONSES the
+# handlers' plain dict payloads are encoded directly instead (see api_response).
 class LoginRequestSchema(BaseModel):
     username: str
     password: str
@@ -32,348 +82,828 @@ class LoginResponseSchema(BaseModel):
     message: str
     sessionId: str
     csrfToken: str
+    expiresIn: float
 
 class LoginStatusResponseSchema(BaseModel):
     isLoggedIn: bool
     sessionId: Optional[str] = None
     csrfToken: Optional[str] = None
+    # Seconds until the session expires, for clients caching the status
+    expiresIn: Optional[float] = None
 
 class LogoutResponseSchema(BaseModel):
     message: str
 
-class GetResourceResponseSchema(BaseModel):
-    name: str
-    properties: Optional[dict] = None
+class RotateSessionResponseSchema(BaseModel):
+    message: str
+    sessionId: str
+    csrfToken: str
+
+class SessionSummarySchema(BaseModel):
+    sessionId: str
+    username: Optional[str] = None
+    expiresAt: Optional[float] = None
+
+class GetAllSessionsResponseSchema(BaseModel):
+    items: List[SessionSummarySchema]
+    nextCursor: Optional[str] = None
 
-class GetAllResourcesResponseSchema(BaseModel):
-    items: List[GetResourceResponseSchema]
+class SessionCountResponseSchema(BaseModel):
     total: int
+    byUser: Dict[str, int]
+
+class RevokeSessionsResponseSchema(BaseModel):
+    message: str
+    revoked: int
 
 def get_uuid():
     return uuid4().hex
 
+def api_response(schema: Type[BaseModel], response: Response, **fields):
+    """The return value of a handler: a schema instance, or with FAST_JSON_RESPONSES the fields encoded as json.
+
+    The fast path skips building and validating the model and FastAPI's
+    jsonable_encoder pass, so fields must only hold json-ready values.
+    """
+    if _FAST_JSON_RESPONSES:
+        return fast_json.json_response(fields, response)
+    return schema(**fields)
+
+def static_api_response(schema: Type[BaseModel], response: Response, payload: StaticJSONPayload):
+    """api_response for a payload that never changes, served from its pre-encoded bytes in fast mode."""
+    if _FAST_JSON_RESPONSES:
+        return payload.response(response)
+    return schema(**payload.content)
+
+_LOGGED_OUT_STATUS = StaticJSONPayload({'isLoggedIn': False, 'sessionId': None, 'csrfToken': None, 'expiresIn': None})
+
+def create_session_backend() -> SessionBackend:
+    """Build the session backend selected by the SESSION_BACKEND setting."""
+    if _SESSION_BACKEND == 'json':
+        backend = JsonFileSessionBackend(file_path=_SESSIONS_JSON_FILE_PATH,
+                                         persistence_mode=_SESSIONS_PERSISTENCE_MODE,
+                                         flush_interval=_SESSIONS_FLUSH_INTERVAL_SECONDS,
+                                         journal_file_path=_SESSIONS_JOURNAL_FILE_PATH,
+                                         journal_compact_threshold=_SESSIONS_JOURNAL_COMPACT_THRESHOLD_BYTES)
+    elif _SESSION_BACKEND == 'sqlite':
+        backend = SqliteSessionBackend(db_path=_SESSIONS_SQLITE_DB_PATH)
+    elif _SESSION_BACKEND == 'redis':
+        backend = RedisSessionBackend(url=_SESSIONS_REDIS_URL, key_prefix=_SESSIONS_REDIS_KEY_PREFIX)
+    else:
+        raise ValueError(f"Unknown session backend: {_SESSION_BACKEND}")
+    if _METRICS_ENABLED:
+        return InstrumentedSessionBackend(backend)
+    return backend
+
+session_backend = create_session_backend()
+session_locks = StripedAsyncLock(stripes=_SESSION_LOCK_STRIPES)
+# Separate from session_locks, whose stripes are taken while one of these is held
+user_session_locks = StripedAsyncLock(stripes=_SESSION_LOCK_STRIPES)
+session_validation_cache = SessionValidationCache(max_size=_SESSION_CACHE_MAX_SIZE, max_ttl=_SESSION_CACHE_TTL_SECONDS)
+
+def create_user_store() -> UserStore:
+    """Build the user store selected by the USER_STORE setting."""
+    if _USER_STORE == 'json':
+        return JsonFileUserStore(file_path=_USERS_JSON_FILE_PATH)
+    elif _USER_STORE == 'sqlite':
+        return SqliteUserStore(db_path=_USERS_SQLITE_DB_PATH)
+    else:
+        raise ValueError(f"Unknown user store: {_USER_STORE}")
+
+user_store = create_user_store()
+password_hasher = PasswordHasher(n=_PASSWORD_SCRYPT_N, r=_PASSWORD_SCRYPT_R, p=_PASSWORD_SCRYPT_P,
+                                 workers=_PASSWORD_HASH_WORKERS,
+                                 cache_ttl=_PASSWORD_VERIFY_CACHE_TTL_SECONDS,
+                                 cache_max_size=_PASSWORD_VERIFY_CACHE_MAX_SIZE)
+
+def create_rate_limiter() -> RateLimiter:
+    """Build the rate limiter from RATE_LIMITS, counting in the session backend when RATE_LIMIT_STORE is 'shared'."""
+    if _RATE_LIMIT_STORE not in ('local', 'shared'):
+        raise ValueError(f"Unknown rate limit store: {_RATE_LIMIT_STORE}")
+    shared_store = session_backend if _RATE_LIMIT_STORE == 'shared' else None
+    return RateLimiter(parse_rate_limits(_RATE_LIMITS), shared_store=shared_store, max_keys=_RATE_LIMIT_MAX_KEYS)
+
+rate_limiter = create_rate_limiter()
+
+# Served until RESOURCES_FILE_PATH is loaded on startup, or for good if it is not set
+_DEMO_RESOURCES = [{'name': 'resource1', 'properties': {'k1': 'v1', 'k2': 'v2'}},
+                   {'name': 'resource2', 'properties': {'k1': 1, 'k2': 2}}]
+# In fast mode resources are encoded with fast_json and once, when the catalog is built
+_RESOURCE_CATALOG_OPTIONS = {'dumps': fast_json.dumps, 'pre_encode': True} if _FAST_JSON_RESPONSES else {}
+resource_catalog = ResourceCatalog(_DEMO_RESOURCES, **_RESOURCE_CATALOG_OPTIONS)
+resources_loaded = False
+
+def load_resources():
+    """Replace the demo catalog with the one in RESOURCES_FILE_PATH. Blocking.
+
+    serve.py calls it before forking workers, so they start with the catalog
+    already in memory instead of each loading its own.
+    """
+    global resource_catalog, resources_loaded
+    logger.info("Loading resource catalog from: %s", _RESOURCES_FILE_PATH)
+    resource_catalog = load_resource_catalog(_RESOURCES_FILE_PATH, **_RESOURCE_CATALOG_OPTIONS)
+    resources_loaded = True
+    logger.info("Loaded %s resources", len(resource_catalog))
+
+def create_session_token_signer() -> Optional[SessionTokenSigner]:
+    """Build the token signer used when SESSION_MODE is 'signed'."""
+    if _SESSION_MODE != 'signed':
+        return None
+    keys = parse_signing_keys(_SESSION_SIGNING_KEYS)
+    if not keys:
+        logger.warning("SESSION_SIGNING_KEYS is not set. Using a random signing key, tokens will not survive a restart or work across workers")
+        keys = {'ephemeral': secrets.token_bytes(32)}
+    return SessionTokenSigner(keys)
+
+session_token_signer = create_session_token_signer()
+
+def create_token_revocation_list() -> TokenRevocationList:
+    """Build the revocation list of signed tokens, shared through the session backend.
+
+    Revocations outlive their token by the clock skew tolerance, as long as
+    an expired token is still accepted.
+    """
+    return TokenRevocationList(session_backend, keep_for=_SESSION_CLOCK_SKEW_TOLERANCE_SECONDS)
+
+token_revocation_list = create_token_revocation_list()
+
+def create_session_validator():
+    """Build the validator of session cookies for the configured SESSION_MODE."""
+    if _SESSION_MODE == 'signed':
+        return SignedSessionValidator(session_token_signer, token_revocation_list, session_validation_cache,
+                                      _SESSION_CLOCK_SKEW_TOLERANCE_SECONDS)
+    return SessionValidator(session_backend, session_validation_cache, _SESSION_CLOCK_SKEW_TOLERANCE_SECONDS)
+
+session_validator = create_session_validator()
+# Held by the one worker that runs the sweeper when there are several
+maintenance_leader = LeaderLock(_MAINTENANCE_LOCK_FILE_PATH)
+sessions_sweeper_task = None
+sessions_sweeper_stats = {
+    'sweeps': 0,
+    'evicted_total': 0,
+    'last_evicted': 0,
+    'last_duration_seconds': 0.0,
+}
+
+def register_session_metrics():
+    """Expose the session cache, sweeper and revocation list stats on /metrics."""
+    cache_stats = session_validation_cache.stats
+    metrics_registry.callback('session_cache_size', 'Entries in the session validation cache.',
+                              lambda: cache_stats()['size'])
+    metrics_registry.callback('session_cache_hits_total', 'Session validation cache hits.',
+                              lambda: cache_stats()['hits'], kind='counter')
+    metrics_registry.callback('session_cache_misses_total', 'Session validation cache misses.',
+                              lambda: cache_stats()['misses'], kind='counter')
+    metrics_registry.callback('session_cache_evictions_total', 'Session validation cache evictions.',
+                              lambda: cache_stats()['evictions'], kind='counter')
+    metrics_registry.callback('sessions_sweeps_total', 'Expired sessions sweeps run.',
+                              lambda: sessions_sweeper_stats['sweeps'], kind='counter')
+    metrics_registry.callback('sessions_swept_total', 'Expired sessions evicted by the sweeper.',
+                              lambda: sessions_sweeper_stats['evicted_total'], kind='counter')
+    metrics_registry.callback('maintenance_leader', 'Whether this worker runs the expired sessions sweeper.',
+                              lambda: int(maintenance_leader.is_leader))
+    metrics_registry.callback('sessions_last_sweep_duration_seconds', 'Duration of the last expired sessions sweep.',
+                              lambda: sessions_sweeper_stats['last_duration_seconds'])
+    metrics_registry.callback('rate_limit_rejected_total', 'Requests rejected by a rate limit.',
+                              lambda: {(limit,): count for limit, count in rate_limiter.stats()['rejected'].items()},
+                              kind='counter', label_names=('limit',))
+    metrics_registry.callback('revoked_session_tokens', 'Revoked signed session tokens known to this worker.',
+                              lambda: len(token_revocation_list))
+
+if _METRICS_ENABLED:
+    register_session_metrics()
+
 async def startup_event_handler():
+    global sessions_sweeper_task
     logger.info("Running the startup event handler")
-    logger.info("Initializing session json file")
-    await init_sessions_json_file()
-    logger.info("session json file initialized successfully")
+    logger.info("Opening %s session backend", session_backend.name)
+    await session_backend.open()
+    logger.info("session backend opened successfully")
+    logger.info("Opening %s user store with %s password hashing workers", user_store.name, password_hasher.workers)
+    password_hasher.open()
+    await user_store.open()
+    await seed_default_admin_user()
+    if _RESOURCES_FILE_PATH and not resources_loaded:
+        await asyncio.to_thread(load_resources)
+    logger.info("Starting expired sessions sweeper with interval: %s seconds", _SESSIONS_SWEEP_INTERVAL_SECONDS)
+    sessions_sweeper_task = asyncio.create_task(sessions_sweeper_loop())
     logger.info("startup event handler completed successfully")
 
-
-async def init_sessions_json_file():
+async def shutdown_event_handler():
+    logger.info("Running the shutdown event handler")
+    if sessions_sweeper_task is not None:
+        logger.info("Stopping expired sessions sweeper")
+        sessions_sweeper_task.cancel()
+        try:
+            await sessions_sweeper_task
+        except asyncio.CancelledError:
+            pass
+    maintenance_leader.release()
+    logger.info("Closing %s session backend", session_backend.name)
+    await session_backend.close()
+    logger.info("Closing %s user store", user_store.name)
+    await user_store.close()
+    password_hasher.close()
+    logger.info("shutdown event handler completed successfully")
+
+async def initialize_shared_state():
+    """Create or migrate the session and user stores and seed the default admin, then close them.
+
+    serve.py runs this once before forking workers, so workers starting
+    together never race on a schema migration or on seeding the admin. Their
+    own startup then finds everything in place. The json session backend has
+    nothing to set up and belongs to its single worker, so it is left alone.
+    """
+    if session_backend.name != 'json':
+        logger.info("Initializing %s session backend", session_backend.name)
+        await session_backend.open()
+        await session_backend.close()
+    logger.info("Initializing %s user store", user_store.name)
+    password_hasher.open()
     try:
-        if not os.path.exists(_SESSIONS_JSON_FILE_PATH):
-            logger.info("sessions json file does not exist. Attempting to create file ...")
-            await write_sessions_to_file(content={})
-        else:
-            logger.info("sessions json file already exists. Skipping creation ...")
+        await user_store.open()
+        try:
+            await seed_default_admin_user()
+        finally:
+            await user_store.close()
+    finally:
+        password_hasher.close()
+
+async def seed_default_admin_user():
+    """Create the default admin user when the user store has no users yet."""
+    if await user_store.count() > 0:
+        return
+    logger.warning("User store is empty. Creating default user: %s, change its password before going to production", _DEFAULT_ADMIN_USERNAME)
+    password_hash = await password_hasher.hash(_DEFAULT_ADMIN_PASSWORD)
+    await user_store.put_user(_DEFAULT_ADMIN_USERNAME, {'password_hash': password_hash, 'is_admin': True})
+
+async def get_user_by_username(username: str) -> Optional[dict]:
+    try:
+        return await user_store.get_user(username)
     except Exception as e:
-        logger.error(f"Error occured while initializing sessions json file. Error:{e}")
+        logger.error("Error occured while getting user by username. Error:%s", e)
         raise
 
-async def read_sessions_from_file():
-    try:
-        logger.debug("Reading sessions from file")
-        async with AIOFile(_SESSIONS_JSON_FILE_PATH, 'r') as afp:
-            content = await afp.read()
-            return json.loads(content) if content else {}
-    except Exception as e:
-        logger.error(f"Error occured while reading session file. Error:{e}")
-        raise 
+async def verify_user_password(username: str, user: dict, password: str) -> bool:
+    """Check a password off the event loop and upgrade hashes made with older scrypt parameters."""
+    password_hash = user.get('password_hash')
+    if password_hash is None:
+        logger.warning("Could not find password_hash field in user record. Possibly the user record in db is corrupted.")
+        return False
+    with span('password_verify'):
+        verified = await password_hasher.verify(username, password, password_hash)
+    if not verified:
+        return False
+    if password_hasher.needs_rehash(password_hash):
+        logger.info("Upgrading password hash of user with username: %s to the current parameters", username)
+        try:
+            await user_store.put_user(username, {**user, 'password_hash': await password_hasher.hash(password)})
+        except Exception as e:
+            logger.error("Error occured while upgrading password hash. Error:%s", e)
+    return True
 
-async def write_sessions_to_file(content: dict):
-    try:
-        logger.debug("Writing sessions to file")
-        async with AIOFile(_SESSIONS_JSON_FILE_PATH, 'w+') as afp:
-            await afp.write(json.dumps(content, indent=4))
-    except Exception as e:
-        logger.error(f"Error occured while writing session file. Error:{e}")
-        raise 
+async def sweep_expired_sessions() -> int:
+    """Evict all expired sessions from the session backend in one pass."""
+    start = time.perf_counter()
+    evicted = await session_backend.evict_expired(now=time.time() - _SESSION_CLOCK_SKEW_TOLERANCE_SECONDS)
+    duration = time.perf_counter() - start
+    sessions_sweeper_stats['sweeps'] += 1
+    sessions_sweeper_stats['evicted_total'] += evicted
+    sessions_sweeper_stats['last_evicted'] = evicted
+    sessions_sweeper_stats['last_duration_seconds'] = duration
+    logger.info("Expired sessions sweep evicted %s sessions in %.2f ms", evicted, duration * 1000)
+    return evicted
+
+def prune_process_state():
+    """Drop expired entries from the state every worker keeps for itself."""
+    if session_validation_cache.enabled:
+        logger.info("Session validation cache stats: %s", session_validation_cache.stats())
+    pruned = token_revocation_list.prune()
+    if pruned:
+        logger.info("Pruned %s expired entries from the token revocation list", pruned)
+
+async def sessions_sweeper_loop():
+    """Periodically evict expired sessions that no client came back for.
+
+    With several workers only the maintenance leader sweeps the shared
+    session store. If it exits, another worker takes over at its next
+    interval. Every worker prunes its own in-process state.
+    """
+    while True:
+        await asyncio.sleep(_SESSIONS_SWEEP_INTERVAL_SECONDS)
+        try:
+            prune_process_state()
+            if maintenance_leader.try_acquire():
+                await sweep_expired_sessions()
+        except Exception as e:
+            logger.error("Error occured while sweeping expired sessions. Error:%s", e)
 
 async def create_session(session_id: str, data: dict):
     try:
-        sessions = await read_sessions_from_file()
-        sessions[session_id] = data
-        await write_sessions_to_file(sessions)
+        async with session_locks.for_key(session_id):
+            await session_backend.put(session_id, data)
     except Exception as e:
-        logger.error(f"Error occured while creating session. Error:{e}")
+        logger.error("Error occured while creating session. Error:%s", e)
         raise
 
 async def get_session_by_session_id(session_id: str):
     try:
-        sessions = await read_sessions_from_file()
-        if session_id in sessions:
-            return sessions[session_id]
-        else:
-            return None
+        return await session_backend.get(session_id)
     except Exception as e:
-        logger.error(f"Error occured while getting session by session_id. Error:{e}")
+        logger.error("Error occured while getting session by session_id. Error:%s", e)
         raise
 
 async def delete_session_by_session_id(session_id: str):
     try:
-        sessions = await read_sessions_from_file()
-        sessions.pop(session_id, None)
-        await write_sessions_to_file(sessions)
+        async with session_locks.for_key(session_id):
+            session_validation_cache.invalidate(session_id)
+            await session_backend.delete(session_id)
     except Exception as e:
-        logger.error(f"Error occured while deleting session by session_id. Error:{e}")
+        logger.error("Error occured while deleting session by session_id. Error:%s", e)
         raise
 
-def is_session_valid(session_expires_at):
-    logger.debug(f"Checking session validity. Expires at: {session_expires_at}, Current time: {time.monotonic()}")
-    if time.monotonic() >= session_expires_at:
-        return False
-    return True
+async def evict_sessions_over_limit(username: str):
+    """Make room for one more session of username by deleting its least recently used sessions.
+
+    Sessions are ranked by expires_at, which sliding expiration keeps moving
+    with activity. Only the user's own sessions are read, through the
+    backend's username index.
+    """
+    if _MAX_SESSIONS_PER_USER <= 0:
+        return
+    try:
+        session_ids = await session_backend.get_user_session_ids(username)
+    except Exception as e:
+        logger.error("Error occured while getting sessions of user. Error:%s", e)
+        raise
+    excess = len(session_ids) - _MAX_SESSIONS_PER_USER + 1
+    if excess <= 0:
+        return
+    sessions = await asyncio.gather(*[get_session_by_session_id(session_id=session_id) for session_id in session_ids])
+    # Sessions gone meanwhile sort first; deleting them again is harmless
+    ranked = sorted(zip(session_ids, sessions),
+                    key=lambda item: (item[1] or {}).get('expires_at') or 0)
+    logger.info("User with username: %s is at the limit of %s sessions. Evicting %s least recently used sessions",
+                username, _MAX_SESSIONS_PER_USER, excess)
+    await asyncio.gather(*[delete_session_by_session_id(session_id=session_id) for session_id, _ in ranked[:excess]])
+
+async def create_user_session(username: str, session_id: str, data: dict):
+    """Evict the user's sessions over the limit and create the new one, as one step per user in this worker.
+
+    Without the lock, concurrent logins of one user could all count the same
+    sessions before any of them created its own, and go over the limit.
+    """
+    async with user_session_locks.for_key(username):
+        await evict_sessions_over_limit(username=username)
+        await create_session(session_id=session_id, data=data)
+
+async def revoke_previous_session(session_id: str):
+    """Invalidate the session a browser held before logging in again."""
+    if is_signed_session_mode():
+        claims = await verify_signed_session_token(session_id)
+        if claims is not None:
+            await revoke_signed_session_token(claims['jti'], claims['exp'])
+        return
+    await delete_session_by_session_id(session_id=session_id)
+
+async def rotate_session(session_id: str, session: dict, response: Response):
+    """Move a session to a new session id and CSRF token, keeping its user and expiry.
+
+    The new record is written before the old one is deleted, so the user is
+    never without a valid session.
+    """
+    new_session_id = get_uuid()
+    new_csrf_token = get_uuid()
+    await create_session(session_id=new_session_id, data={**session, 'csrfToken': new_csrf_token})
+    await delete_session_by_session_id(session_id=session_id)
+    set_session_cookie(response, new_session_id)
+    logger.info("Rotated session_id:%s to session_id:%s for user with username: %s",
+                session_id, new_session_id, session.get('username'))
+    return api_response(RotateSessionResponseSchema, response,
+                        message=f"Rotated session for user: {session.get('username')}",
+                        sessionId=new_session_id,
+                        csrfToken=new_csrf_token)
+
+def get_client_ip(request: Request) -> Optional[str]:
+    """The client IP as seen by the outermost of the trusted proxies in front of the app.
+
+    Every proxy appends the address it received the request from to
+    X-Forwarded-For, so only the last _RATE_LIMIT_TRUSTED_PROXY_COUNT entries
+    were written by our proxies; anything left of them comes from the client
+    and could be forged to dodge a per-IP limit.
+    """
+    if _RATE_LIMIT_TRUST_FORWARDED_FOR:
+        forwarded_for = [entry.strip() for header in request.headers.getlist('X-Forwarded-For')
+                         for entry in header.split(',')]
+        if len(forwarded_for) >= _RATE_LIMIT_TRUSTED_PROXY_COUNT > 0:
+            return forwarded_for[-_RATE_LIMIT_TRUSTED_PROXY_COUNT]
+    return request.client.host if request.client is not None else None
+
+async def enforce_rate_limit(route: str, request: Request, username: Optional[str] = None):
+    """Reject the request with 429 when the client IP or username is over the route's limit."""
+    if not rate_limiter.has_limits(route):
+        return
+    client_ip = get_client_ip(request)
+    retry_after = await rate_limiter.check(route, ip=client_ip, username=username)
+    if retry_after > 0:
+        logger.warning("Rate limit exceeded on %s for client: %s username: %s", route, client_ip, username)
+        raise HTTPException(status_code=status.HTTP_429_TOO_MANY_REQUESTS,
+                            detail="Too many requests",
+                            headers={'Retry-After': str(math.ceil(retry_after))})
+
+def get_session_expires_in(expires_at: float) -> float:
+    """Seconds left before a session expires, as reported to clients (never negative)."""
+    return max(0.0, round(seconds_until(expires_at), 3))
 
 def get_session_expiration_timestamp(duration_seconds: int) -> float:
-    """Get the expiration timestamp for a session given a duration in seconds."""
-    logger.debug(f"Calculating session expiration timestamp with duration: {duration_seconds} seconds.")
-    return time.monotonic() + duration_seconds
+    """Get the epoch expiration timestamp for a session given a duration in seconds."""
+    logger.debug("Calculating session expiration timestamp with duration: %s seconds.", duration_seconds)
+    return time.time() + duration_seconds
+
+def set_session_cookie(response: Response, session_id: str):
+    response.set_cookie("session_id", session_id, max_age=_SESSION_DURATION_SECONDS, httponly=True, samesite='lax')
+
+async def refresh_session_expiry(session_id: str, session_expires_at: float, response: Response) -> float:
+    """Slide the session expiry forward on activity when sliding expiration is enabled. Returns the session's expiry.
+
+    Refreshes are coalesced: the store is only written once the session was last
+    refreshed more than SESSION_REFRESH_INTERVAL_SECONDS ago, so a busy session
+    costs one write per interval rather than one per request.
+    """
+    if not _SESSION_SLIDING_EXPIRATION:
+        return session_expires_at
+    now = time.time()
+    if session_expires_at - now > _SESSION_DURATION_SECONDS - _SESSION_REFRESH_INTERVAL_SECONDS:
+        return session_expires_at
+    logger.debug("Refreshing expiry of session_id:%s", session_id)
+    async with session_locks.for_key(session_id):
+        session_validation_cache.invalidate(session_id)
+        await session_backend.expire(session_id, now + _SESSION_DURATION_SECONDS)
+    set_session_cookie(response, session_id)
+    return now + _SESSION_DURATION_SECONDS
+
+def is_signed_session_mode() -> bool:
+    return _SESSION_MODE == 'signed'
+
+async def revoke_signed_session_token(token_id: str, expires_at: float):
+    """Revoke a signed token for every worker sharing the session backend."""
+    try:
+        session_validation_cache.invalidate(token_id)
+        await token_revocation_list.revoke(token_id, expires_at)
+    except Exception as e:
+        logger.error("Error occured while revoking signed session token. Error:%s", e)
+        raise
+
+async def verify_signed_session_token(session_token: str) -> Optional[dict]:
+    """Return the claims of a signed session token that is not revoked, else None.
+
+    Expiry is left to the caller, as with server-side session records.
+    """
+    claims = session_token_signer.verify(session_token)
+    if claims is None:
+        logger.warning("Signed session token verification failed. Possibly some attacker has sent a forged session_id cookie")
+        return None
+    if await token_revocation_list.is_revoked(claims['jti'], claims['exp']):
+        logger.warning("Signed session token %s has been revoked", claims['jti'])
+        return None
+    return claims
+
+def refresh_signed_session_token(claims: dict, response: Response) -> float:
+    """Re-issue a signed token with a later expiry when sliding expiration is enabled. Returns the token's expiry.
+
+    The token is re-signed with the key it was signed with, not the active
+    one, so its CSRF token stays the same across a key rotation.
+    """
+    if not _SESSION_SLIDING_EXPIRATION:
+        return claims['exp']
+    now = time.time()
+    if claims['exp'] - now > _SESSION_DURATION_SECONDS - _SESSION_REFRESH_INTERVAL_SECONDS:
+        return claims['exp']
+    issued = session_token_signer.issue(claims['sub'], now + _SESSION_DURATION_SECONDS, token_id=claims['jti'],
+                                        key_id=claims['kid'])
+    set_session_cookie(response, issued['token'])
+    return now + _SESSION_DURATION_SECONDS
+
+async def refresh_validated_session(result: SessionValidationResult, response: Response):
+    """Slide a valid session's expiry if due, and update result.expires_at to match."""
+    if result.claims is not None:
+        result.expires_at = refresh_signed_session_token(result.claims, response)
+    else:
+        result.expires_at = await refresh_session_expiry(result.session_id, result.expires_at, response)
+
+async def revoke_validated_session(result: SessionValidationResult):
+    """Revoke a validated session, deleting its record or revoking its signed token."""
+    if result.claims is not None:
+        logger.info("Revoking signed session token %s", result.session_id)
+        await revoke_signed_session_token(result.session_id, result.expires_at)
+        return
+    await delete_session_by_session_id(session_id=result.session_id)
+
+def prebuilt_http_errors(errors: Dict[str, tuple]) -> Dict[str, PreEncodedHTTPError]:
+    """Build the error of every validation failure once, keyed by status.
+
+    Only the status, detail and json body are shared; reject_invalid_session
+    raises a new exception from them on every request. The body is reused
+    in fast mode.
+    """
+    return {result_status: PreEncodedHTTPError(status_code=status_code, detail=detail)
+            for result_status, (status_code, detail) in errors.items()}
+
+_LOGIN_STATUS_ERRORS = prebuilt_http_errors({
+    session_validation.NO_COOKIE: (status.HTTP_400_BAD_REQUEST, "No session_id cookie found"),
+    session_validation.INVALID: (status.HTTP_401_UNAUTHORIZED, "Invalid session_id cookie sent"),
+    session_validation.CORRUPTED: (status.HTTP_500_INTERNAL_SERVER_ERROR, "Corrupted session record found in db"),
+})
+_PROTECTED_API_ERRORS = prebuilt_http_errors({
+    session_validation.NO_COOKIE: (status.HTTP_401_UNAUTHORIZED, "No session_id cookie found in request"),
+    session_validation.INVALID: (status.HTTP_401_UNAUTHORIZED, "Invalid session_id cookie"),
+    session_validation.NO_CSRF_TOKEN: (status.HTTP_401_UNAUTHORIZED, "No csrf token header found in request"),
+    session_validation.CORRUPTED: (status.HTTP_500_INTERNAL_SERVER_ERROR, "Corrupted session record found in db"),
+    session_validation.CSRF_MISMATCH: (status.HTTP_401_UNAUTHORIZED, "csrf token validation failed"),
+    session_validation.EXPIRED: (status.HTTP_401_UNAUTHORIZED, "Session expired"),
+})
+
+async def reject_invalid_session(result: SessionValidationResult, errors: Dict[str, PreEncodedHTTPError]):
+    """Log a failed validation, clean up a corrupted record and raise the prebuilt error for it."""
+    if result.status == session_validation.CORRUPTED:
+        logger.warning("Found a corrupted session record in db for session_id:%s. Deleting it", result.session_id)
+        await delete_session_by_session_id(session_id=result.session_id)
+    elif result.status in (session_validation.NO_CSRF_TOKEN, session_validation.CSRF_MISMATCH):
+        logger.error("csrf token validation failed with %s for session_id:%s. Possibly some attacker performing cross site request",
+                     result.status, result.session_id)
+    else:
+        logger.warning("Session validation failed with %s for session_id:%s", result.status, result.session_id)
+    raise errors[result.status].exception()
 
 login_api_router = APIRouter()
 
 @login_api_router.post("/api/v1/login")
 async def login(input: LoginRequestSchema, request: Request, response: Response):
-    logger.info(f"Recevied a login request for username: {input.username}")
+    logger.info("Recevied a login request for username: %s", input.username)
+    await enforce_rate_limit('login', request, username=input.username)
     
-    session_id = request.cookies.get('session_id')
-    if session_id:
-        logger.info(f"Found a session_id:{session_id} in cookie")
-        existing_session = await get_session_by_session_id(session_id=session_id)
-        if existing_session is not None:
-            session_expires_at = existing_session.get('expires_at')
-            csrf_token = existing_session.get('csrfToken')
-            if session_expires_at is None:
-                logger.warning(f"Could not find expires_at field in session record. Possibly the session record in db is corrupted.")
-                logger.warning(f"Deleting the corrupted session record in db")
-                await delete_session_by_session_id(session_id=session_id)
-            elif csrf_token is None:
-                logger.warning(f"Could not find csrf_token field in session record in db. Possibly the session record in db is corrupted.")
-                logger.warning(f"Deleting the corrupted session record in db")
-                await delete_session_by_session_id(session_id=session_id)
-            else:
-                logger.info(f"Found a valid session record in db for session_id:{session_id}")
-                logger.info("Checking if session is still valid or not")
-                if is_session_valid(session_expires_at=session_expires_at):
-                    logger.info("Session is valid. Skipping login")
-                    return LoginResponseSchema(message=f"There is already an active session for user: {input.username}. Skipping login",
-                                               sessionId=session_id,
-                                               csrfToken=csrf_token)
-                else:
-                    logger.info("Session is expired.")
-                    logger.info("Deleting the expired session record in db")
-                    await delete_session_by_session_id(session_id=session_id)
+    logger.info("Checking if user with username:%s is existing in internal db", input.username)
+    user = await get_user_by_username(username=input.username)
+    if user is not None:
+        logger.info("User with username: %s found", input.username)
+        logger.info("Validating password for user with username: %s", input.username)
+        if await verify_user_password(input.username, user, input.password):
+            logger.info("Password validation successful for user with username: %s", input.username)
         else:
-            logger.warning(f"Could not find a session record in db for session_id:{session_id}. Possibly cookie deletion in client's browser failed or else some attacker has sent invalid session_id in cookie")
-
-    logger.info(f"Checking if user with username:{input.username} is existing in internal db")
-    if input.username == _DEFAULT_ADMIN_USERNAME:
-        logger.info(f"User with username: {input.username} found")
-        logger.info(f"Validating password for user with username: {input.username}")
-        if input.password == _DEFAULT_ADMIN_PASSWORD:
-            logger.info(f"Password validation successful for user with username: {input.username}")
-        else:
-            logger.info(f"Password validation failed for user with username: {input.username}")
+            logger.info("Password validation failed for user with username: %s", input.username)
             raise HTTPException(status_code=status.HTTP_401_UNAUTHORIZED, 
                                 detail=f"Password validation failed for user with username: {input.username}")
     else:
-        logger.info(f"User with username:{input.username} not found")
+        logger.info("User with username:%s not found", input.username)
         raise HTTPException(status_code=status.HTTP_401_UNAUTHORIZED,
                             detail=f"User with username:{input.username} not found")
     
-    logger.info(f"Creating session record for user with username: {input.username} in db")
+    # A successful login always starts a new session, so a session id planted
+    # in the browser before authentication (session fixation) is never promoted
+    previous_session_id = request.cookies.get('session_id')
+    if previous_session_id:
+        logger.info("Found a session_id:%s in cookie. Rotating it out on re-authentication", previous_session_id)
+        await revoke_previous_session(previous_session_id)
+
+    if is_signed_session_mode():
+        logger.info("Issuing signed session token for user with username: %s", input.username)
+        issued = session_token_signer.issue(input.username, get_session_expiration_timestamp(duration_seconds=_SESSION_DURATION_SECONDS))
+        set_session_cookie(response, issued['token'])
+        return api_response(LoginResponseSchema, response,
+                            message=f"Logged in user: {input.username} successfully",
+                            sessionId=issued['token_id'],
+                            csrfToken=issued['csrf_token'],
+                            expiresIn=float(_SESSION_DURATION_SECONDS))
+
+    logger.info("Creating session record for user with username: %s in db", input.username)
     session_id = get_uuid()
     csrf_token = get_uuid()
-    session_expiration_timestamp = get_session_expiration_timestamp(duration_seconds=60)
+    session_expiration_timestamp = get_session_expiration_timestamp(duration_seconds=_SESSION_DURATION_SECONDS)
     session_record = {
         'username': input.username,
         'csrfToken': csrf_token,
         'expires_at': session_expiration_timestamp
     }
-    await create_session(session_id=session_id, data=session_record)
-    logger.info(f"Session record with session_id: {session_id} created successfully for user with username: {input.username}")
+    await create_user_session(username=input.username, session_id=session_id, data=session_record)
+    logger.info("Session record with session_id: %s created successfully for user with username: %s", session_id, input.username)
     
-    logger.info(f"Setting session_id cookie in response")
-    response.set_cookie("session_id", session_id, max_age=60, httponly=True, samesite='lax')
-    logger.info(f"Successfully set the session_id={session_id} cookie in response with params: max_age=60, httponly=true, samesite=lax")
+    logger.info("Setting session_id cookie in response")
+    set_session_cookie(response, session_id)
+    logger.info("Successfully set the session_id=%s cookie in response with params: max_age=%s, httponly=true, samesite=lax", session_id, _SESSION_DURATION_SECONDS)
 
-    return LoginResponseSchema(message=f"Logged in user: {input.username} successfully",
-                               sessionId=session_id,
-                               csrfToken=csrf_token)
+    return api_response(LoginResponseSchema, response,
+                        message=f"Logged in user: {input.username} successfully",
+                        sessionId=session_id,
+                        csrfToken=csrf_token,
+                        expiresIn=float(_SESSION_DURATION_SECONDS))
 
 
 @login_api_router.get("/api/v1/login/status")
-async def login_status(request: Request):
+async def login_status(request: Request, response: Response):
     logger.info("Received a login status request")
-
-    session_id = request.cookies.get('session_id')
-    if session_id is None:
-        logger.warning("No session_id cookie found")
-        raise HTTPException(status_code=status.HTTP_400_BAD_REQUEST, 
-                            detail="No session_id cookie found")
-    else:
-        logger.info(f"Found a session_id:{session_id} in cookie")
-        existing_session = await get_session_by_session_id(session_id=session_id)
-        if existing_session is None:
-            logger.warning("Could not find a record for session_id in db. Possibly cookie deletion in client's browser failed or else some attacker has sent invalid session_id in cookie")
-            raise HTTPException(status_code=status.HTTP_401_UNAUTHORIZED,
-                                detail="Invalid session_id cookie sent")
-        else:
-            session_expires_at = existing_session.get('expires_at')
-            username = existing_session.get('username')
-            csrf_token = existing_session.get('csrfToken')
-            if session_expires_at is None:
-                logger.warning(f"Could not find expires_at field in session record. Possibly the session record in db is corrupted.")
-                logger.warning(f"Deleting the corrupted session record in db")
-                await delete_session_by_session_id(session_id=session_id)
-            elif csrf_token is None:
-                logger.warning(f"Could not find csrf_token field in session record in db. Possibly the session record in db is corrupted.")
-                logger.warning(f"Deleting the corrupted session record in db")
-                await delete_session_by_session_id(session_id=session_id)
-            elif username is None:
-                logger.warning(f"Could not find username field in session record. Possibly the session record in db is corrupted.")
-                logger.warning(f"Deleting the corrupted session record in db")
-                await delete_session_by_session_id(session_id=session_id)
-                raise HTTPException(status_code=status.HTTP_500_INTERNAL_SERVER_ERROR,
-                                    detail="Corrupted session record found in db")
-            else:
-                logger.info(f"Found a valid session record in db for session_id:{session_id}")
-                logger.info("Checking if session is still valid or not")
-                if is_session_valid(session_expires_at=session_expires_at):
-                    logger.info("Session is valid.")
-                    return LoginStatusResponseSchema(isLoggedIn=True, sessionId=session_id, csrfToken=csrf_token)
-                else:
-                    logger.info("Session is expired.")
-                    logger.info("Deleting the expired session record in db")
-                    await delete_session_by_session_id(session_id=session_id)
-                    return LoginStatusResponseSchema(isLoggedIn=False, sessionId=None, csrfToken=None)
+    await enforce_rate_limit('login_status', request)
+
+    result = await session_validator.validate(request.cookies.get('session_id'))
+    if result.valid:
+        logger.info("Session is valid.")
+        await refresh_validated_session(result, response)
+        return api_response(LoginStatusResponseSchema, response,
+                            isLoggedIn=True, sessionId=result.session_id, csrfToken=result.csrf_token,
+                            expiresIn=get_session_expires_in(result.expires_at))
+    if result.status == session_validation.EXPIRED:
+        # Left for the sweeper, so this answer costs a single store lookup
+        logger.info("Session is expired.")
+        return static_api_response(LoginStatusResponseSchema, response, _LOGGED_OUT_STATUS)
+    await reject_invalid_session(result, _LOGIN_STATUS_ERRORS)
 
 @login_api_router.get("/api/v1/logout")
 async def logout(request: Request, response: Response):
     logger.info("Received a logout request")
-
-    session_id = request.cookies.get('session_id')
-    if session_id is None:
-        logger.warning("No session_id cookie found")
-        raise HTTPException(status_code=status.HTTP_400_BAD_REQUEST, 
-                            detail="No session_id cookie found")
-    else:
-        logger.info(f"Found a session_id:{session_id} in cookie")
-        existing_session = await get_session_by_session_id(session_id=session_id)
-        if existing_session is None:
-            logger.warning("Could not find a record for session_id in db. Possibly cookie deletion in client's browser failed or else some attacker has sent invalid session_id in cookie")
-            raise HTTPException(status_code=status.HTTP_401_UNAUTHORIZED,
-                                detail="Invalid session_id cookie sent")
-        else:
-            session_expires_at = existing_session.get('expires_at')
-            username = existing_session.get('username')
-            if session_expires_at is None:
-                logger.warning(f"Could not find expires_at field in session record. Possibly the session record in db is corrupted.")
-                logger.warning(f"Deleting the corrupted session record in db")
-                await delete_session_by_session_id(session_id=session_id)
-                raise HTTPException(status_code=status.HTTP_500_INTERNAL_SERVER_ERROR,
-                                    detail="Corrupted session record found in db")
-            elif username is None:
-                logger.warning(f"Could not find username field in session record. Possibly the session record in db is corrupted.")
-                logger.warning(f"Deleting the corrupted session record in db")
-                await delete_session_by_session_id(session_id=session_id)
-                raise HTTPException(status_code=status.HTTP_500_INTERNAL_SERVER_ERROR,
-                                    detail="Corrupted session record found in db")
-            else:
-                logger.info(f"Found a valid session record in db for session_id:{session_id}")
-                logger.info("Checking if session is still valid or not")
-                if is_session_valid(session_expires_at=session_expires_at):
-                    logger.info("Session is valid.")
-                    logger.info("Deleting the session record in db")
-                    await delete_session_by_session_id(session_id=session_id)
-                    logger.info(f"Deleting session_id cookie in response")
-                    response.delete_cookie('session_id')
-                    logger.info(f"Successfully deleted session_id:{session_id} cookie in response")
-                    return LogoutResponseSchema(message=f"Logged out session_id:{session_id} for user: {username} successfully")
-                else:
-                    logger.info("Session is expired.")
-                    logger.info("Deleting the expired session record in db")
-                    await delete_session_by_session_id(session_id=session_id)
-                    logger.info(f"Deleting session_id cookie in response")
-                    response.delete_cookie('session_id')
-                    logger.info(f"Successfully deleted session_id:{session_id} cookie in response")
-                    return LogoutResponseSchema(message=f"session_id:{session_id} for user: {username} is already expired")
-
-async def validate_protected_api_request(request: Request):
+    await enforce_rate_limit('logout', request)
+
+    result = await session_validator.validate(request.cookies.get('session_id'))
+    if result.status not in (session_validation.VALID, session_validation.EXPIRED):
+        await reject_invalid_session(result, _LOGIN_STATUS_ERRORS)
+    logger.info("Deleting the session record of session_id:%s", result.session_id)
+    await revoke_validated_session(result)
+    response.delete_cookie('session_id')
+    logger.info("Successfully deleted session_id:%s cookie in response", result.session_id)
+    if result.valid:
+        return api_response(LogoutResponseSchema, response,
+                            message=f"Logged out session_id:{result.session_id} for user: {result.username} successfully")
+    return api_response(LogoutResponseSchema, response,
+                        message=f"session_id:{result.session_id} for user: {result.username} is already expired")
+
+@timed('validate_protected_api_request')
+async def validate_protected_api_request(request: Request, response: Response):
     logger.info("Validating protected api request")
-    session_id = request.cookies.get('session_id')
-    if session_id is None:
-        logger.error("No session_id cookie found in request")
-        raise HTTPException(status_code=status.HTTP_401_UNAUTHORIZED,
-                            detail="No session_id cookie found in request")
-    else:
-        logger.info(f"Found session_id={session_id} cookie in request")
-        existing_session = await get_session_by_session_id(session_id=session_id)
-        if existing_session is None:
-            logger.warning(f"Could not find a session record in db for session_id={session_id}. Possibly cookie deletion in client's browser failed or else some attacker has sent invalid session_id in cookie")
-            raise HTTPException(status_code=status.HTTP_401_UNAUTHORIZED,
-                                detail="Invalid session_id cookie")
-        else:
-            logger.info(f"Found a session record in db for session_id={session_id}")
-            csrf_token_header = request.headers.get('X-CSRF-TOKEN')
-            if csrf_token_header is None:
-                logger.error("No csrf token header found in request. Possibly some attacker performing cross site request")
-                raise HTTPException(status_code=status.HTTP_401_UNAUTHORIZED,
-                                    detail="No csrf token header found in request")
-            else:
-                session_expires_at = existing_session.get('expires_at')
-                username = existing_session.get('username')
-                csrf_token = existing_session.get('csrfToken')
-                if session_expires_at is None:
-                    logger.warning(f"Could not find expires_at field in session record. Possibly the session record in db is corrupted.")
-                    logger.warning(f"Deleting the corrupted session record in db")
-                    await delete_session_by_session_id(session_id=session_id)
-                    raise HTTPException(status_code=status.HTTP_500_INTERNAL_SERVER_ERROR,
-                                        detail="Corrupted session record found in db")
-                elif csrf_token is None:
-                    logger.warning(f"Could not find csrf_token field in session record in db. Possibly the session record in db is corrupted.")
-                    logger.warning(f"Deleting the corrupted session record in db")
-                    await delete_session_by_session_id(session_id=session_id)
-                    raise HTTPException(status_code=status.HTTP_500_INTERNAL_SERVER_ERROR,
-                                        detail="Corrupted session record found in db")
-                elif username is None:
-                    logger.warning(f"Could not find username field in session record. Possibly the session record in db is corrupted.")
-                    logger.warning(f"Deleting the corrupted session record in db")
-                    await delete_session_by_session_id(session_id=session_id)
-                    raise HTTPException(status_code=status.HTTP_500_INTERNAL_SERVER_ERROR,
-                                        detail="Corrupted session record found in db")
-                elif csrf_token != csrf_token_header:
-                    logger.error(f"csrf token validation failed. Possibly some attacker performing cross site request with invalid csrf token")
-                    raise HTTPException(status_code=status.HTTP_401_UNAUTHORIZED,
-                                        detail="csrf token validation failed")
-                else:
-                    logger.info("csrf token validation successfull")
-                    logger.info(f"Found a valid session record in db for session_id:{session_id}")
-                    logger.info("Checking if session is still valid or not")
-                    if is_session_valid(session_expires_at=session_expires_at):
-                        logger.info("Session is valid.")
-                        return
-                    else:
-                        logger.info("Session is expired.")
-                        logger.info("Deleting the expired session record in db")
-                        await delete_session_by_session_id(session_id=session_id)
-                        raise HTTPException(status_code=status.HTTP_401_UNAUTHORIZED,
-                                            detail=f"session expired for session_id={session_id}")
+    await enforce_rate_limit('protected', request)
+    result = await session_validator.validate(request.cookies.get('session_id'), request.headers.get('X-CSRF-TOKEN'),
+                                              check_csrf=True, use_cache=True)
+    if not result.valid:
+        await reject_invalid_session(result, _PROTECTED_API_ERRORS)
+    await refresh_validated_session(result, response)
+    request.state.session_validation = result
 
 protected_api_router = APIRouter()
 
+def wants_ndjson(request: Request, response_format: Optional[str]) -> bool:
+    if response_format is not None:
+        if response_format not in ('json', 'ndjson'):
+            raise HTTPException(status_code=status.HTTP_400_BAD_REQUEST,
+                                detail=f"Invalid format: {response_format}. Expected 'json' or 'ndjson'")
+        return response_format == 'ndjson'
+    return 'application/x-ndjson' in request.headers.get('accept', '')
+
+def select_resources_page(catalog: ResourceCatalog, cursor: Optional[str], limit: int, prefix: Optional[str],
+                          has: List[str], where_filters: list, include_total: bool):
+    """The positions and next cursor of one page of catalog, and the total if asked for. Blocking, run it in a thread."""
+    positions, next_cursor = catalog.select(cursor=cursor, limit=limit, prefix=prefix, has=has, where=where_filters)
+    total = catalog.count(prefix=prefix, has=has, where=where_filters) if include_total else None
+    return positions, next_cursor, total
+
 @protected_api_router.get('/api/v1/protected/resources')
-async def get_all_resources(request: Request):
-    resources = [{'name': 'resource1', 'properties': {'k1': 'v1', 'k2': 'v2'}},
-                 {'name': 'resource2', 'properties': {'k1': 1, 'k2': 2}},]
-    return GetAllResourcesResponseSchema(
-        items=[GetResourceResponseSchema(name=resource['name'], 
-                                         properties=resource['properties']) for resource in resources], 
-        total=len(resources))
+async def get_all_resources(request: Request,
+                            cursor: Optional[str] = None,
+                            limit: int = Query(100, ge=1),
+                            prefix: Optional[str] = None,
+                            has: List[str] = Query([]),
+                            where: List[str] = Query([]),
+                            fields: Optional[str] = None,
+                            response_format: Optional[str] = Query(None, alias='format'),
+                            include_total: bool = False):
+    """One page of the resource catalog, streamed as json or NDJSON.
+
+    The next page's cursor is returned in the X-Next-Cursor header (and in
+    the json body), and is absent on the last page.
+    """
+    ndjson = wants_ndjson(request, response_format)
+    max_limit = _RESOURCES_STREAM_MAX_SIZE if ndjson else _RESOURCES_PAGE_MAX_SIZE
+    if limit > max_limit:
+        raise HTTPException(status_code=status.HTTP_400_BAD_REQUEST,
+                            detail=f"limit must be at most {max_limit} for this format")
+    # Every request of a page works on the same catalog, even if it is swapped meanwhile
+    catalog = resource_catalog
+    try:
+        where_filters = [parse_where_filter(item) for item in where]
+        projection = parse_fields(fields)
+        # Selecting and counting may walk the whole catalog, keep that off the event loop
+        positions, next_cursor, total = await asyncio.to_thread(
+            select_resources_page, catalog, cursor, limit, prefix, has, where_filters, include_total)
+    except ValueError as e:
+        raise HTTPException(status_code=status.HTTP_400_BAD_REQUEST, detail=str(e))
+    headers = {}
+    if next_cursor is not None:
+        headers['X-Next-Cursor'] = next_cursor
+    if total is not None:
+        headers['X-Total-Count'] = str(total)
+    if ndjson:
+        return StreamingResponse(catalog.stream_ndjson(positions, projection),
+                                 media_type='application/x-ndjson', headers=headers)
+    return StreamingResponse(catalog.stream_json(positions, projection, next_cursor, total),
+                             media_type='application/json', headers=headers)
+
+async def require_admin_user(request: Request):
+    """Allow the request only for users flagged 'is_admin' in the user store. Runs after validate_protected_api_request."""
+    if is_signed_session_mode():
+        raise HTTPException(status_code=status.HTTP_400_BAD_REQUEST,
+                            detail="Session administration is not available in signed session mode")
+    username = request.state.session_validation.username
+    user = await get_user_by_username(username=username)
+    if user is None or not user.get('is_admin'):
+        logger.warning("User with username: %s is not an admin. Rejecting session administration request", username)
+        raise HTTPException(status_code=status.HTTP_403_FORBIDDEN,
+                            detail=f"User with username: {username} is not an admin")
+
+def session_summary(session_id: str, session: dict) -> dict:
+    """A SessionSummarySchema payload. csrfToken is left out on purpose, it would let an admin act as the user."""
+    return {'sessionId': session_id,
+            'username': session.get('username'),
+            'expiresAt': session.get('expires_at')}
+
+async def revoke_sessions_of_user(username: str) -> int:
+    """Delete every session of username, found through the backend's username index."""
+    try:
+        session_ids = await session_backend.get_user_session_ids(username)
+    except Exception as e:
+        logger.error("Error occured while getting sessions of user. Error:%s", e)
+        raise
+    await asyncio.gather(*[delete_session_by_session_id(session_id=session_id) for session_id in session_ids])
+    return len(session_ids)
+
+@protected_api_router.post('/api/v1/protected/session/rotate')
+async def rotate_current_session(request: Request, response: Response):
+    """Issue a new session id and CSRF token for the current session, e.g. before a privilege-sensitive action."""
+    if is_signed_session_mode():
+        claims = request.state.session_validation.claims
+        issued = session_token_signer.issue(claims['sub'], claims['exp'])
+        await revoke_signed_session_token(claims['jti'], claims['exp'])
+        set_session_cookie(response, issued['token'])
+        return api_response(RotateSessionResponseSchema, response,
+                            message=f"Rotated session for user: {claims['sub']}",
+                            sessionId=issued['token_id'],
+                            csrfToken=issued['csrf_token'])
+    result = request.state.session_validation
+    return await rotate_session(result.session_id, result.session, response)
+
+admin_api_router = APIRouter()
+
+@admin_api_router.get('/api/v1/protected/admin/sessions')
+async def get_all_sessions(response: Response,
+                           cursor: Optional[str] = None,
+                           limit: int = Query(100, ge=1, le=_ADMIN_SESSIONS_PAGE_MAX_SIZE),
+                           username: Optional[str] = None):
+    if username is not None:
+        session_ids = await session_backend.get_user_session_ids(username)
+        sessions = await asyncio.gather(*[get_session_by_session_id(session_id=session_id) for session_id in session_ids])
+        return api_response(
+            GetAllSessionsResponseSchema, response,
+            items=[session_summary(session_id, session) for session_id, session in zip(session_ids, sessions)
+                   if session is not None])
+    try:
+        sessions, next_cursor = await session_backend.list_sessions(cursor, limit)
+    except ValueError:
+        raise HTTPException(status_code=status.HTTP_400_BAD_REQUEST, detail=f"Invalid cursor: {cursor}")
+    return api_response(GetAllSessionsResponseSchema, response,
+                        items=[session_summary(session_id, session) for session_id, session in sessions],
+                        nextCursor=next_cursor)
+
+@admin_api_router.get('/api/v1/protected/admin/sessions/count')
+async def count_sessions(response: Response):
+    by_user = await session_backend.count_sessions_by_user(now=time.time() - _SESSION_CLOCK_SKEW_TOLERANCE_SECONDS)
+    return api_response(SessionCountResponseSchema, response, total=sum(by_user.values()), byUser=by_user)
+
+@admin_api_router.delete('/api/v1/protected/admin/sessions/{session_id}')
+async def revoke_session(session_id: str, request: Request, response: Response):
+    existing_session = await get_session_by_session_id(session_id=session_id)
+    if existing_session is None:
+        raise HTTPException(status_code=status.HTTP_404_NOT_FOUND,
+                            detail=f"Could not find a session with session_id:{session_id}")
+    await delete_session_by_session_id(session_id=session_id)
+    logger.info("Admin: %s revoked session_id:%s", request.state.session_validation.username, session_id)
+    return api_response(RevokeSessionsResponseSchema, response, message=f"Revoked session_id:{session_id}", revoked=1)
+
+@admin_api_router.delete('/api/v1/protected/admin/users/{username}/sessions')
+async def revoke_all_sessions_of_user(username: str, request: Request, response: Response):
+    revoked = await revoke_sessions_of_user(username)
+    logger.info("Admin: %s revoked %s sessions of user with username: %s", request.state.session_validation.username, revoked, username)
+    return api_response(RevokeSessionsResponseSchema, response,
+                        message=f"Revoked {revoked} sessions of user: {username}", revoked=revoked)
+
+operations_api_router = APIRouter()
+
+@operations_api_router.get('/metrics')
+async def get_metrics():
+    return PlainTextResponse(metrics_registry.render(), media_type='text/plain; version=0.0.4')
 
 
 logger.info("Initializing app")
-app = FastAPI()
+if _FAST_JSON_RESPONSES:
+    logger.info("Fast json responses enabled, encoding with %s", fast_json.ENCODER)
+    app = FastAPI(default_response_class=FastJSONResponse)
+    app.add_exception_handler(StarletteHTTPException, fast_json.http_exception_handler)
+else:
+    app = FastAPI()
 logger.info("Adding middlewares")
 app.add_middleware(
     CORSMiddleware,
@@ -382,8 +912,15 @@ app.add_middleware(
     allow_headers="*",
     allow_methods="*"
 )
+app.add_middleware(LogContextMiddleware)
+if _METRICS_ENABLED:
+    app.add_middleware(MetricsMiddleware)
 logger.info("Adding event handlers")
 app.add_event_handler('startup', startup_event_handler)
+app.add_event_handler('shutdown', shutdown_event_handler)
 logger.info("Adding routers")
 app.include_router(router=login_api_router)
-app.include_router(router=protected_api_router, dependencies=[Depends(validate_protected_api_request)])
\ No newline at end of file
+app.include_router(router=protected_api_router, dependencies=[Depends(validate_protected_api_request)])
+app.include_router(router=admin_api_router, dependencies=[Depends(validate_protected_api_request), Depends(require_admin_user)])
+if _METRICS_ENABLED:
+    app.include_router(router=operations_api_router)
\ No newline at end of file
@@ -0,0 +1,147 @@
+"""Per-route rate limits keyed by client IP and by username.
+
+Limits are written as '<route>.<scope>=<requests>/<seconds>', comma
+separated, where route is the label a handler passes to the check ('login',
+'login_status', 'logout' or 'protected', which covers every protected route)
+and scope is 'ip' or 'username', e.g. 'login.ip=20/60,login.username=10/60'.
+
+By default each worker enforces the limits on its own with token buckets:
+every key gets a bucket of <requests> tokens refilled at <requests>/<seconds>
+per second. Buckets are kept in insertion-ordered dicts sorted by last use,
+so finding idle buckets to evict only ever looks at the oldest ones and a
+check is O(1) however many clients there are.
+
+With a shared store, the limits are enforced as fixed windows counted in the
+session backend instead, so that all workers draw from the same allowance.
+"""
+import math
+import time
+from collections import OrderedDict
+from typing import Dict, Optional, Tuple
+
+_SCOPES = ('ip', 'username')
+
+
+def parse_rate_limits(value: str) -> Dict[Tuple[str, str], Tuple[int, float]]:
+    """Parse '<route>.<scope>=<requests>/<seconds>,...' into {(route, scope): (requests, seconds)}."""
+    limits = {}
+    for item in value.split(','):
+        item = item.strip()
+        if not item:
+            continue
+        try:
+            target, rate = item.split('=')
+            route, scope = target.rsplit('.', 1)
+            requests, seconds = rate.split('/')
+            requests, seconds = int(requests), float(seconds)
+        except ValueError:
+            raise ValueError(f"Invalid rate limit entry: {item!r}. Expected '<route>.<scope>=<requests>/<seconds>'")
+        if scope not in _SCOPES or requests <= 0 or seconds <= 0:
+            raise ValueError(f"Invalid rate limit entry: {item!r}. Scope must be one of {_SCOPES} and the rate positive")
+        limits[(route, scope)] = (requests, seconds)
+    return limits
+
+
+class TokenBucketLimiter:
+    """Token buckets for one route and scope, local to this worker.
+
+    A bucket untouched for a full period has refilled completely and is then
+    indistinguishable from a missing one, so it is dropped.
+    """
+
+    def __init__(self, requests: int, seconds: float, max_keys: int = 100000):
+        self.capacity = requests
+        self.refill_rate = requests / seconds
+        self.idle_after = seconds
+        self.max_keys = max_keys
+        # key -> [tokens, last update], least recently used first
+        self._buckets = OrderedDict()
+
+    def __len__(self):
+        return len(self._buckets)
+
+    def acquire(self, key: str, now: Optional[float] = None) -> float:
+        """Take a token for key. Returns 0 if allowed, else seconds until a token is available."""
+        now = time.monotonic() if now is None else now
+        bucket = self._buckets.get(key)
+        if bucket is None:
+            bucket = self._buckets[key] = [float(self.capacity), now]
+        else:
+            bucket[0] = min(self.capacity, bucket[0] + (now - bucket[1]) * self.refill_rate)
+            bucket[1] = now
+            self._buckets.move_to_end(key)
+        self._evict_idle(now)
+        if bucket[0] >= 1:
+            bucket[0] -= 1
+            return 0.0
+        return (1 - bucket[0]) / self.refill_rate
+
+    def _evict_idle(self, now: float):
+        while self._buckets:
+            oldest_key, (_, updated_at) = next(iter(self._buckets.items()))
+            if now - updated_at < self.idle_after and len(self._buckets) <= self.max_keys:
+                return
+            del self._buckets[oldest_key]
+
+
+class SharedWindowLimiter:
+    """Fixed-window counters for one route and scope, kept in a shared store.
+
+    The store must provide 'async incr(key, expires_at) -> int'. Windows are
+    aligned to wall-clock time so every worker counts into the same one.
+    """
+
+    def __init__(self, name: str, requests: int, seconds: float, store):
+        self.name = name
+        self.requests = requests
+        self.seconds = seconds
+        self.store = store
+
+    async def acquire(self, key: str, now: Optional[float] = None) -> float:
+        now = time.time() if now is None else now
+        window = math.floor(now / self.seconds)
+        window_ends_at = (window + 1) * self.seconds
+        count = await self.store.incr(f"ratelimit:{self.name}:{window}:{key}", window_ends_at)
+        if count <= self.requests:
+            return 0.0
+        return window_ends_at - now
+
+
+class RateLimiter:
+    """All configured limits, checked per request with check()."""
+
+    def __init__(self, limits: Dict[Tuple[str, str], Tuple[int, float]], shared_store=None, max_keys: int = 100000):
+        self.shared = shared_store is not None
+        self._limiters = {}
+        for (route, scope), (requests, seconds) in limits.items():
+            if self.shared:
+                limiter = SharedWindowLimiter(f"{route}.{scope}", requests, seconds, shared_store)
+            else:
+                limiter = TokenBucketLimiter(requests, seconds, max_keys=max_keys)
+            self._limiters[(route, scope)] = limiter
+        self.rejected = {}
+
+    def has_limits(self, route: str) -> bool:
+        return any((route, scope) in self._limiters for scope in _SCOPES)
+
+    async def check(self, route: str, ip: Optional[str], username: Optional[str] = None) -> float:
+        """Count a request to route. Returns 0 if allowed, else the seconds to wait before retrying."""
+        for scope, key in (('ip', ip), ('username', username)):
+            limiter = self._limiters.get((route, scope))
+            if limiter is None or key is None:
+                continue
+            if self.shared:
+                retry_after = await limiter.acquire(key)
+            else:
+                retry_after = limiter.acquire(key)
+            if retry_after > 0:
+                self.rejected[(route, scope)] = self.rejected.get((route, scope), 0) + 1
+                return retry_after
+        return 0.0
+
+    def stats(self) -> dict:
+        return {
+            'keys': {f"{route}.{scope}": len(limiter) for (route, scope), limiter in self._limiters.items()
+                     if not self.shared},
+            'rejected': {f"{route}.{scope}": count for (route, scope), count in self.rejected.items()},
+        }
@@ -0,0 +1,235 @@
+"""Catalog of protected resources with in-memory indexes, cursor pagination and streamed output.
+
+Resources are {'name': str, 'properties': dict} records, loaded once from a
+json array or an NDJSON file (one record per line) and then only read.
+
+The catalog keeps the resources in a list sorted by name, so:
+
+- a page starts after the cursor (the last name of the previous page) with a
+  binary search, whatever the page number;
+- a name prefix is a contiguous slice found with two binary searches;
+- 'has' (property key) and 'where' (property key and value) filters are
+  backed by lists of positions per key and per (key, value), also sorted, so
+  a query walks the shortest matching list instead of the whole catalog and
+  checks the remaining filters per candidate.
+
+Pages are written out in batches as they are encoded, either as one json
+document or as NDJSON, so a large page is never held in memory as a whole.
+The streams give the event loop a turn after every batch, so encoding a large
+page does not hold up other requests.
+With pre_encode, every resource is also encoded once when the catalog is
+built, and pages without a field projection only join those bytes.
+"""
+import asyncio
+import base64
+import binascii
+import bisect
+import json
+import os
+from typing import AsyncIterator, Callable, Dict, Iterable, List, Optional, Sequence, Tuple
+
+from logging_setup import get_logger
+
+logger = get_logger(__name__)
+
+_SCALAR_TYPES = (str, int, float, bool, type(None))
+_ENCODE_BATCH_SIZE = 256
+# Sorts after every name that starts with a given prefix
+_PREFIX_UPPER_BOUND = '\U0010ffff'
+
+
+def property_value_key(value) -> Optional[str]:
+    """The form a property value is matched in by 'where' filters, or None if it cannot be indexed.
+
+    Strings match as they are, other scalars in their json form, e.g. 1 as '1' and true as 'true'.
+    """
+    if isinstance(value, str):
+        return value
+    if isinstance(value, _SCALAR_TYPES):
+        return json.dumps(value)
+    return None
+
+
+def compact_json_dumps(content) -> bytes:
+    return json.dumps(content, separators=(',', ':')).encode()
+
+
+def encode_cursor(name: str) -> str:
+    return base64.urlsafe_b64encode(name.encode()).rstrip(b'=').decode('ascii')
+
+
+def decode_cursor(cursor: str) -> str:
+    """Return the name a cursor points after. Raises ValueError for a malformed cursor."""
+    try:
+        return base64.b64decode(cursor + '=' * (-len(cursor) % 4), altchars=b'-_', validate=True).decode()
+    except (binascii.Error, UnicodeDecodeError):
+        raise ValueError(f"Invalid cursor: {cursor!r}")
+
+
+def parse_where_filter(value: str) -> Tuple[str, str]:
+    """Parse a 'key:value' filter. Raises ValueError if there is no ':'."""
+    key, separator, expected = value.partition(':')
+    if not separator or not key:
+        raise ValueError(f"Invalid where filter: {value!r}. Expected '<key>:<value>'")
+    return key, expected
+
+
+def parse_fields(value: Optional[str]) -> Optional[List[str]]:
+    """Parse a 'name,properties.k1' projection. None selects whole resources."""
+    if not value:
+        return None
+    fields = [field.strip() for field in value.split(',') if field.strip()]
+    for field in fields:
+        if field not in ('name', 'properties') and not field.startswith('properties.'):
+            raise ValueError(f"Invalid field: {field!r}. Expected 'name', 'properties' or 'properties.<key>'")
+    return fields
+
+
+def project(resource: dict, fields: Optional[Sequence[str]]) -> dict:
+    if fields is None:
+        return resource
+    projected = {}
+    for field in fields:
+        if field == 'name':
+            projected['name'] = resource['name']
+        elif field == 'properties':
+            projected['properties'] = resource['properties']
+        else:
+            key = field[len('properties.'):]
+            if key in resource['properties']:
+                projected.setdefault('properties', {})[key] = resource['properties'][key]
+    return projected
+
+
+class ResourceCatalog:
+    """Immutable, indexed set of resources. Build a new catalog to change it.
+
+    dumps encodes one resource (or the page tail) to json bytes. pre_encode
+    keeps every resource's encoding, trading memory for encoding time.
+    """
+
+    def __init__(self, resources: Iterable[dict], dumps: Callable[[object], bytes] = compact_json_dumps,
+                 pre_encode: bool = False):
+        self.dumps = dumps
+        by_name = {}
+        for resource in resources:
+            name = resource.get('name') if isinstance(resource, dict) else None
+            if not isinstance(name, str):
+                raise ValueError(f"Resource without a string name: {resource!r}")
+            properties = resource.get('properties') or {}
+            if not isinstance(properties, dict):
+                raise ValueError(f"Properties of resource {name!r} are not an object")
+            if name in by_name:
+                logger.warning("Duplicate resource name: %s, keeping the last one", name)
+            by_name[name] = {'name': name, 'properties': properties}
+        self.names = sorted(by_name)
+        self.resources = [by_name[name] for name in self.names]
+        # Positions into self.resources, ascending since they are appended in order
+        self._positions_by_key: Dict[str, List[int]] = {}
+        self._positions_by_value: Dict[Tuple[str, str], List[int]] = {}
+        for position, resource in enumerate(self.resources):
+            for key, value in resource['properties'].items():
+                self._positions_by_key.setdefault(key, []).append(position)
+                value_key = property_value_key(value)
+                if value_key is not None:
+                    self._positions_by_value.setdefault((key, value_key), []).append(position)
+        self._encoded: Optional[List[bytes]] = [dumps(resource) for resource in self.resources] if pre_encode else None
+
+    def __len__(self):
+        return len(self.resources)
+
+    def _name_range(self, prefix: Optional[str]) -> Tuple[int, int]:
+        if not prefix:
+            return 0, len(self.names)
+        return (bisect.bisect_left(self.names, prefix),
+                bisect.bisect_left(self.names, prefix + _PREFIX_UPPER_BOUND))
+
+    def _matches(self, resource: dict, has: Sequence[str], where: Sequence[Tuple[str, str]]) -> bool:
+        properties = resource['properties']
+        for key in has:
+            if key not in properties:
+                return False
+        for key, expected in where:
+            if key not in properties or property_value_key(properties[key]) != expected:
+                return False
+        return True
+
+    def _candidates(self, start: int, end: int, has: Sequence[str], where: Sequence[Tuple[str, str]]) -> Iterable[int]:
+        """Positions in [start, end) that may match, walking the shortest index list of the filters."""
+        index_lists = [self._positions_by_key.get(key, []) for key in has]
+        index_lists += [self._positions_by_value.get(item, []) for item in where]
+        if not index_lists:
+            return range(start, end)
+        shortest = min(index_lists, key=len)
+        first = bisect.bisect_left(shortest, start)
+        last = bisect.bisect_left(shortest, end)
+        return (shortest[index] for index in range(first, last))
+
+    def select(self, cursor: Optional[str] = None, limit: int = 100, prefix: Optional[str] = None,
+               has: Sequence[str] = (), where: Sequence[Tuple[str, str]] = ()) -> Tuple[List[int], Optional[str]]:
+        """Return the positions of one page of matching resources and the cursor of the next page (None on the last)."""
+        start, end = self._name_range(prefix)
+        if cursor is not None:
+            start = max(start, bisect.bisect_right(self.names, decode_cursor(cursor)))
+        page = []
+        for position in self._candidates(start, end, has, where):
+            if self._matches(self.resources[position], has, where):
+                if len(page) == limit:
+                    return page, encode_cursor(self.names[page[-1]])
+                page.append(position)
+        return page, None
+
+    def count(self, prefix: Optional[str] = None, has: Sequence[str] = (),
+              where: Sequence[Tuple[str, str]] = ()) -> int:
+        """Number of matching resources. Walks all candidates, unless there are no property filters."""
+        start, end = self._name_range(prefix)
+        if not has and not where:
+            return end - start
+        return sum(1 for position in self._candidates(start, end, has, where)
+                   if self._matches(self.resources[position], has, where))
+
+    def _encoded_batches(self, positions: Sequence[int], fields: Optional[Sequence[str]], separator: bytes,
+                         batch_size: int) -> Iterable[bytes]:
+        encoded, dumps = self._encoded, self.dumps
+        for batch_start in range(0, len(positions), batch_size):
+            batch = positions[batch_start:batch_start + batch_size]
+            if encoded is not None and fields is None:
+                yield separator.join([encoded[position] for position in batch])
+            else:
+                yield separator.join([dumps(project(self.resources[position], fields)) for position in batch])
+
+    async def stream_json(self, positions: Sequence[int], fields: Optional[Sequence[str]], next_cursor: Optional[str],
+                          total: Optional[int] = None, batch_size: int = _ENCODE_BATCH_SIZE) -> AsyncIterator[bytes]:
+        """Encode a page as {"items": [...], "nextCursor": ..., "total": ...}, one batch of items at a time."""
+        yield b'{"items":['
+        for index, batch in enumerate(self._encoded_batches(positions, fields, b',', batch_size)):
+            yield batch if index == 0 else b',' + batch
+            await asyncio.sleep(0)
+        tail = {'nextCursor': next_cursor}
+        if total is not None:
+            tail['total'] = total
+        yield b'],' + self.dumps(tail)[1:]
+
+    async def stream_ndjson(self, positions: Sequence[int], fields: Optional[Sequence[str]],
+                            batch_size: int = _ENCODE_BATCH_SIZE) -> AsyncIterator[bytes]:
+        """Encode a page as one json resource per line."""
+        for batch in self._encoded_batches(positions, fields, b'\n', batch_size):
+            yield batch + b'\n'
+            await asyncio.sleep(0)
+
+
+def read_resources_file(file_path: str) -> List[dict]:
+    """Read resources from a json array file, or an NDJSON file ('.ndjson' or '.jsonl'). Blocking."""
+    with open(file_path) as fp:
+        if os.path.splitext(file_path)[1] in ('.ndjson', '.jsonl'):
+            return [json.loads(line) for line in fp if line.strip()]
+        resources = json.load(fp)
+    if not isinstance(resources, list):
+        raise ValueError(f"{file_path} must contain a json array of resources")
+    return resources
+
+
+def load_resource_catalog(file_path: str, dumps: Callable[[object], bytes] = compact_json_dumps,
+                          pre_encode: bool = False) -> ResourceCatalog:
+    """Read and index a resources file. Blocking, run it in a thread."""
+    return ResourceCatalog(read_resources_file(file_path), dumps=dumps, pre_encode=pre_encode)
@@ -0,0 +1,110 @@
+"""Production entry point: the backend app in several worker processes, managed by gunicorn.
+
+    python serve.py
+
+The master process imports main once (preload), initializes the shared
+stores and loads the resource catalog, then forks WORKERS uvicorn workers
+that start with all of it already in memory. Gunicorn restarts workers that
+die and handles the signals for graceful and rolling restarts:
+
+- HUP: start fresh workers and stop the old ones once they finish their
+  in-flight requests (same code, since it was preloaded).
+- USR2, then QUIT to the old master: start a new master with the new code
+  next to the old one, then stop the old one. Both serve while it happens.
+- TTIN / TTOU: add or remove a worker.
+
+Only one worker runs the expired sessions sweeper at a time, see leader_lock.py.
+Needs gunicorn and uvicorn-worker (in requirements.txt) and a POSIX system.
+"""
+import asyncio
+import multiprocessing
+import os
+
+from gunicorn.app.base import BaseApplication
+
+from logging_setup import get_logger, stop_logging
+
+_BIND = os.environ.get('BIND', '0.0.0.0:8000')
+_WORKERS = int(os.environ.get('WORKERS', '0')) or os.cpu_count() or 1
+_GRACEFUL_TIMEOUT_SECONDS = int(os.environ.get('GRACEFUL_TIMEOUT_SECONDS', '30'))
+_WORKER_MAX_REQUESTS = int(os.environ.get('WORKER_MAX_REQUESTS', '0'))
+_PID_FILE_PATH = os.environ.get('PID_FILE_PATH', '')
+
+logger = get_logger(__name__)
+
+
+class BackendApplication(BaseApplication):
+    """Gunicorn application serving main.app with uvicorn workers."""
+
+    def __init__(self, options: dict):
+        self.options = options
+        super().__init__()
+
+    def load_config(self):
+        for key, value in self.options.items():
+            self.cfg.set(key, value)
+
+    def load(self):
+        import main
+        if main._RESOURCES_FILE_PATH and not main.resources_loaded:
+            main.load_resources()
+        return main.app
+
+
+def initialize_shared_state():
+    """Run main.initialize_shared_state in a forked child and wait for it.
+
+    The child's event loop, threads and store connections go away with it, so
+    nothing the workers inherit from the master was ever bound to a loop.
+    """
+    import main
+
+    def run():
+        try:
+            asyncio.run(main.initialize_shared_state())
+        finally:
+            # The child leaves through os._exit, which skips the atexit flush
+            stop_logging()
+
+    process = multiprocessing.get_context('fork').Process(target=run, name='initialize-shared-state')
+    process.start()
+    process.join()
+    if process.exitcode != 0:
+        raise SystemExit(f"Initializing the session and user stores failed with exit code {process.exitcode}")
+
+
+def check_worker_count():
+    import main
+    if _WORKERS > 1 and main._SESSION_BACKEND == 'json':
+        # Signed mode stores no sessions, but its token revocations live in the backend too
+        raise SystemExit("SESSION_BACKEND=json keeps sessions and revoked tokens in the memory of one process and "
+                         "cannot be shared by several workers. Use SESSION_BACKEND=sqlite or redis, or WORKERS=1")
+    if _WORKERS > 1 and main._USER_STORE == 'json':
+        logger.warning("USER_STORE=json is loaded by every worker; password hash upgrades made by one worker "
+                       "are not seen by the others until they restart. Prefer USER_STORE=sqlite")
+
+
+def flush_worker_logs(server, worker):
+    stop_logging()
+
+
+def options() -> dict:
+    return {
+        'bind': _BIND,
+        'workers': _WORKERS,
+        'worker_class': 'uvicorn_worker.UvicornWorker',
+        'preload_app': True,
+        'graceful_timeout': _GRACEFUL_TIMEOUT_SECONDS,
+        'max_requests': _WORKER_MAX_REQUESTS,
+        # Spread recycling out so workers do not all restart at once
+        'max_requests_jitter': _WORKER_MAX_REQUESTS // 10,
+        'pidfile': _PID_FILE_PATH or None,
+        'worker_exit': flush_worker_logs,
+    }
+
+
+if __name__ == '__main__':
+    check_worker_count()
+    logger.info("Initializing shared state before starting %s workers on %s", _WORKERS, _BIND)
+    initialize_shared_state()
+    BackendApplication(options()).run()
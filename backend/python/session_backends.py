@@ -0,0 +1,990 @@
+import asyncio
+import fnmatch
+import heapq
+import json
+import math
+import os
+import sqlite3
+import time
+import zlib
+from concurrent.futures import ThreadPoolExecutor
+from typing import Dict, Optional, Tuple
+
+from aiofile import AIOFile, Writer
+
+from atomic_file import write_json_atomically
+from logging_setup import get_logger
+from metrics import span
+
+logger = get_logger(__name__)
+
+
+def seconds_until(expires_at) -> Optional[float]:
+    """Remaining lifetime of a session record, or None if it has no expiry.
+
+    Session expiry is stored as an epoch timestamp so it stays meaningful across
+    restarts and between processes sharing a store.
+    """
+    if expires_at is None:
+        return None
+    return expires_at - time.time()
+
+
+def _expires_after(data: dict, now: float) -> bool:
+    """Whether a session record expires after now. Records without a numeric expiry are corrupted and never do."""
+    expires_at = data.get('expires_at')
+    return isinstance(expires_at, (int, float)) and expires_at > now
+
+
+class StripedAsyncLock:
+    """A fixed pool of asyncio locks shared out by key.
+
+    Mutations of the same session always take the same lock, while unrelated
+    sessions rarely contend. The memory cost is fixed regardless of how many
+    sessions exist.
+
+    Locks are created on first use, inside the running event loop. main.py
+    builds its pools at import time, before uvicorn starts its loop, and on
+    Python 3.9 a lock binds to the loop that is current when it is created.
+    """
+
+    def __init__(self, stripes: int = 64):
+        self._locks = [None] * stripes
+
+    def for_key(self, key: str) -> asyncio.Lock:
+        index = zlib.crc32(key.encode()) % len(self._locks)
+        lock = self._locks[index]
+        if lock is None:
+            lock = self._locks[index] = asyncio.Lock()
+        return lock
+
+
+class SessionBackend:
+    """Async interface of a session store.
+
+    Session records are plain dicts with at least 'username', 'csrfToken' and
+    'expires_at' keys. Implementations must tolerate records missing any of
+    those, since main.py treats such records as corrupted and deletes them.
+    """
+
+    name = 'base'
+
+    async def open(self):
+        pass
+
+    async def close(self):
+        pass
+
+    async def get(self, session_id: str) -> Optional[dict]:
+        raise NotImplementedError
+
+    async def put(self, session_id: str, data: dict):
+        raise NotImplementedError
+
+    async def delete(self, session_id: str):
+        raise NotImplementedError
+
+    async def expire(self, session_id: str, expires_at: float):
+        """Move the expiry of an existing session. Missing sessions are ignored."""
+        raise NotImplementedError
+
+    async def get_user_session_ids(self, username: str) -> list:
+        """Ids of the sessions of username, looked up in the username index."""
+        raise NotImplementedError
+
+    async def count_sessions_by_user(self, now: float) -> Dict[str, int]:
+        """Number of sessions expiring after now, per username."""
+        raise NotImplementedError
+
+    async def list_sessions(self, cursor: Optional[str], limit: int) -> Tuple[list, Optional[str]]:
+        """Return a page of about limit (session_id, record) pairs and the cursor of the next page.
+
+        Pass cursor None for the first page; the next cursor is None after the last.
+        """
+        raise NotImplementedError
+
+    async def incr(self, key: str, expires_at: float) -> int:
+        """Increment a counter shared by everyone using the store and return its new value.
+
+        A counter this call creates expires at expires_at; it then starts again
+        from zero. Used for rate limit windows shared between workers.
+        """
+        raise NotImplementedError
+
+    async def revoke_token(self, token_id: str, expires_at: float):
+        """Record a signed session token as revoked until expires_at, for everyone using the store."""
+        raise NotImplementedError
+
+    async def is_token_revoked(self, token_id: str) -> bool:
+        raise NotImplementedError
+
+    async def evict_expired(self, now: float) -> int:
+        """Delete every session whose 'expires_at' is at or before now.
+
+        Revoked tokens and counters past their expiry go too, but only
+        sessions are counted in the returned number. Implementations should
+        only do work proportional to the number of expired sessions.
+        """
+        raise NotImplementedError
+
+
+class InstrumentedSessionBackend(SessionBackend):
+    """Wraps a backend and times every store operation as a 'session_store_<op>' span."""
+
+    def __init__(self, backend: SessionBackend):
+        self.backend = backend
+        self.name = backend.name
+
+    def __getattr__(self, name):
+        return getattr(self.backend, name)
+
+    async def open(self):
+        with span('session_store_open'):
+            await self.backend.open()
+
+    async def close(self):
+        with span('session_store_close'):
+            await self.backend.close()
+
+    async def get(self, session_id: str) -> Optional[dict]:
+        with span('session_store_get'):
+            return await self.backend.get(session_id)
+
+    async def put(self, session_id: str, data: dict):
+        with span('session_store_put'):
+            await self.backend.put(session_id, data)
+
+    async def delete(self, session_id: str):
+        with span('session_store_delete'):
+            await self.backend.delete(session_id)
+
+    async def expire(self, session_id: str, expires_at: float):
+        with span('session_store_expire'):
+            await self.backend.expire(session_id, expires_at)
+
+    async def get_user_session_ids(self, username: str) -> list:
+        with span('session_store_get_user_session_ids'):
+            return await self.backend.get_user_session_ids(username)
+
+    async def count_sessions_by_user(self, now: float) -> Dict[str, int]:
+        with span('session_store_count_sessions_by_user'):
+            return await self.backend.count_sessions_by_user(now)
+
+    async def list_sessions(self, cursor: Optional[str], limit: int) -> Tuple[list, Optional[str]]:
+        with span('session_store_list_sessions'):
+            return await self.backend.list_sessions(cursor, limit)
+
+    async def incr(self, key: str, expires_at: float) -> int:
+        with span('session_store_incr'):
+            return await self.backend.incr(key, expires_at)
+
+    async def revoke_token(self, token_id: str, expires_at: float):
+        with span('session_store_revoke_token'):
+            await self.backend.revoke_token(token_id, expires_at)
+
+    async def is_token_revoked(self, token_id: str) -> bool:
+        with span('session_store_is_token_revoked'):
+            return await self.backend.is_token_revoked(token_id)
+
+    async def evict_expired(self, now: float) -> int:
+        with span('session_store_evict_expired'):
+            return await self.backend.evict_expired(now)
+
+
+class JsonFileSessionBackend(SessionBackend):
+    """Sessions held in memory and persisted to a local json file.
+
+    In 'snapshot' mode changes are flushed to the file in batches every
+    flush_interval seconds. In 'journal' mode every change is appended to a
+    journal file which is compacted into the snapshot in the background once it
+    passes journal_compact_threshold bytes.
+    """
+
+    name = 'json'
+
+    def __init__(self, file_path: str, persistence_mode: str = 'snapshot', flush_interval: float = 1.0,
+                 journal_file_path: str = 'sessions.journal', journal_compact_threshold: int = 1024 * 1024):
+        self.file_path = file_path
+        self.persistence_mode = persistence_mode
+        self.flush_interval = flush_interval
+        self.journal_file_path = journal_file_path
+        self.journal_compact_threshold = journal_compact_threshold
+        self.sessions = {}
+        # username -> set of session ids, kept in step with sessions
+        self._user_sessions = {}
+        # Counters and revoked tokens are not persisted, this backend serves a single process
+        self._counters = {}
+        self._revoked_tokens = {}
+        # Min-heap of (expires_at, session_id). Entries go stale when a session
+        # is deleted or its expiry moves; those are skipped when popped.
+        self._expiry_heap = []
+        self._version = 0
+        self._flushed_version = 0
+        self._flush_task = None
+        # Created in open() or on first use, inside the event loop the backend runs on
+        self._snapshot_lock = None
+        self._journal_file = None
+        self._journal_writer = None
+        self._journal_size = 0
+        self._journal_lock = None
+        self._journal_compaction_task = None
+
+    @property
+    def is_journal_mode(self) -> bool:
+        return self.persistence_mode == 'journal'
+
+    @property
+    def snapshot_lock(self) -> asyncio.Lock:
+        if self._snapshot_lock is None:
+            self._snapshot_lock = asyncio.Lock()
+        return self._snapshot_lock
+
+    @property
+    def journal_lock(self) -> asyncio.Lock:
+        if self._journal_lock is None:
+            self._journal_lock = asyncio.Lock()
+        return self._journal_lock
+
+    async def open(self):
+        self._snapshot_lock = asyncio.Lock()
+        self._journal_lock = asyncio.Lock()
+        logger.info("Initializing session json file with persistence mode: %s", self.persistence_mode)
+        await self.init_sessions_json_file()
+        if self.is_journal_mode:
+            logger.info("Opening sessions journal file")
+            await self.open_sessions_journal()
+        else:
+            logger.info("Starting sessions flush task with interval: %s seconds", self.flush_interval)
+            self._flush_task = asyncio.create_task(self.sessions_flush_loop())
+
+    async def close(self):
+        if self._flush_task is not None:
+            logger.info("Stopping sessions flush task")
+            # Holding the snapshot lock guarantees the task is not mid-write
+            async with self.snapshot_lock:
+                self._flush_task.cancel()
+            try:
+                await self._flush_task
+            except asyncio.CancelledError:
+                pass
+            self._flush_task = None
+        if self.is_journal_mode:
+            if self._journal_compaction_task is not None:
+                logger.info("Waiting for running sessions journal compaction to finish")
+                await self._journal_compaction_task
+            logger.info("Closing sessions journal file")
+            await self.close_sessions_journal()
+        else:
+            logger.info("Flushing pending session changes to file")
+            await self.flush_sessions_to_file()
+
+    async def get(self, session_id: str) -> Optional[dict]:
+        return self.sessions.get(session_id)
+
+    async def put(self, session_id: str, data: dict):
+        previous = self.sessions.get(session_id)
+        self.sessions[session_id] = data
+        if previous is not None:
+            self._unindex_user(session_id, previous)
+        self._index_user(session_id, data)
+        self._index_expiry(session_id, data)
+        await self._record_put(session_id, data)
+
+    async def delete(self, session_id: str):
+        session = self.sessions.pop(session_id, None)
+        if session is not None:
+            self._unindex_user(session_id, session)
+            if self.is_journal_mode:
+                await self.append_session_journal_record({'op': 'del', 'id': session_id})
+            else:
+                self.mark_sessions_changed()
+
+    async def expire(self, session_id: str, expires_at: float):
+        session = self.sessions.get(session_id)
+        if session is not None:
+            data = {**session, 'expires_at': expires_at}
+            self.sessions[session_id] = data
+            self._index_expiry(session_id, data)
+            await self._record_put(session_id, data)
+
+    async def incr(self, key: str, expires_at: float) -> int:
+        counter = self._counters.get(key)
+        if counter is None or counter[1] <= time.time():
+            counter = self._counters[key] = [0, expires_at]
+        counter[0] += 1
+        return counter[0]
+
+    async def revoke_token(self, token_id: str, expires_at: float):
+        self._revoked_tokens[token_id] = expires_at
+
+    async def is_token_revoked(self, token_id: str) -> bool:
+        return token_id in self._revoked_tokens
+
+    async def evict_expired(self, now: float) -> int:
+        if self._counters:
+            self._counters = {key: counter for key, counter in self._counters.items() if counter[1] > now}
+        if self._revoked_tokens:
+            self._revoked_tokens = {token_id: expires_at for token_id, expires_at in self._revoked_tokens.items()
+                                    if expires_at > now}
+        expired_session_ids = []
+        while self._expiry_heap and self._expiry_heap[0][0] <= now:
+            expires_at, session_id = heapq.heappop(self._expiry_heap)
+            session = self.sessions.get(session_id)
+            if session is not None and session.get('expires_at') == expires_at:
+                del self.sessions[session_id]
+                self._unindex_user(session_id, session)
+                expired_session_ids.append(session_id)
+        if expired_session_ids:
+            if self.is_journal_mode:
+                await self.append_session_journal_records([{'op': 'del', 'id': session_id}
+                                                           for session_id in expired_session_ids])
+            else:
+                self.mark_sessions_changed()
+        if len(self._expiry_heap) > 2 * len(self.sessions) + 1024:
+            self.rebuild_expiry_index()
+        return len(expired_session_ids)
+
+    async def get_user_session_ids(self, username: str) -> list:
+        return list(self._user_sessions.get(username, ()))
+
+    async def count_sessions_by_user(self, now: float) -> Dict[str, int]:
+        counts = {}
+        for username, session_ids in self._user_sessions.items():
+            count = sum(1 for session_id in session_ids
+                        if _expires_after(self.sessions[session_id], now))
+            if count:
+                counts[username] = count
+        return counts
+
+    async def list_sessions(self, cursor: Optional[str], limit: int) -> Tuple[list, Optional[str]]:
+        # Pages are ordered by session id; picking the next page is one pass
+        # over the ids, O(n log limit), without keeping a sorted copy around
+        candidates = self.sessions if cursor is None else (session_id for session_id in self.sessions
+                                                           if session_id > cursor)
+        session_ids = heapq.nsmallest(limit, candidates)
+        next_cursor = session_ids[-1] if len(session_ids) == limit else None
+        return [(session_id, self.sessions[session_id]) for session_id in session_ids], next_cursor
+
+    def _index_user(self, session_id: str, data: dict):
+        username = data.get('username')
+        if username is not None:
+            self._user_sessions.setdefault(username, set()).add(session_id)
+
+    def _unindex_user(self, session_id: str, data: dict):
+        username = data.get('username')
+        session_ids = self._user_sessions.get(username)
+        if session_ids is not None:
+            session_ids.discard(session_id)
+            if not session_ids:
+                del self._user_sessions[username]
+
+    def rebuild_user_index(self):
+        """Rebuild the username index from the live sessions."""
+        self._user_sessions = {}
+        for session_id, session in self.sessions.items():
+            self._index_user(session_id, session)
+
+    def _index_expiry(self, session_id: str, data: dict):
+        expires_at = data.get('expires_at')
+        if isinstance(expires_at, (int, float)):
+            heapq.heappush(self._expiry_heap, (expires_at, session_id))
+
+    def rebuild_expiry_index(self):
+        """Rebuild the expiry heap from the live sessions, dropping stale entries."""
+        self._expiry_heap = [(session['expires_at'], session_id) for session_id, session in self.sessions.items()
+                             if isinstance(session.get('expires_at'), (int, float))]
+        heapq.heapify(self._expiry_heap)
+
+    async def _record_put(self, session_id: str, data: dict):
+        if self.is_journal_mode:
+            await self.append_session_journal_record({'op': 'put', 'id': session_id, 'data': data})
+        else:
+            self.mark_sessions_changed()
+
+    async def init_sessions_json_file(self):
+        try:
+            if not os.path.exists(self.file_path):
+                logger.info("sessions json file does not exist. Attempting to create file ...")
+                await self.write_sessions_to_file(content={})
+            else:
+                logger.info("sessions json file already exists. Skipping creation ...")
+            logger.info("Loading sessions from file into memory")
+            self.sessions.clear()
+            self.sessions.update(await self.read_sessions_from_file())
+            logger.info("Loaded %s sessions from file into memory", len(self.sessions))
+            if self.is_journal_mode:
+                logger.info("Replaying sessions journal")
+                replayed = self.replay_sessions_journal(f"{self.journal_file_path}.old")
+                replayed += self.replay_sessions_journal(self.journal_file_path)
+                logger.info("Replayed %s journal records. %s sessions in memory", replayed, len(self.sessions))
+                if replayed:
+                    logger.info("Compacting replayed sessions journal into sessions json file")
+                    await self.write_sessions_to_file(dict(self.sessions))
+                    for path in (self.journal_file_path, f"{self.journal_file_path}.old"):
+                        if os.path.exists(path):
+                            os.remove(path)
+            self.rebuild_expiry_index()
+            self.rebuild_user_index()
+        except Exception as e:
+            logger.error("Error occured while initializing sessions json file. Error:%s", e)
+            raise
+
+    async def read_sessions_from_file(self):
+        try:
+            logger.debug("Reading sessions from file")
+            async with AIOFile(self.file_path, 'r') as afp:
+                content = await afp.read()
+                return json.loads(content) if content else {}
+        except Exception as e:
+            logger.error("Error occured while reading session file. Error:%s", e)
+            raise
+
+    async def write_sessions_to_file(self, content: dict):
+        try:
+            logger.debug("Writing sessions to file")
+            async with self.snapshot_lock:
+                await asyncio.to_thread(self.write_sessions_snapshot, content)
+        except Exception as e:
+            logger.error("Error occured while writing session file. Error:%s", e)
+            raise
+
+    def write_sessions_snapshot(self, content: dict):
+        """Atomically replace the sessions json file. Blocking, run it in a thread."""
+        write_json_atomically(self.file_path, content, separators=(',', ':'))
+
+    async def flush_sessions_to_file(self):
+        """Write the in-memory sessions to file if they changed since the last flush."""
+        version = self._version
+        if version == self._flushed_version:
+            return
+        try:
+            await self.write_sessions_to_file(dict(self.sessions))
+            self._flushed_version = version
+            logger.debug("Flushed %s sessions to file", len(self.sessions))
+        except Exception as e:
+            logger.error("Error occured while flushing sessions to file. Error:%s", e)
+
+    async def sessions_flush_loop(self):
+        """Periodically flush batched session changes to file."""
+        while True:
+            await asyncio.sleep(self.flush_interval)
+            await self.flush_sessions_to_file()
+
+    def mark_sessions_changed(self):
+        self._version += 1
+
+    def replay_sessions_journal(self, journal_file_path: str) -> int:
+        """Apply the records of a journal file to the in-memory sessions."""
+        if not os.path.exists(journal_file_path):
+            return 0
+        replayed = 0
+        with open(journal_file_path, 'r') as fp:
+            for line_number, line in enumerate(fp, start=1):
+                try:
+                    record = json.loads(line)
+                    if record['op'] == 'put':
+                        self.sessions[record['id']] = record['data']
+                    elif record['op'] == 'del':
+                        self.sessions.pop(record['id'], None)
+                    else:
+                        raise ValueError(f"unknown op {record['op']}")
+                    replayed += 1
+                except Exception as e:
+                    # A crash while appending can leave a partial last line behind
+                    logger.warning("Skipping invalid record at line %s of %s. Error:%s", line_number, journal_file_path, e)
+        return replayed
+
+    async def open_sessions_journal(self):
+        self._journal_size = os.path.getsize(self.journal_file_path) if os.path.exists(self.journal_file_path) else 0
+        self._journal_file = AIOFile(self.journal_file_path, 'a')
+        await self._journal_file.open()
+        self._journal_writer = Writer(self._journal_file, offset=self._journal_size)
+
+    async def close_sessions_journal(self):
+        if self._journal_file is not None:
+            await self._journal_file.close()
+        self._journal_file = None
+        self._journal_writer = None
+
+    async def append_session_journal_record(self, record: dict):
+        """Append a single put/del record to the sessions journal."""
+        await self.append_session_journal_records([record])
+
+    async def append_session_journal_records(self, records: list):
+        """Append put/del records to the sessions journal in a single write."""
+        lines = ''.join(json.dumps(record, separators=(',', ':')) + '\n' for record in records)
+        async with self.journal_lock:
+            await self._journal_writer(lines)
+            self._journal_size += len(lines.encode())
+            should_compact = (self._journal_size >= self.journal_compact_threshold
+                              and self._journal_compaction_task is None)
+            if should_compact:
+                self._journal_compaction_task = asyncio.create_task(self.compact_sessions_journal())
+
+    async def compact_sessions_journal(self):
+        """Rewrite the sessions json snapshot and start a fresh journal.
+
+        The current journal is rotated to '<journal>.old' under the journal lock
+        so appends only wait for the rename. The snapshot is written in a thread
+        and the rotated journal is removed once the snapshot is safely in place.
+        If we crash in between, startup replays the snapshot, the rotated
+        journal and the new journal in that order.
+        """
+        old_journal_file_path = f"{self.journal_file_path}.old"
+        try:
+            logger.info("Compacting sessions journal of %s bytes", self._journal_size)
+            start = time.monotonic()
+            async with self.journal_lock:
+                snapshot = dict(self.sessions)
+                await self.close_sessions_journal()
+                os.replace(self.journal_file_path, old_journal_file_path)
+                await self.open_sessions_journal()
+            await self.write_sessions_to_file(snapshot)
+            os.remove(old_journal_file_path)
+            logger.info("Compacted sessions journal into %s sessions in %.3f seconds", len(snapshot), time.monotonic() - start)
+        except Exception as e:
+            logger.error("Error occured while compacting sessions journal. Error:%s", e)
+        finally:
+            self._journal_compaction_task = None
+
+
+class SqliteSessionBackend(SessionBackend):
+    """Sessions stored in a SQLite database in WAL mode.
+
+    Several processes can share the same database file. All statements run on a
+    single dedicated thread so the event loop never blocks on disk and the
+    connection is never used concurrently.
+    """
+
+    name = 'sqlite'
+
+    def __init__(self, db_path: str):
+        self.db_path = db_path
+        self._executor = None
+        self._connection = None
+
+    async def _run(self, fn, *args):
+        loop = asyncio.get_running_loop()
+        return await loop.run_in_executor(self._executor, fn, *args)
+
+    def _open(self):
+        self._connection = sqlite3.connect(self.db_path, check_same_thread=False, isolation_level=None)
+        self._connection.execute("PRAGMA journal_mode=WAL")
+        self._connection.execute("PRAGMA synchronous=NORMAL")
+        self._connection.execute("PRAGMA busy_timeout=5000")
+        self._connection.execute(
+            "CREATE TABLE IF NOT EXISTS sessions ("
+            "session_id TEXT PRIMARY KEY, "
+            "expires_at REAL, "
+            "data TEXT NOT NULL)")
+        columns = [row[1] for row in self._connection.execute("PRAGMA table_info(sessions)")]
+        if 'username' not in columns:
+            # Databases created before sessions were indexed by username
+            self._connection.execute("ALTER TABLE sessions ADD COLUMN username TEXT")
+            self._connection.execute("UPDATE sessions SET username = json_extract(data, '$.username')")
+        self._connection.execute("CREATE INDEX IF NOT EXISTS sessions_expires_at_idx ON sessions (expires_at)")
+        self._connection.execute("CREATE INDEX IF NOT EXISTS sessions_username_idx ON sessions (username)")
+        self._connection.execute(
+            "CREATE TABLE IF NOT EXISTS counters ("
+            "key TEXT PRIMARY KEY, "
+            "count INTEGER NOT NULL, "
+            "expires_at REAL NOT NULL)")
+        self._connection.execute(
+            "CREATE TABLE IF NOT EXISTS revoked_tokens ("
+            "token_id TEXT PRIMARY KEY, "
+            "expires_at REAL NOT NULL)")
+        self._connection.execute(
+            "CREATE INDEX IF NOT EXISTS revoked_tokens_expires_at_idx ON revoked_tokens (expires_at)")
+
+    async def open(self):
+        logger.info("Opening sessions sqlite database: %s", self.db_path)
+        self._executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix='sessions-sqlite')
+        await self._run(self._open)
+
+    async def close(self):
+        if self._connection is not None:
+            logger.info("Closing sessions sqlite database")
+            await self._run(self._connection.close)
+            self._connection = None
+        if self._executor is not None:
+            self._executor.shutdown(wait=True)
+            self._executor = None
+
+    def _get(self, session_id: str):
+        row = self._connection.execute("SELECT data FROM sessions WHERE session_id = ?", (session_id,)).fetchone()
+        return json.loads(row[0]) if row is not None else None
+
+    def _put(self, session_id: str, data: dict):
+        self._connection.execute(
+            "INSERT OR REPLACE INTO sessions (session_id, expires_at, username, data) VALUES (?, ?, ?, ?)",
+            (session_id, data.get('expires_at'), data.get('username'), json.dumps(data, separators=(',', ':'))))
+
+    def _delete(self, session_id: str):
+        self._connection.execute("DELETE FROM sessions WHERE session_id = ?", (session_id,))
+
+    def _expire(self, session_id: str, expires_at: float):
+        self._connection.execute(
+            "UPDATE sessions SET expires_at = ?, data = json_set(data, '$.expires_at', ?) WHERE session_id = ?",
+            (expires_at, expires_at, session_id))
+
+    def _incr(self, key: str, expires_at: float) -> int:
+        # IMMEDIATE takes the write lock up front, so workers sharing the file
+        # never lose an increment between the upsert and the read
+        self._connection.execute("BEGIN IMMEDIATE")
+        try:
+            self._connection.execute("DELETE FROM counters WHERE key = ? AND expires_at <= ?", (key, time.time()))
+            self._connection.execute(
+                "INSERT INTO counters (key, count, expires_at) VALUES (?, 1, ?) "
+                "ON CONFLICT (key) DO UPDATE SET count = count + 1", (key, expires_at))
+            count = self._connection.execute("SELECT count FROM counters WHERE key = ?", (key,)).fetchone()[0]
+            self._connection.execute("COMMIT")
+            return count
+        except BaseException:
+            self._connection.execute("ROLLBACK")
+            raise
+
+    def _get_user_session_ids(self, username: str) -> list:
+        return [row[0] for row in self._connection.execute(
+            "SELECT session_id FROM sessions WHERE username = ?", (username,))]
+
+    def _count_sessions_by_user(self, now: float) -> Dict[str, int]:
+        return dict(self._connection.execute(
+            "SELECT username, COUNT(*) FROM sessions WHERE username IS NOT NULL AND expires_at > ? "
+            "GROUP BY username", (now,)).fetchall())
+
+    def _list_sessions(self, cursor: Optional[str], limit: int) -> Tuple[list, Optional[str]]:
+        rows = self._connection.execute(
+            "SELECT session_id, data FROM sessions WHERE session_id > ? ORDER BY session_id LIMIT ?",
+            ('' if cursor is None else cursor, limit)).fetchall()
+        next_cursor = rows[-1][0] if len(rows) == limit else None
+        return [(session_id, json.loads(data)) for session_id, data in rows], next_cursor
+
+    def _revoke_token(self, token_id: str, expires_at: float):
+        self._connection.execute("INSERT OR REPLACE INTO revoked_tokens (token_id, expires_at) VALUES (?, ?)",
+                                 (token_id, expires_at))
+
+    def _is_token_revoked(self, token_id: str) -> bool:
+        return self._connection.execute(
+            "SELECT 1 FROM revoked_tokens WHERE token_id = ?", (token_id,)).fetchone() is not None
+
+    def _evict_expired(self, now: float) -> int:
+        self._connection.execute("DELETE FROM counters WHERE expires_at <= ?", (now,))
+        self._connection.execute("DELETE FROM revoked_tokens WHERE expires_at <= ?", (now,))
+        return self._connection.execute("DELETE FROM sessions WHERE expires_at <= ?", (now,)).rowcount
+
+    async def get(self, session_id: str) -> Optional[dict]:
+        return await self._run(self._get, session_id)
+
+    async def put(self, session_id: str, data: dict):
+        await self._run(self._put, session_id, data)
+
+    async def delete(self, session_id: str):
+        await self._run(self._delete, session_id)
+
+    async def expire(self, session_id: str, expires_at: float):
+        await self._run(self._expire, session_id, expires_at)
+
+    async def incr(self, key: str, expires_at: float) -> int:
+        return await self._run(self._incr, key, expires_at)
+
+    async def get_user_session_ids(self, username: str) -> list:
+        return await self._run(self._get_user_session_ids, username)
+
+    async def count_sessions_by_user(self, now: float) -> Dict[str, int]:
+        return await self._run(self._count_sessions_by_user, now)
+
+    async def list_sessions(self, cursor: Optional[str], limit: int) -> Tuple[list, Optional[str]]:
+        return await self._run(self._list_sessions, cursor, limit)
+
+    async def revoke_token(self, token_id: str, expires_at: float):
+        await self._run(self._revoke_token, token_id, expires_at)
+
+    async def is_token_revoked(self, token_id: str) -> bool:
+        return await self._run(self._is_token_revoked, token_id)
+
+    async def evict_expired(self, now: float) -> int:
+        return await self._run(self._evict_expired, now)
+
+
+class InMemoryRedisPipeline:
+    """Queues commands of an InMemoryRedis and runs them back to back on execute().
+
+    Nothing else runs on the event loop in between, so like MULTI/EXEC the
+    commands apply as one step.
+    """
+
+    def __init__(self, client: 'InMemoryRedis'):
+        self._client = client
+        self._commands = []
+
+    def __getattr__(self, name):
+        command = getattr(self._client, name)
+
+        def queue(*args, **kwargs):
+            self._commands.append((command, args, kwargs))
+            return self
+        return queue
+
+    async def execute(self) -> list:
+        commands, self._commands = self._commands, []
+        return [await command(*args, **kwargs) for command, args, kwargs in commands]
+
+    async def __aenter__(self):
+        return self
+
+    async def __aexit__(self, *exc_info):
+        self._commands = []
+
+
+class InMemoryRedis:
+    """In-process stand-in for the subset of redis.asyncio.Redis used here.
+
+    Selected with the 'memory://' url. Useful for tests and local runs without
+    a Redis server; it is not shared between processes.
+    """
+
+    def __init__(self):
+        self._data = {}
+        self._expires_at = {}
+
+    def _alive(self, name: str) -> bool:
+        expires_at = self._expires_at.get(name)
+        if expires_at is not None and time.monotonic() >= expires_at:
+            self._data.pop(name, None)
+            self._expires_at.pop(name, None)
+        return name in self._data
+
+    async def get(self, name: str):
+        return self._data[name] if self._alive(name) else None
+
+    async def set(self, name: str, value, ex: Optional[int] = None, xx: bool = False):
+        if xx and not self._alive(name):
+            return None
+        self._data[name] = value.encode() if isinstance(value, str) else value
+        if ex is not None:
+            self._expires_at[name] = time.monotonic() + ex
+        else:
+            self._expires_at.pop(name, None)
+        return True
+
+    async def delete(self, *names: str) -> int:
+        deleted = 0
+        for name in names:
+            if self._alive(name):
+                deleted += 1
+            self._data.pop(name, None)
+            self._expires_at.pop(name, None)
+        return deleted
+
+    async def incr(self, name: str) -> int:
+        value = int(self._data[name]) + 1 if self._alive(name) else 1
+        self._data[name] = str(value).encode()
+        return value
+
+    async def getdel(self, name: str):
+        value = await self.get(name)
+        await self.delete(name)
+        return value
+
+    async def expire(self, name: str, time_seconds: int, nx: bool = False, gt: bool = False) -> bool:
+        if not self._alive(name):
+            return False
+        expires_at = time.monotonic() + time_seconds
+        if nx and name in self._expires_at:
+            return False
+        # Like Redis, GT treats a key without a TTL as never expiring
+        if gt and self._expires_at.get(name, math.inf) >= expires_at:
+            return False
+        self._expires_at[name] = expires_at
+        return True
+
+    async def mget(self, *names: str) -> list:
+        return [await self.get(name) for name in names]
+
+    async def sadd(self, name: str, *values: str) -> int:
+        if not self._alive(name):
+            self._data[name] = set()
+        members = self._data[name]
+        added = len(set(values) - members)
+        members.update(values)
+        return added
+
+    async def srem(self, name: str, *values: str) -> int:
+        if not self._alive(name):
+            return 0
+        members = self._data[name]
+        removed = len(members & set(values))
+        members.difference_update(values)
+        if not members:
+            await self.delete(name)
+        return removed
+
+    async def smembers(self, name: str) -> set:
+        return {value.encode() for value in self._data[name]} if self._alive(name) else set()
+
+    async def scan(self, cursor: int = 0, match: Optional[str] = None, count: Optional[int] = None):
+        names = sorted(name for name in list(self._data)
+                       if self._alive(name) and (match is None or fnmatch.fnmatchcase(name, match)))
+        end = cursor + (count or 10)
+        return (end if end < len(names) else 0), [name.encode() for name in names[cursor:end]]
+
+    def pipeline(self, transaction: bool = True) -> InMemoryRedisPipeline:
+        return InMemoryRedisPipeline(self)
+
+    async def aclose(self):
+        pass
+
+
+class RedisSessionBackend(SessionBackend):
+    """Sessions stored in a Redis-compatible server as json strings.
+
+    Keys carry a native TTL derived from the record's 'expires_at', so Redis
+    drops abandoned sessions on its own. Requires the optional 'redis' package
+    unless the in-process 'memory://' stand-in is used.
+
+    Every kind of key has its own namespace under the prefix: sessions under
+    '<prefix>id:', user sets under '<prefix>user:', counters under
+    '<prefix>counter:' and revoked tokens under '<prefix>revoked:'. A session id comes from a cookie and may contain
+    anything, so it must never be able to name a key of another kind.
+    """
+
+    name = 'redis'
+
+    def __init__(self, url: str, key_prefix: str = 'session:', client=None):
+        self.url = url
+        self.key_prefix = key_prefix
+        self.client = client
+
+    def _key(self, session_id: str) -> str:
+        return f"{self.key_prefix}id:{session_id}"
+
+    @staticmethod
+    def _ttl(expires_at) -> Optional[int]:
+        remaining = seconds_until(expires_at)
+        if remaining is None:
+            return None
+        return max(1, math.ceil(remaining))
+
+    async def open(self):
+        if self.client is None:
+            if self.url.startswith('memory://'):
+                logger.info("Using in-process redis stand-in for sessions")
+                self.client = InMemoryRedis()
+            else:
+                import redis.asyncio
+                logger.info("Connecting to redis for sessions: %s", self.url)
+                self.client = redis.asyncio.Redis.from_url(self.url)
+
+    async def close(self):
+        if self.client is not None:
+            await self.client.aclose()
+            self.client = None
+
+    async def get(self, session_id: str) -> Optional[dict]:
+        value = await self.client.get(self._key(session_id))
+        return json.loads(value) if value is not None else None
+
+    def _user_key(self, username: str) -> str:
+        return f"{self.key_prefix}user:{username}"
+
+    @staticmethod
+    def _decode(value) -> str:
+        return value.decode() if isinstance(value, bytes) else value
+
+    async def put(self, session_id: str, data: dict, only_if_exists: bool = False):
+        ttl = self._ttl(data.get('expires_at'))
+        stored = await self.client.set(self._key(session_id), json.dumps(data, separators=(',', ':')),
+                                       ex=ttl, xx=only_if_exists)
+        username = data.get('username')
+        if stored and username is not None:
+            user_key = self._user_key(username)
+            await self.client.sadd(user_key, session_id)
+            if ttl is not None:
+                # GT never sets a TTL on a key that has none, so a new set gets
+                # one with NX first. GT then only ever extends it, so the set
+                # outlives its longest-lived session.
+                if not await self.client.expire(user_key, ttl, nx=True):
+                    await self.client.expire(user_key, ttl, gt=True)
+
+    async def delete(self, session_id: str):
+        value = await self.client.getdel(self._key(session_id))
+        if value is not None:
+            username = json.loads(value).get('username')
+            if username is not None:
+                await self.client.srem(self._user_key(username), session_id)
+
+    async def _get_user_sessions(self, username: str) -> list:
+        """(session id, record) pairs of a user's live sessions, pruning deleted ids from the user set."""
+        user_key = self._user_key(username)
+        session_ids = sorted(self._decode(member) for member in await self.client.smembers(user_key))
+        if not session_ids:
+            return []
+        values = await self.client.mget(*[self._key(session_id) for session_id in session_ids])
+        stale_session_ids = [session_id for session_id, value in zip(session_ids, values) if value is None]
+        if stale_session_ids:
+            await self.client.srem(user_key, *stale_session_ids)
+        return [(session_id, json.loads(value)) for session_id, value in zip(session_ids, values)
+                if value is not None]
+
+    async def get_user_session_ids(self, username: str) -> list:
+        return [session_id for session_id, _ in await self._get_user_sessions(username)]
+
+    async def count_sessions_by_user(self, now: float) -> Dict[str, int]:
+        counts = {}
+        user_key_prefix = self._user_key('')
+        cursor = 0
+        while True:
+            cursor, keys = await self.client.scan(cursor, match=f"{user_key_prefix}*", count=500)
+            for key in keys:
+                username = self._decode(key)[len(user_key_prefix):]
+                # A key outlives its expires_at by up to a second of TTL rounding
+                count = sum(1 for _, data in await self._get_user_sessions(username)
+                            if _expires_after(data, now))
+                if count:
+                    counts[username] = count
+            if not cursor:
+                return counts
+
+    async def list_sessions(self, cursor: Optional[str], limit: int) -> Tuple[list, Optional[str]]:
+        # SCAN pages are unordered and only roughly limit long, and sessions
+        # added or removed during a listing may or may not be seen
+        session_key_prefix = self._key('')
+        scan_cursor, keys = await self.client.scan(int(cursor or 0), match=f"{session_key_prefix}*", count=limit)
+        session_ids = [self._decode(key)[len(session_key_prefix):] for key in keys]
+        sessions = []
+        if session_ids:
+            values = await self.client.mget(*[self._key(session_id) for session_id in session_ids])
+            sessions = [(session_id, json.loads(value)) for session_id, value in zip(session_ids, values)
+                        if value is not None]
+        return sessions, (str(scan_cursor) if scan_cursor else None)
+
+    async def expire(self, session_id: str, expires_at: float):
+        data = await self.get(session_id)
+        if data is not None:
+            data['expires_at'] = expires_at
+            # XX so a session deleted by another worker meanwhile is not resurrected
+            await self.put(session_id, data, only_if_exists=True)
+
+    def _counter_key(self, key: str) -> str:
+        return f"{self.key_prefix}counter:{key}"
+
+    async def incr(self, key: str, expires_at: float) -> int:
+        counter_key = self._counter_key(key)
+        # One MULTI/EXEC, so a counter never exists without its TTL; a counter
+        # left without one would keep counting and limit its key forever
+        async with self.client.pipeline(transaction=True) as pipe:
+            count, _ = await pipe.incr(counter_key).expire(counter_key, self._ttl(expires_at), nx=True).execute()
+        return count
+
+    def _revoked_token_key(self, token_id: str) -> str:
+        return f"{self.key_prefix}revoked:{token_id}"
+
+    async def revoke_token(self, token_id: str, expires_at: float):
+        await self.client.set(self._revoked_token_key(token_id), b'1', ex=self._ttl(expires_at))
+
+    async def is_token_revoked(self, token_id: str) -> bool:
+        return await self.client.get(self._revoked_token_key(token_id)) is not None
+
+    async def evict_expired(self, now: float) -> int:
+        # Keys carry their own TTL, Redis evicts them without our help
+        return 0
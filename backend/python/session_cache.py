@@ -0,0 +1,70 @@
+import time
+from collections import OrderedDict
+from typing import Optional
+
+
+class SessionValidationCache:
+    """Bounded LRU cache of validated session records, local to one worker.
+
+    An entry lives until the earlier of the session's own 'expires_at' and
+    max_ttl seconds after it was cached. max_ttl bounds how long a change made
+    by another worker (e.g. a logout) can go unnoticed here; changes made by
+    this worker must call invalidate().
+    """
+
+    def __init__(self, max_size: int, max_ttl: float):
+        self.max_size = max_size
+        self.max_ttl = max_ttl
+        self._entries = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    @property
+    def enabled(self) -> bool:
+        return self.max_size > 0
+
+    def __len__(self):
+        return len(self._entries)
+
+    def get(self, session_id: str, now: Optional[float] = None) -> Optional[dict]:
+        entry = self._entries.get(session_id)
+        if entry is None:
+            self.misses += 1
+            return None
+        record, cached_until = entry
+        if (time.time() if now is None else now) >= cached_until:
+            del self._entries[session_id]
+            self.misses += 1
+            return None
+        self._entries.move_to_end(session_id)
+        self.hits += 1
+        return record
+
+    def put(self, session_id: str, record: dict, now: Optional[float] = None):
+        if not self.enabled:
+            return
+        now = time.time() if now is None else now
+        cached_until = min(record['expires_at'], now + self.max_ttl)
+        if cached_until <= now:
+            return
+        self._entries[session_id] = (record, cached_until)
+        self._entries.move_to_end(session_id)
+        while len(self._entries) > self.max_size:
+            self._entries.popitem(last=False)
+            self.evictions += 1
+
+    def invalidate(self, session_id: str):
+        self._entries.pop(session_id, None)
+
+    def clear(self):
+        self._entries.clear()
+
+    def stats(self) -> dict:
+        return {
+            'size': len(self._entries),
+            'max_size': self.max_size,
+            'hits': self.hits,
+            'misses': self.misses,
+            'evictions': self.evictions,
+        }
@@ -0,0 +1,146 @@
+"""Session validation shared by login status, logout and the protected routes.
+
+A validator turns the session_id cookie (and, for protected routes, the
+X-CSRF-TOKEN header) into a SessionValidationResult in a single store
+lookup, or none at all for cached sessions. Signed sessions need no record,
+only a check that the token was not revoked. A validator never writes: an
+expired session is left to the sweeper and the caller decides what to do
+with a corrupted one, so the common paths cost exactly one round trip.
+
+Checks run in a fixed order and the first failure decides the status:
+no cookie, unknown or forged session, missing CSRF header, corrupted
+record, CSRF mismatch, expired.
+"""
+import hmac
+import time
+from typing import Optional
+
+from session_cache import SessionValidationCache
+from signed_tokens import SessionTokenSigner, TokenRevocationList
+
+VALID = 'valid'
+NO_COOKIE = 'no_cookie'
+INVALID = 'invalid'
+NO_CSRF_TOKEN = 'no_csrf_token'
+CORRUPTED = 'corrupted'
+CSRF_MISMATCH = 'csrf_mismatch'
+EXPIRED = 'expired'
+
+
+class SessionValidationResult:
+    """Outcome of validating one request's session.
+
+    session_id, username, csrf_token and expires_at are set whenever a
+    session record or token was found, even if it is expired. session is the
+    stored record (server mode) and claims the token claims (signed mode).
+    """
+
+    __slots__ = ('status', 'session_id', 'username', 'csrf_token', 'expires_at', 'session', 'claims')
+
+    def __init__(self, status: str, session_id: Optional[str] = None, username: Optional[str] = None,
+                 csrf_token: Optional[str] = None, expires_at: Optional[float] = None,
+                 session: Optional[dict] = None, claims: Optional[dict] = None):
+        self.status = status
+        self.session_id = session_id
+        self.username = username
+        self.csrf_token = csrf_token
+        self.expires_at = expires_at
+        self.session = session
+        self.claims = claims
+
+    @property
+    def valid(self) -> bool:
+        return self.status == VALID
+
+    def __repr__(self):
+        return f"SessionValidationResult(status={self.status!r}, username={self.username!r})"
+
+
+_NO_COOKIE_RESULT = SessionValidationResult(NO_COOKIE)
+
+
+def csrf_token_matches(expected: str, actual: str) -> bool:
+    return hmac.compare_digest(expected.encode(), actual.encode())
+
+
+class SessionValidator:
+    """Validates server-side sessions kept in a session backend.
+
+    With a validation cache, protected requests (use_cache=True) are served
+    from it and valid sessions are put back into it.
+    """
+
+    def __init__(self, backend, cache: SessionValidationCache, clock_skew_tolerance: float):
+        self.backend = backend
+        self.cache = cache
+        self.clock_skew_tolerance = clock_skew_tolerance
+
+    async def _lookup(self, session_id: str, use_cache: bool) -> Optional[dict]:
+        if use_cache and self.cache.enabled:
+            session = self.cache.get(session_id)
+            if session is not None:
+                return session
+        return await self.backend.get(session_id)
+
+    async def validate(self, session_id: Optional[str], csrf_token: Optional[str] = None,
+                       check_csrf: bool = False, use_cache: bool = False) -> SessionValidationResult:
+        if session_id is None:
+            return _NO_COOKIE_RESULT
+        session = await self._lookup(session_id, use_cache)
+        if session is None:
+            return SessionValidationResult(INVALID, session_id)
+        if check_csrf and csrf_token is None:
+            return SessionValidationResult(NO_CSRF_TOKEN, session_id, session=session)
+        username = session.get('username')
+        expected_csrf_token = session.get('csrfToken')
+        expires_at = session.get('expires_at')
+        if username is None or expected_csrf_token is None or expires_at is None:
+            return SessionValidationResult(CORRUPTED, session_id, session=session)
+        result = SessionValidationResult(VALID, session_id, username, expected_csrf_token, expires_at, session=session)
+        if check_csrf and not csrf_token_matches(result.csrf_token, csrf_token):
+            result.status = CSRF_MISMATCH
+        elif time.time() >= result.expires_at + self.clock_skew_tolerance:
+            result.status = EXPIRED
+        elif use_cache:
+            self.cache.put(session_id, session)
+        return result
+
+
+class SignedSessionValidator:
+    """Validates signed session tokens, looking up only whether they were revoked.
+
+    With a validation cache, protected requests (use_cache=True) trust a
+    token found there to be unrevoked, and unrevoked valid tokens are put
+    back into it, keyed by token id.
+    """
+
+    def __init__(self, signer: SessionTokenSigner, revocation_list: TokenRevocationList,
+                 cache: SessionValidationCache, clock_skew_tolerance: float):
+        self.signer = signer
+        self.revocation_list = revocation_list
+        self.cache = cache
+        self.clock_skew_tolerance = clock_skew_tolerance
+
+    async def _is_revoked(self, claims: dict, use_cache: bool) -> bool:
+        if use_cache and self.cache.enabled and self.cache.get(claims['jti']) is not None:
+            return False
+        return await self.revocation_list.is_revoked(claims['jti'], claims['exp'])
+
+    async def validate(self, session_id: Optional[str], csrf_token: Optional[str] = None,
+                       check_csrf: bool = False, use_cache: bool = False) -> SessionValidationResult:
+        if session_id is None:
+            return _NO_COOKIE_RESULT
+        claims = self.signer.verify(session_id)
+        if claims is None or await self._is_revoked(claims, use_cache):
+            return SessionValidationResult(INVALID)
+        result = SessionValidationResult(VALID, claims['jti'], claims['sub'], claims['csrfToken'], claims['exp'],
+                                         claims=claims)
+        if check_csrf and csrf_token is None:
+            result.status = NO_CSRF_TOKEN
+        elif check_csrf and not self.signer.csrf_token_matches(claims, csrf_token):
+            result.status = CSRF_MISMATCH
+        elif time.time() >= result.expires_at + self.clock_skew_tolerance:
+            result.status = EXPIRED
+        elif use_cache:
+            self.cache.put(claims['jti'], {'expires_at': claims['exp']})
+        return result
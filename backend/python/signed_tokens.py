@@ -0,0 +1,153 @@
+import base64
+import hashlib
+import hmac
+import json
+import secrets
+import time
+from typing import Dict, Optional
+
+from logging_setup import get_logger
+
+logger = get_logger(__name__)
+
+_TOKEN_VERSION = 'v1'
+
+
+def b64url_encode(data: bytes) -> str:
+    return base64.urlsafe_b64encode(data).rstrip(b'=').decode('ascii')
+
+
+def b64url_decode(data: str) -> bytes:
+    return base64.urlsafe_b64decode(data + '=' * (-len(data) % 4))
+
+
+def parse_signing_keys(value: str) -> Dict[str, bytes]:
+    """Parse 'kid1:secret1,kid2:secret2' into an ordered {kid: secret} dict.
+
+    The first key signs new tokens; all keys are accepted for verification, so
+    rotating means prepending a new key and dropping the oldest one once every
+    token signed with it has expired.
+    """
+    keys = {}
+    for item in value.split(','):
+        item = item.strip()
+        if not item:
+            continue
+        key_id, separator, secret = item.partition(':')
+        if not separator or not key_id or not secret or '.' in key_id:
+            raise ValueError(f"Invalid signing key entry: {key_id!r}. Expected '<kid>:<secret>'")
+        keys[key_id] = secret.encode()
+    return keys
+
+
+class SessionTokenSigner:
+    """Issues and verifies HMAC-SHA256 signed session tokens.
+
+    A token looks like 'v1.<kid>.<payload>.<signature>' where payload is the
+    base64url json {'sub': username, 'exp': epoch expiry, 'jti': token id}.
+    The CSRF token is derived from the jti with the same key, so checking the
+    X-CSRF-TOKEN header needs no stored state either.
+    """
+
+    def __init__(self, keys: Dict[str, bytes]):
+        if not keys:
+            raise ValueError("At least one signing key is required")
+        self.keys = keys
+        self.active_key_id = next(iter(keys))
+
+    def _sign(self, key: bytes, message: bytes) -> bytes:
+        return hmac.new(key, message, hashlib.sha256).digest()
+
+    def _csrf_token(self, key: bytes, token_id: str) -> str:
+        return b64url_encode(self._sign(key, b'csrf:' + token_id.encode()))[:32]
+
+    def issue(self, username: str, expires_at: float, token_id: Optional[str] = None,
+              key_id: Optional[str] = None) -> dict:
+        """Sign a token. Returns {'token', 'token_id', 'csrf_token'}.
+
+        New tokens are signed with the active key. Passing the token_id and
+        key_id ('kid' claim) of an existing token re-issues it with a new
+        expiry while keeping its CSRF token, which is derived from that key.
+        """
+        key_id = key_id or self.active_key_id
+        key = self.keys[key_id]
+        token_id = token_id or secrets.token_hex(16)
+        payload = b64url_encode(json.dumps({'sub': username, 'exp': expires_at, 'jti': token_id},
+                                           separators=(',', ':')).encode())
+        signing_input = f"{_TOKEN_VERSION}.{key_id}.{payload}"
+        signature = b64url_encode(self._sign(key, signing_input.encode()))
+        return {
+            'token': f"{signing_input}.{signature}",
+            'token_id': token_id,
+            'csrf_token': self._csrf_token(key, token_id),
+        }
+
+    def verify(self, token: str) -> Optional[dict]:
+        """Return the token claims plus its 'csrfToken' and signing key id 'kid', or None if the signature is bad.
+
+        Expiry is not checked here; callers compare 'exp' themselves so they
+        can apply the same clock-skew tolerance as server-side sessions.
+        """
+        try:
+            version, key_id, payload, signature = token.split('.')
+        except ValueError:
+            return None
+        key = self.keys.get(key_id)
+        if version != _TOKEN_VERSION or key is None:
+            return None
+        expected_signature = self._sign(key, f"{version}.{key_id}.{payload}".encode())
+        try:
+            if not hmac.compare_digest(expected_signature, b64url_decode(signature)):
+                return None
+            claims = json.loads(b64url_decode(payload))
+        except (ValueError, TypeError):
+            return None
+        if not isinstance(claims, dict) or not all(k in claims for k in ('sub', 'exp', 'jti')):
+            return None
+        claims['csrfToken'] = self._csrf_token(key, claims['jti'])
+        claims['kid'] = key_id
+        return claims
+
+    def csrf_token_matches(self, claims: dict, csrf_token: str) -> bool:
+        return hmac.compare_digest(claims['csrfToken'].encode(), csrf_token.encode())
+
+
+class TokenRevocationList:
+    """Ids of tokens revoked before their expiry, kept until they would have expired.
+
+    Revocations are written to the session backend, so every worker and node
+    sharing it sees them. Tokens this worker has seen revoked are also kept in
+    memory; a revocation never goes stale, so those are answered without a
+    store lookup until prune() drops them past their expiry. keep_for extends
+    every revocation beyond the token's expiry, e.g. by the clock skew
+    tolerance for which expired tokens are still accepted.
+    """
+
+    def __init__(self, backend, keep_for: float = 0.0):
+        self.backend = backend
+        self.keep_for = keep_for
+        self._revoked = {}
+
+    def __len__(self):
+        return len(self._revoked)
+
+    async def revoke(self, token_id: str, expires_at: float):
+        keep_until = expires_at + self.keep_for
+        self._revoked[token_id] = keep_until
+        await self.backend.revoke_token(token_id, keep_until)
+
+    async def is_revoked(self, token_id: str, expires_at: float) -> bool:
+        """Whether the token with this id and 'exp' claim was revoked, here or by another worker."""
+        if token_id in self._revoked:
+            return True
+        if not await self.backend.is_token_revoked(token_id):
+            return False
+        self._revoked[token_id] = expires_at + self.keep_for
+        return True
+
+    def prune(self, now: Optional[float] = None) -> int:
+        now = time.time() if now is None else now
+        expired = [token_id for token_id, keep_until in self._revoked.items() if keep_until <= now]
+        for token_id in expired:
+            del self._revoked[token_id]
+        return len(expired)
@@ -0,0 +1,301 @@
+"""User accounts and password verification.
+
+Users live in a JSON file loaded into a dict at startup, or in a SQLite
+table keyed by username; either way a lookup by username is a single index
+hit. Passwords are stored as scrypt hashes,
+'scrypt$<n>$<r>$<p>$<salt>$<hash>' with base64url salt and hash.
+
+scrypt is deliberately slow and memory hungry, so hashing runs on a thread
+pool (hashlib releases the GIL while deriving) and never blocks the event
+loop; logins then scale with cores. Recent verification results are cached
+for a short time, keyed by an HMAC of the password under a per-process key,
+and concurrent verifications of the same credentials share one derivation,
+so bursts of retries cost one hash.
+
+Run 'python user_store.py set-password <username>' to add a user or change
+a password; add --admin to let the user call the session admin api.
+"""
+import asyncio
+import hashlib
+import hmac
+import json
+import os
+import secrets
+import sqlite3
+import time
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+from typing import Dict, Optional
+
+from atomic_file import write_json_atomically
+from logging_setup import get_logger
+from signed_tokens import b64url_decode, b64url_encode
+
+logger = get_logger(__name__)
+
+_HASH_SCHEME = 'scrypt'
+_SALT_BYTES = 16
+_HASH_BYTES = 32
+
+
+def derive_password_hash(password: str, salt: bytes, n: int, r: int, p: int) -> bytes:
+    # scrypt needs 128 * n * r bytes, leave headroom above that
+    return hashlib.scrypt(password.encode(), salt=salt, n=n, r=r, p=p,
+                          maxmem=256 * n * r + 1024 * 1024, dklen=_HASH_BYTES)
+
+
+def hash_password(password: str, n: int, r: int, p: int) -> str:
+    """Hash a password into its storable 'scrypt$...' form. Blocking."""
+    salt = secrets.token_bytes(_SALT_BYTES)
+    digest = derive_password_hash(password, salt, n, r, p)
+    return f"{_HASH_SCHEME}${n}${r}${p}${b64url_encode(salt)}${b64url_encode(digest)}"
+
+
+def check_password(password: str, password_hash: str) -> bool:
+    """Check a password against its stored hash in constant time. Blocking."""
+    try:
+        scheme, n, r, p, salt, expected = password_hash.split('$')
+        if scheme != _HASH_SCHEME:
+            return False
+        digest = derive_password_hash(password, b64url_decode(salt), int(n), int(r), int(p))
+        return hmac.compare_digest(digest, b64url_decode(expected))
+    except (ValueError, TypeError):
+        logger.warning("Malformed password hash found in user store")
+        return False
+
+
+class PasswordHasher:
+    """Runs scrypt hashing and verification on a thread pool with a short-lived result cache."""
+
+    def __init__(self, n: int = 2 ** 14, r: int = 8, p: int = 1, workers: Optional[int] = None,
+                 cache_ttl: float = 30.0, cache_max_size: int = 10000):
+        self.n = n
+        self.r = r
+        self.p = p
+        self.workers = workers or os.cpu_count() or 1
+        self.cache_ttl = cache_ttl
+        self.cache_max_size = cache_max_size
+        self._executor = None
+        self._cache_key = secrets.token_bytes(32)
+        self._cache = OrderedDict()
+        self._in_flight: Dict[bytes, asyncio.Future] = {}
+
+    def open(self):
+        if self._executor is None:
+            self._executor = ThreadPoolExecutor(max_workers=self.workers, thread_name_prefix='password-hasher')
+
+    def close(self):
+        if self._executor is not None:
+            self._executor.shutdown(wait=True)
+            self._executor = None
+
+    async def _run(self, fn, *args):
+        loop = asyncio.get_running_loop()
+        return await loop.run_in_executor(self._executor, fn, *args)
+
+    async def hash(self, password: str) -> str:
+        return await self._run(hash_password, password, self.n, self.r, self.p)
+
+    def needs_rehash(self, password_hash: str) -> bool:
+        return not password_hash.startswith(f"{_HASH_SCHEME}${self.n}${self.r}${self.p}$")
+
+    def _credential_key(self, username: str, password: str, password_hash: str) -> bytes:
+        # The stored hash is part of the key, so a password change invalidates cached results
+        return hmac.new(self._cache_key, '\0'.join((username, password, password_hash)).encode(),
+                        hashlib.sha256).digest()
+
+    def _cached_result(self, key: bytes) -> Optional[bool]:
+        entry = self._cache.get(key)
+        if entry is None:
+            return None
+        result, cached_until = entry
+        if time.monotonic() >= cached_until:
+            del self._cache[key]
+            return None
+        return result
+
+    def _cache_result(self, key: bytes, result: bool):
+        if self.cache_ttl <= 0 or self.cache_max_size <= 0:
+            return
+        self._cache[key] = (result, time.monotonic() + self.cache_ttl)
+        self._cache.move_to_end(key)
+        while len(self._cache) > self.cache_max_size:
+            self._cache.popitem(last=False)
+
+    async def verify(self, username: str, password: str, password_hash: str) -> bool:
+        key = self._credential_key(username, password, password_hash)
+        result = self._cached_result(key)
+        if result is not None:
+            return result
+        in_flight = self._in_flight.get(key)
+        if in_flight is None:
+            in_flight = asyncio.ensure_future(self._run(check_password, password, password_hash))
+            in_flight.add_done_callback(lambda future: self._verification_done(key, future))
+            self._in_flight[key] = in_flight
+        # Shielded, so one caller going away does not cancel the others' result
+        return await asyncio.shield(in_flight)
+
+    def _verification_done(self, key: bytes, future: asyncio.Future):
+        del self._in_flight[key]
+        if not future.cancelled() and future.exception() is None:
+            self._cache_result(key, future.result())
+
+
+class UserStore:
+    """Async interface of a user store. User records are dicts with at least 'password_hash'."""
+
+    name = 'base'
+
+    async def open(self):
+        pass
+
+    async def close(self):
+        pass
+
+    async def get_user(self, username: str) -> Optional[dict]:
+        raise NotImplementedError
+
+    async def put_user(self, username: str, user: dict):
+        raise NotImplementedError
+
+    async def count(self) -> int:
+        raise NotImplementedError
+
+
+class JsonFileUserStore(UserStore):
+    """Users kept in a dict loaded from a json file {username: record}.
+
+    Writes rewrite the whole file atomically. They are rare: a user is added,
+    a password changes or an old hash is upgraded to the current parameters.
+    """
+
+    name = 'json'
+
+    def __init__(self, file_path: str):
+        self.file_path = file_path
+        self.users: Dict[str, dict] = {}
+        # Created in open() or on first use, inside the event loop the store runs on
+        self._write_lock = None
+
+    @property
+    def write_lock(self) -> asyncio.Lock:
+        if self._write_lock is None:
+            self._write_lock = asyncio.Lock()
+        return self._write_lock
+
+    async def open(self):
+        self._write_lock = asyncio.Lock()
+        logger.info("Loading users from: %s", self.file_path)
+        if os.path.exists(self.file_path):
+            self.users = await asyncio.to_thread(self.read_users_file)
+        logger.info("Loaded %s users", len(self.users))
+
+    def read_users_file(self) -> Dict[str, dict]:
+        with open(self.file_path) as fp:
+            return json.load(fp)
+
+    def write_users_file(self, content: dict):
+        """Atomically replace the users json file. Blocking, run it in a thread."""
+        write_json_atomically(self.file_path, content, indent=2)
+
+    async def get_user(self, username: str) -> Optional[dict]:
+        return self.users.get(username)
+
+    async def put_user(self, username: str, user: dict):
+        async with self.write_lock:
+            self.users[username] = user
+            await asyncio.to_thread(self.write_users_file, dict(self.users))
+
+    async def count(self) -> int:
+        return len(self.users)
+
+
+class SqliteUserStore(UserStore):
+    """Users in a SQLite table keyed by username, queried on one dedicated thread."""
+
+    name = 'sqlite'
+
+    def __init__(self, db_path: str):
+        self.db_path = db_path
+        self._executor = None
+        self._connection = None
+
+    async def _run(self, fn, *args):
+        loop = asyncio.get_running_loop()
+        return await loop.run_in_executor(self._executor, fn, *args)
+
+    def _open(self):
+        self._connection = sqlite3.connect(self.db_path, check_same_thread=False, isolation_level=None)
+        self._connection.execute("PRAGMA journal_mode=WAL")
+        self._connection.execute("PRAGMA busy_timeout=5000")
+        self._connection.execute(
+            "CREATE TABLE IF NOT EXISTS users ("
+            "username TEXT PRIMARY KEY, "
+            "data TEXT NOT NULL)")
+
+    async def open(self):
+        logger.info("Opening users sqlite database: %s", self.db_path)
+        self._executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix='users-sqlite')
+        await self._run(self._open)
+
+    async def close(self):
+        if self._connection is not None:
+            await self._run(self._connection.close)
+            self._connection = None
+        if self._executor is not None:
+            self._executor.shutdown(wait=True)
+            self._executor = None
+
+    def _get_user(self, username: str):
+        row = self._connection.execute("SELECT data FROM users WHERE username = ?", (username,)).fetchone()
+        return json.loads(row[0]) if row is not None else None
+
+    def _put_user(self, username: str, user: dict):
+        self._connection.execute("INSERT OR REPLACE INTO users (username, data) VALUES (?, ?)",
+                                 (username, json.dumps(user, separators=(',', ':'))))
+
+    def _count(self) -> int:
+        return self._connection.execute("SELECT COUNT(*) FROM users").fetchone()[0]
+
+    async def get_user(self, username: str) -> Optional[dict]:
+        return await self._run(self._get_user, username)
+
+    async def put_user(self, username: str, user: dict):
+        await self._run(self._put_user, username, user)
+
+    async def count(self) -> int:
+        return await self._run(self._count)
+
+
+if __name__ == '__main__':
+    import argparse
+    import getpass
+
+    import main
+
+    parser = argparse.ArgumentParser(description="Manage users of the configured user store")
+    subparsers = parser.add_subparsers(dest='command', required=True)
+    set_password_parser = subparsers.add_parser('set-password', help='add a user or change its password')
+    set_password_parser.add_argument('username')
+    set_password_parser.add_argument('--admin', action=argparse.BooleanOptionalAction, default=None,
+                                     help='grant (--admin) or withdraw (--no-admin) access to the session admin api')
+    args = parser.parse_args()
+
+    async def set_password(username: str, is_admin: Optional[bool]):
+        password = getpass.getpass(f"New password for {username}: ")
+        if password != getpass.getpass("Repeat password: "):
+            raise SystemExit("Passwords do not match")
+        await main.user_store.open()
+        main.password_hasher.open()
+        try:
+            user = await main.user_store.get_user(username) or {}
+            user['password_hash'] = await main.password_hasher.hash(password)
+            if is_admin is not None:
+                user['is_admin'] = is_admin
+            await main.user_store.put_user(username, user)
+        finally:
+            main.password_hasher.close()
+            await main.user_store.close()
+        print(f"Password set for user: {username}")
+
+    asyncio.run(set_password(args.username, args.admin))
@@ -1,19 +1,22 @@
-from fastapi import FastAPI
+from fastapi import FastAPI, Request
 from fastapi.middleware.cors import CORSMiddleware
-from fastapi.responses import HTMLResponse, FileResponse
-from aiofile import AIOFile
-import logging
+from fastapi.responses import HTMLResponse, PlainTextResponse
 import os
+from logging_setup import get_logger, LogContextMiddleware
+from asset_cache import AssetCache
+from metrics import MetricsMiddleware, registry as metrics_registry
 
 
-logLevel = logging.INFO
-logger = logging.getLogger(__name__)
-logger.setLevel(logLevel)
-ch = logging.StreamHandler()
-ch.setLevel(logLevel)
-formatter = logging.Formatter('%(asctime)s - %(name)s - %(levelname)s - %(message)s')
-ch.setFormatter(formatter)
-logger.addHandler(ch)
+logger = get_logger(__name__)
+
+_UI_ASSETS_DIR = os.environ.get('UI_ASSETS_DIR', 'ui')
+_UI_ASSETS_RELOAD = os.environ.get('UI_ASSETS_RELOAD', 'false').lower() in ('1', 'true', 'yes')
+_UI_STATIC_MAX_AGE_SECONDS = int(os.environ.get('UI_STATIC_MAX_AGE_SECONDS', '31536000'))
+_METRICS_ENABLED = os.environ.get('METRICS_ENABLED', 'true').lower() in ('1', 'true', 'yes')
+
+logger.info("Loading UI assets from: %s (reload: %s)", _UI_ASSETS_DIR, _UI_ASSETS_RELOAD)
+asset_cache = AssetCache(_UI_ASSETS_DIR, reload=_UI_ASSETS_RELOAD, static_max_age=_UI_STATIC_MAX_AGE_SECONDS)
+asset_cache.load()
 
 logger.info("Initializing FastAPI app")
 app = FastAPI()
@@ -25,51 +28,42 @@ app.add_middleware(
     allow_headers="*",
     allow_methods="*"
 )
+app.add_middleware(LogContextMiddleware)
+if _METRICS_ENABLED:
+    app.add_middleware(MetricsMiddleware)
+
+    @app.get("/metrics")
+    async def get_metrics():
+        return PlainTextResponse(metrics_registry.render(), media_type='text/plain; version=0.0.4')
 
-async def get_file_content(file_path: str) -> str:
-    """Read the content of a file asynchronously."""
-    logger.debug(f"Attempting to read file: {file_path}")
-    try:
-        async with AIOFile(file_path, 'r') as afp:
-            content = await afp.read()
-        logger.debug(f"Successfully read file: {file_path}")
-        return content
-    except Exception as e:
-        logger.error(f"Error reading file: {file_path}. Error: {e}")
-        return f"<h1>Error loading file: {str(e)}</h1>"
-    
 @app.get("/ui/{page}")
-async def serve_ui_page(page: str):
+async def serve_ui_page(page: str, request: Request):
     """Serve a UI page."""
-    logger.info(f"Serving UI page: {page}")
+    logger.info("Serving UI page: %s", page)
     try:
-        ui_page_html_file_path = f"ui/{page}.html"
-        if os.path.exists(ui_page_html_file_path):
-            logger.debug(f"UI page file found at: {ui_page_html_file_path}")
-            content = await get_file_content(ui_page_html_file_path)
-            return HTMLResponse(content=content)
+        asset = asset_cache.get(f"{page}.html")
+        if asset is not None:
+            logger.debug("UI page found in asset cache: %s", asset.path)
+            return asset_cache.response(asset, request)
         else:
-            logger.warning(f"UI page file not found at: {ui_page_html_file_path}")
+            logger.warning("UI page not found: %s", page)
             return HTMLResponse(content="<h1>404 Not Found</h1>", status_code=404)
     except Exception as e:
-        logger.error(f"Error serving UI page: {page}. Error: {e}")
+        logger.error("Error serving UI page: %s. Error: %s", page, e)
         return HTMLResponse(content=f"<h1>Error loading page: {str(e)}</h1>", status_code=500)
     
 @app.get("/ui/static/{file_path:path}")
-async def serve_static_file(file_path: str):
+async def serve_static_file(file_path: str, request: Request):
     """Serve a static file."""
-    logger.info(f"Serving static file: {file_path}")
+    logger.info("Serving static file: %s", file_path)
     try:
-        static_file_path = f"ui/static/{file_path}"
-        if os.path.exists(static_file_path):
-            logger.debug(f"Static file found at: {static_file_path}")
-            return FileResponse(path=static_file_path)
+        asset = asset_cache.get(f"static/{file_path}")
+        if asset is not None:
+            logger.debug("Static file found in asset cache: %s", asset.path)
+            return asset_cache.response(asset, request, versioned=True)
         else:
-            logger.warning(f"Static file not found at: {static_file_path}")
+            logger.warning("Static file not found: %s", file_path)
             return HTMLResponse(content="<h1>404 Not Found</h1>", status_code=404)
     except Exception as e:
-        logger.error(f"Error serving static file: {file_path}. Error: {e}")
+        logger.error("Error serving static file: %s. Error: %s", file_path, e)
         return HTMLResponse(content=f"<h1>Error loading file: {str(e)}</h1>", status_code=500)
-        logger.error(f"Error serving static file: {file_path}. Error: {e}")
-        return HTMLResponse(content=f"<h1>Error loading file: {str(e)}</h1>", status_code=500)
-    
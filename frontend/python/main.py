@@ -1,21 +1,127 @@
 from fastapi import FastAPI, Request
 from fastapi.responses import JSONResponse
 from fastapi.middleware.cors import CORSMiddleware
-from fastapi.responses import HTMLResponse, FileResponse
-from aiofile import AIOFile
-import logging
+from fastapi.responses import HTMLResponse, StreamingResponse, PlainTextResponse
 import os
+import asyncio
 import aiohttp
+from logging_setup import get_logger, LogContextMiddleware, current_trace_id
+from metrics import MetricsMiddleware, registry as metrics_registry, span
+from asset_cache import AssetCache
 
 
-logLevel = logging.INFO
-logger = logging.getLogger(__name__)
-logger.setLevel(logLevel)
-ch = logging.StreamHandler()
-ch.setLevel(logLevel)
-formatter = logging.Formatter('%(asctime)s - %(name)s - %(levelname)s - %(message)s')
-ch.setFormatter(formatter)
-logger.addHandler(ch)
+logger = get_logger(__name__)
+
+_BACKEND_BASE_URL = os.environ.get('BACKEND_BASE_URL', 'http://localhost:8000')
+_BACKEND_CONNECTION_LIMIT = int(os.environ.get('BACKEND_CONNECTION_LIMIT', '100'))
+_BACKEND_CONNECTION_LIMIT_PER_HOST = int(os.environ.get('BACKEND_CONNECTION_LIMIT_PER_HOST', '50'))
+_BACKEND_KEEPALIVE_TIMEOUT_SECONDS = float(os.environ.get('BACKEND_KEEPALIVE_TIMEOUT_SECONDS', '30'))
+_BACKEND_CONNECT_TIMEOUT_SECONDS = float(os.environ.get('BACKEND_CONNECT_TIMEOUT_SECONDS', '5'))
+_BACKEND_TOTAL_TIMEOUT_SECONDS = float(os.environ.get('BACKEND_TOTAL_TIMEOUT_SECONDS', '30'))
+_PROXY_CHUNK_SIZE = 64 * 1024
+_UI_ASSETS_DIR = os.environ.get('UI_ASSETS_DIR', 'ui')
+_UI_ASSETS_RELOAD = os.environ.get('UI_ASSETS_RELOAD', 'false').lower() in ('1', 'true', 'yes')
+_UI_STATIC_MAX_AGE_SECONDS = int(os.environ.get('UI_STATIC_MAX_AGE_SECONDS', '31536000'))
+_METRICS_ENABLED = os.environ.get('METRICS_ENABLED', 'true').lower() in ('1', 'true', 'yes')
+
+# Only these inbound headers are forwarded to the backend, everything else
+# (Host, Origin, Connection, ...) stays on this hop.
+_FORWARDED_REQUEST_HEADERS = frozenset([
+    'accept',
+    'accept-encoding',
+    'content-type',
+    'cookie',
+    'user-agent',
+    'x-csrf-token',
+])
+_FORWARDED_RESPONSE_HEADERS = frozenset([
+    'cache-control',
+    'content-encoding',
+    'content-type',
+    'etag',
+    'server-timing',
+    'set-cookie',
+    'x-next-cursor',
+    'x-total-count',
+])
+
+logger.info("Loading UI assets from: %s (reload: %s)", _UI_ASSETS_DIR, _UI_ASSETS_RELOAD)
+asset_cache = AssetCache(_UI_ASSETS_DIR, reload=_UI_ASSETS_RELOAD, static_max_age=_UI_STATIC_MAX_AGE_SECONDS)
+asset_cache.load()
+
+# App-lifetime client for calls to the backend, opened on startup
+backend_client_session = None
+
+async def startup_event_handler():
+    global backend_client_session
+    logger.info("Running the startup event handler")
+    logger.info("Opening backend client session with connection limit: %s, per host: %s",
+                _BACKEND_CONNECTION_LIMIT, _BACKEND_CONNECTION_LIMIT_PER_HOST)
+    connector = aiohttp.TCPConnector(limit=_BACKEND_CONNECTION_LIMIT,
+                                     limit_per_host=_BACKEND_CONNECTION_LIMIT_PER_HOST,
+                                     keepalive_timeout=_BACKEND_KEEPALIVE_TIMEOUT_SECONDS,
+                                     ttl_dns_cache=300)
+    timeout = aiohttp.ClientTimeout(total=_BACKEND_TOTAL_TIMEOUT_SECONDS, connect=_BACKEND_CONNECT_TIMEOUT_SECONDS)
+    # The session is shared by all users: never keep cookies in it, and pass
+    # compressed bodies through untouched.
+    backend_client_session = aiohttp.ClientSession(connector=connector,
+                                                   timeout=timeout,
+                                                   cookie_jar=aiohttp.DummyCookieJar(),
+                                                   auto_decompress=False)
+    logger.info("startup event handler completed successfully")
+
+async def shutdown_event_handler():
+    logger.info("Running the shutdown event handler")
+    if backend_client_session is not None:
+        logger.info("Closing backend client session")
+        await backend_client_session.close()
+    logger.info("shutdown event handler completed successfully")
+
+def get_forwarded_request_headers(request: Request) -> dict:
+    headers = {key: value for key, value in request.headers.items() if key in _FORWARDED_REQUEST_HEADERS}
+    # Carry this request's trace id to the backend so both logs can be joined
+    trace_id = current_trace_id.get()
+    if trace_id is not None:
+        headers['x-trace-id'] = trace_id
+    return headers
+
+def get_forwarded_response_headers(response: aiohttp.ClientResponse) -> list:
+    return [(key, value) for key, value in response.headers.items() if key.lower() in _FORWARDED_RESPONSE_HEADERS]
+
+async def stream_backend_response(response: aiohttp.ClientResponse):
+    try:
+        async for chunk in response.content.iter_chunked(_PROXY_CHUNK_SIZE):
+            yield chunk
+    finally:
+        response.release()
+
+def build_streaming_response(response: aiohttp.ClientResponse) -> StreamingResponse:
+    streaming_response = StreamingResponse(stream_backend_response(response), status_code=response.status)
+    streaming_response.raw_headers.extend((key.lower().encode('latin-1'), value.encode('latin-1'))
+                                          for key, value in get_forwarded_response_headers(response))
+    return streaming_response
+
+async def proxy_request_to_backend(request: Request, backend_path: str):
+    """Forward a request to the backend and stream the response back unbuffered."""
+    url = f"{_BACKEND_BASE_URL}{backend_path}"
+    logger.info("Proxying %s request to backend URL: %s", request.method, url)
+    body = await request.body() if request.method not in ('GET', 'HEAD') else None
+    try:
+        with span('backend'):
+            # multi_items keeps repeated keys, e.g. ?id=1&id=2
+            response = await backend_client_session.request(request.method, url,
+                                                            params=request.query_params.multi_items(),
+                                                            headers=get_forwarded_request_headers(request),
+                                                            data=body,
+                                                            allow_redirects=False)
+    except asyncio.TimeoutError:
+        logger.error("Timed out calling backend URL: %s", url)
+        return JSONResponse(status_code=504, content={"error": "Backend timed out"})
+    except aiohttp.ClientError as e:
+        logger.error("Error calling backend URL: %s. Error: %s", url, e)
+        return JSONResponse(status_code=502, content={"error": "Backend unavailable"})
+    logger.info("Received response with status: %s", response.status)
+    return build_streaming_response(response)
 
 logger.info("Initializing FastAPI app")
 app = FastAPI()
@@ -28,74 +134,78 @@ app.add_middleware(
     allow_headers="*",
     allow_methods="*"
 )
-
-async def get_file_content(file_path: str) -> str:
-    """Read the content of a file asynchronously."""
-    logger.debug(f"Attempting to read file: {file_path}")
-    try:
-        async with AIOFile(file_path, 'r') as afp:
-            content = await afp.read()
-        logger.debug(f"Successfully read file: {file_path}")
-        return content
-    except Exception as e:
-        logger.error(f"Error reading file: {file_path}. Error: {e}")
-        return f"<h1>Error loading file: {str(e)}</h1>"
-
+app.add_middleware(LogContextMiddleware)
+if _METRICS_ENABLED:
+    app.add_middleware(MetricsMiddleware)
 
 @app.get("/ui/{page}")
-async def serve_ui_page(page: str):
+async def serve_ui_page(page: str, request: Request):
     """Serve a UI page."""
-    logger.info(f"Serving UI page: {page}")
+    logger.info("Serving UI page: %s", page)
     try:
-        ui_page_html_file_path = f"ui/{page}.html"
-        if os.path.exists(ui_page_html_file_path):
-            logger.debug(f"UI page file found at: {ui_page_html_file_path}")
-            content = await get_file_content(ui_page_html_file_path)
-            return HTMLResponse(content=content)
+        asset = asset_cache.get(f"{page}.html")
+        if asset is not None:
+            logger.debug("UI page found in asset cache: %s", asset.path)
+            return asset_cache.response(asset, request)
         else:
-            logger.warning(f"UI page file not found at: {ui_page_html_file_path}")
+            logger.warning("UI page not found: %s", page)
             return HTMLResponse(content="<h1>404 Not Found</h1>", status_code=404)
     except Exception as e:
-        logger.error(f"Error serving UI page: {page}. Error: {e}")
+        logger.error("Error serving UI page: %s. Error: %s", page, e)
         return HTMLResponse(content=f"<h1>Error loading page: {str(e)}</h1>", status_code=500)
 
 @app.get("/ui/static/{file_path:path}")
-async def serve_static_file(file_path: str):
+async def serve_static_file(file_path: str, request: Request):
     """Serve a static file."""
-    logger.info(f"Serving static file: {file_path}")
+    logger.info("Serving static file: %s", file_path)
     try:
-        static_file_full_path = f"ui/static/{file_path}"
-        if os.path.exists(static_file_full_path):
-            logger.debug(f"Static file found at: {static_file_full_path}")
-            return FileResponse(static_file_full_path)
+        asset = asset_cache.get(f"static/{file_path}")
+        if asset is not None:
+            logger.debug("Static file found in asset cache: %s", asset.path)
+            return asset_cache.response(asset, request, versioned=True)
         else:
-            logger.warning(f"Static file not found at: {static_file_full_path}")
+            logger.warning("Static file not found: %s", file_path)
             return HTMLResponse(content="<h1>404 Not Found</h1>", status_code=404)
     except Exception as e:
-        logger.error(f"Error serving static file: {file_path}. Error: {e}")
+        logger.error("Error serving static file: %s. Error: %s", file_path, e)
         return HTMLResponse(content=f"<h1>Error loading file: {str(e)}</h1>", status_code=500)
 
 @app.get("/ui/protected/resources")
 async def get_all_resources(request: Request):
     logger.info("Request received: GET /ui/protected/resources")
     
-    url = "http://localhost:8000/api/v1/protected/resources"
-    logger.info(f"Fetching protected resources from URL: {url}")
+    url = f"{_BACKEND_BASE_URL}/api/v1/protected/resources"
+    logger.info("Fetching protected resources from URL: %s", url)
     
     try:
-        async with aiohttp.ClientSession() as session:
-            async with session.get(url=url, headers=request.headers) as response:
-                logger.info(f"Received response with status: {response.status}")
-                
-                if response.status == 200:
-                    data = await response.json()
-                    logger.info(f"Successfully retrieved {data}")
-                    return data
-                else:
-                    # Log detailed info for non-200 responses
-                    text = await response.text()
-                    logger.warning(f"Failed to retrieve resources. Status: {response.status}, Response: {text}")
-                    return JSONResponse(status_code=response.status, content={"error": f"{text}"})
+        with span('backend'):
+            # multi_items keeps repeated keys, e.g. ?fields=a&fields=b
+            response = await backend_client_session.get(url=url, params=request.query_params.multi_items(),
+                                                        headers=get_forwarded_request_headers(request))
+        logger.info("Received response with status: %s", response.status)
+
+        if response.status == 200:
+            return build_streaming_response(response)
+        else:
+            # Log detailed info for non-200 responses
+            async with response:
+                text = await response.text()
+            logger.warning("Failed to retrieve resources. Status: %s, Response: %s", response.status, text)
+            return JSONResponse(status_code=response.status, content={"error": f"{text}"})
     except Exception as e:
-        logger.error(f"Exception occurred while retrieving resources: {e}")
+        logger.error("Exception occurred while retrieving resources: %s", e)
         return JSONResponse(status_code=500, content={"error": "Internal Server Error"})
+
+@app.api_route("/api/v1/protected/{path:path}", methods=["GET", "POST", "PUT", "PATCH", "DELETE"])
+async def proxy_protected_api_request(path: str, request: Request):
+    """Stream any protected API call through to the backend."""
+    return await proxy_request_to_backend(request, backend_path=f"/api/v1/protected/{path}")
+
+if _METRICS_ENABLED:
+    @app.get("/metrics")
+    async def get_metrics():
+        return PlainTextResponse(metrics_registry.render(), media_type='text/plain; version=0.0.4')
+
+logger.info("Adding event handlers")
+app.add_event_handler('startup', startup_event_handler)
+app.add_event_handler('shutdown', shutdown_event_handler)
@@ -1,9 +1,24 @@
+// The login status is cached in sessionStorage until shortly before the
+// session expires, so page loads and navigation do not ask the backend again.
+const LOGIN_STATUS_STORAGE_KEY = "loginStatus";
+// The cached status is refreshed this long before the session expires
+const LOGIN_STATUS_REFRESH_MARGIN_MS = 5000;
+
 const state = {
     isLoggedIn: null,
     sessionId: null,
-    csrfToken: null
+    csrfToken: null,
+    // Epoch milliseconds at which the session expires, by this browser's clock
+    expiresAt: null,
+    // When the status was last received from the backend
+    updatedAt: null
 };
 
+// Promises of the requests in flight, by name, so concurrent callers share one request
+const inFlightRequests = new Map();
+let loginStatusRefreshTimer = null;
+let lastUserActivityAt = Date.now();
+
 main();
 
 function main(){
@@ -15,6 +30,27 @@ function addEventHandlers(){
     addLoginButtonClickEventHandler();
     addLogoutButtonClickEventHandler();
     addViewAllProtectedResourcesButtonClickEventHandler();
+    addUserActivityEventHandlers();
+}
+
+function addUserActivityEventHandlers(){
+    for(const eventType of ["click", "keydown"]){
+        document.addEventListener(eventType, () => {
+            lastUserActivityAt = Date.now();
+        }, {passive: true});
+    }
+}
+
+function coalesceRequest(name, sendRequest){
+    const inFlightRequest = inFlightRequests.get(name);
+    if(inFlightRequest !== undefined){
+        return inFlightRequest;
+    }
+    const request = sendRequest().finally(() => {
+        inFlightRequests.delete(name);
+    });
+    inFlightRequests.set(name, request);
+    return request;
 }
 
 function addLoginButtonClickEventHandler(){
@@ -84,6 +120,15 @@ async function callGetAllProtectedResourcesAPI(){
     return response
 }
 
+async function getAllProtectedResources(){
+    // Read the body inside the shared request, a response body can only be read once
+    return coalesceRequest("protectedResources", async () => {
+        const response = await callGetAllProtectedResourcesAPI();
+        const data = response.ok ? await response.json() : null;
+        return {ok: response.ok, status: response.status, data: data};
+    });
+}
+
 async function setIsLoggedIn(isLoggedIn){
     state.isLoggedIn = isLoggedIn;
 }
@@ -96,28 +141,110 @@ async function setCsrfToken(csrfToken){
     state.csrfToken = csrfToken;
 }
 
-async function checkLoginStatusAndUpdateState(){
+function setLoggedInState(sessionId, csrfToken, expiresIn){
+    setIsLoggedIn(true);
+    setSessionId(sessionId);
+    setCsrfToken(csrfToken);
+    state.updatedAt = Date.now();
+    state.expiresAt = expiresIn === null ? null : state.updatedAt + expiresIn * 1000;
+    if(state.expiresAt === null){
+        sessionStorage.removeItem(LOGIN_STATUS_STORAGE_KEY);
+    }else{
+        sessionStorage.setItem(LOGIN_STATUS_STORAGE_KEY, JSON.stringify({
+            sessionId: sessionId,
+            csrfToken: csrfToken,
+            expiresAt: state.expiresAt,
+            updatedAt: state.updatedAt
+        }));
+    }
+}
+
+function setLoggedOutState(){
+    setIsLoggedIn(false);
+    setSessionId(null);
+    setCsrfToken(null);
+    state.expiresAt = null;
+    state.updatedAt = Date.now();
+    sessionStorage.removeItem(LOGIN_STATUS_STORAGE_KEY);
+}
+
+function loadCachedLoginStatus(){
+    let cached = null;
+    try{
+        cached = JSON.parse(sessionStorage.getItem(LOGIN_STATUS_STORAGE_KEY));
+    }catch(error){
+        sessionStorage.removeItem(LOGIN_STATUS_STORAGE_KEY);
+    }
+    if(cached === null || !(cached.expiresAt - LOGIN_STATUS_REFRESH_MARGIN_MS > Date.now())){
+        return false;
+    }
+    setIsLoggedIn(true);
+    setSessionId(cached.sessionId);
+    setCsrfToken(cached.csrfToken);
+    state.expiresAt = cached.expiresAt;
+    state.updatedAt = cached.updatedAt;
+    return true;
+}
+
+async function fetchLoginStatusAndUpdateState(){
     const loginStatusResponse = await callLoginStatusAPI();
     if(!loginStatusResponse.ok){
-        setIsLoggedIn(false);
-        setSessionId(null);
-        setCsrfToken(null);
+        setLoggedOutState();
     }else{
         const data = await loginStatusResponse.json();
         const sessionId = data?.sessionId ?? null;
         const csrfToken = data?.csrfToken ?? null;
         if(sessionId === null){
             console.log("User is not logged in");
-            setIsLoggedIn(false);
-            setSessionId(null);
-            setCsrfToken(null);
+            setLoggedOutState();
         }else{
             console.log("User is logged in");
-            setIsLoggedIn(true);
-            setSessionId(sessionId);
-            setCsrfToken(csrfToken);
+            setLoggedInState(sessionId, csrfToken, data?.expiresIn ?? null);
         }
     }
+}
+
+async function refreshLoginStatus(){
+    await coalesceRequest("loginStatus", fetchLoginStatusAndUpdateState);
+    scheduleLoginStatusRefresh();
+}
+
+async function checkLoginStatusAndUpdateState(){
+    if(loadCachedLoginStatus()){
+        console.log("User is logged in (cached)");
+        scheduleLoginStatusRefresh();
+    }else{
+        await refreshLoginStatus();
+    }
+    redirectUIBasedOnLoginState();
+}
+
+function scheduleLoginStatusRefresh(){
+    clearTimeout(loginStatusRefreshTimer);
+    loginStatusRefreshTimer = null;
+    if(state.isLoggedIn !== true || state.expiresAt === null){
+        return;
+    }
+    const remaining = state.expiresAt - Date.now();
+    // Refresh just before expiry. A session that was not extended since is
+    // checked again once it has expired, instead of over and over until then.
+    const delay = remaining > LOGIN_STATUS_REFRESH_MARGIN_MS
+        ? remaining - LOGIN_STATUS_REFRESH_MARGIN_MS
+        : remaining + LOGIN_STATUS_REFRESH_MARGIN_MS;
+    loginStatusRefreshTimer = setTimeout(loginStatusRefreshTimerHandler, Math.max(0, delay));
+}
+
+async function loginStatusRefreshTimerHandler(){
+    loginStatusRefreshTimer = null;
+    // A status request can slide the session's expiry forward, so an idle page
+    // waits for the session to expire rather than keeping it alive
+    const idle = lastUserActivityAt < state.updatedAt;
+    const remaining = state.expiresAt - Date.now();
+    if(idle && remaining > 0){
+        loginStatusRefreshTimer = setTimeout(loginStatusRefreshTimerHandler, remaining + LOGIN_STATUS_REFRESH_MARGIN_MS);
+        return;
+    }
+    await refreshLoginStatus();
     redirectUIBasedOnLoginState();
 }
 
@@ -146,13 +273,18 @@ function loginButtonClickEventHandler(event){
 
 async function viewAllProtectedResourcesButtonClickEventHandler(event){
     event.preventDefault();
-    const response = await callGetAllProtectedResourcesAPI();
+    const response = await getAllProtectedResources();
     if(!response.ok){
         displayToast('Unable To View All protected resources', 'failure', 10000);
+        if(response.status === 401){
+            // The cached status is stale, e.g. the session was ended in another tab
+            sessionStorage.removeItem(LOGIN_STATUS_STORAGE_KEY);
+            await refreshLoginStatus();
+            redirectUIBasedOnLoginState();
+        }
     }else{
         displayToast('Success', 'success', 10000);
-        const data = await response.json();
-        const resources = data?.items ?? [];
+        const resources = response.data?.items ?? [];
         displayProtectedResourcesTable(resources);
     }
 }
@@ -185,11 +317,10 @@ async function logoutButtonClickEventHandler(event){
     event.preventDefault();
     const logoutResponse = await callLogoutAPI();
     if(!logoutResponse.ok){
+        sessionStorage.removeItem(LOGIN_STATUS_STORAGE_KEY);
         window.location.replace(window.location.pathname);
     }else{
-        setIsLoggedIn(false);
-        setSessionId(null);
-        setCsrfToken(null);
+        setLoggedOutState();
         window.location.replace('/ui/login');
     }
 }
@@ -201,22 +332,17 @@ async function loginFormSubmitEventHandler(event){
     const loginResponse = await callLoginAPI(username, password);
     if(!loginResponse.ok){
         displayToast('Login Failed! Pls Check username and password', 'failure', 10000);
-        setIsLoggedIn(false);
-        setCsrfToken(null);
-        setSessionId(null);
+        setLoggedOutState();
     }else{
         const data = await loginResponse.json();
         const sessionId = data?.sessionId ?? null;
         const csrfToken = data?.csrfToken ?? null;
         if(sessionId === null || csrfToken === null){
-            setIsLoggedIn(false);
-            setCsrfToken(null);
-            setSessionId(null);
+            setLoggedOutState();
             displayToast('Login Failed! No Csrf Token and session id', 'failure', 10000);
         }else{
-            setIsLoggedIn(true);
-            setCsrfToken(csrfToken);
-            setSessionId(sessionId);
+            // Cached, so the home page loads without asking for the status again
+            setLoggedInState(sessionId, csrfToken, data?.expiresIn ?? null);
             displayToast('Login Success', 'success', 5000);
             window.location.replace("/ui/home");
         }
@@ -0,0 +1,75 @@
+"""Copy the modules shared by the services from shared/python into each service.
+
+Every service runs from its own directory and is deployed on its own, so it
+keeps a copy of the shared modules next to its main.py. shared/python holds
+the one copy that is edited; this script writes it into every service that
+uses it, behind a header saying where it comes from.
+
+Run from the repository root after editing a shared module:
+
+    python scripts/sync_shared_modules.py
+
+--check changes nothing and exits with status 1 if a service copy differs
+from its shared module, e.g. after a copy was edited by hand; run it in CI.
+"""
+import argparse
+import os
+import sys
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+SHARED_DIR = os.path.join('shared', 'python')
+
+# Shared module -> service directories keeping a copy of it
+SHARED_MODULES = {
+    'logging_setup.py': ('backend/python', 'frontend/python', 'csrf_attacker_frontend/python'),
+    'metrics.py': ('backend/python', 'frontend/python', 'csrf_attacker_frontend/python'),
+    'asset_cache.py': ('frontend/python', 'csrf_attacker_frontend/python'),
+}
+
+HEADER = ("# Copied from {source} by scripts/sync_shared_modules.py. Do not edit this copy:\n"
+          "# edit {source} and run the script again.\n")
+
+
+def vendored_content(module: str) -> str:
+    source = f"{SHARED_DIR}/{module}"
+    with open(os.path.join(ROOT, source)) as fp:
+        return HEADER.format(source=source) + fp.read()
+
+
+def read_or_none(path: str):
+    try:
+        with open(path) as fp:
+            return fp.read()
+    except FileNotFoundError:
+        return None
+
+
+def sync(check: bool) -> list:
+    """Write every stale copy, or only list them with check. Returns the stale copies."""
+    stale = []
+    for module, service_dirs in SHARED_MODULES.items():
+        content = vendored_content(module)
+        for service_dir in service_dirs:
+            path = os.path.join(ROOT, service_dir, module)
+            if read_or_none(path) == content:
+                continue
+            stale.append(f"{service_dir}/{module}")
+            if not check:
+                with open(path, 'w') as fp:
+                    fp.write(content)
+    return stale
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--check', action='store_true', help='only report copies that differ from shared/python')
+    return parser.parse_args()
+
+
+if __name__ == '__main__':
+    args = parse_args()
+    stale_copies = sync(args.check)
+    for stale_copy in stale_copies:
+        print(f"{'Out of date' if args.check else 'Updated'}: {stale_copy}")
+    if args.check and stale_copies:
+        sys.exit(f"{len(stale_copies)} copies differ from {SHARED_DIR}, run python scripts/sync_shared_modules.py")
@@ -0,0 +1,192 @@
+"""In-memory cache of the ui/ tree with precompressed variants and ETags.
+
+Every file under the root is read once, hashed (sha256) and, for text types,
+compressed with gzip and, when the optional 'brotli' package is installed,
+brotli. Serving a page or static file is then a dict lookup: the variant is
+picked from Accept-Encoding and If-None-Match is answered with 304.
+
+Pages reference static files as 'static/<name>'; those references are
+rewritten to 'static/<name>?v=<hash>' so a request carrying the current hash
+can be cached by the browser for a year, while everything else is served with
+'no-cache' and revalidated through its ETag.
+
+With reload enabled (development), the tree is re-scanned at most once per
+reload interval and changed, added or removed files are picked up.
+"""
+import gzip
+import hashlib
+import mimetypes
+import os
+import re
+import threading
+import time
+from typing import Dict, Optional
+
+from starlette.requests import Request
+from starlette.responses import Response
+
+from logging_setup import get_logger
+
+try:
+    import brotli
+except ImportError:
+    brotli = None
+
+logger = get_logger(__name__)
+
+_COMPRESSIBLE_TYPES = ('text/', 'application/javascript', 'application/json', 'image/svg+xml')
+_COMPRESS_MIN_BYTES = 256
+_STATIC_REFERENCE_PATTERN = re.compile(r'''((?:src|href)=["'])(static/[^"'?#]+)(["'])''')
+
+
+class Asset:
+    """One file of the tree with its encoded variants."""
+
+    def __init__(self, path: str, body: bytes, media_type: str, mtime: float):
+        self.path = path
+        self.media_type = media_type
+        self.mtime = mtime
+        self.version = hashlib.sha256(body).hexdigest()[:16]
+        self.variants = {'identity': body}
+        if media_type.startswith(_COMPRESSIBLE_TYPES) and len(body) >= _COMPRESS_MIN_BYTES:
+            compressed = gzip.compress(body, compresslevel=9, mtime=0)
+            if len(compressed) < len(body):
+                self.variants['gzip'] = compressed
+            if brotli is not None:
+                compressed = brotli.compress(body)
+                if len(compressed) < len(body):
+                    self.variants['br'] = compressed
+
+    def etag(self, encoding: str) -> str:
+        if encoding == 'identity':
+            return f'"{self.version}"'
+        return f'"{self.version}-{encoding}"'
+
+
+def get_media_type(path: str) -> str:
+    media_type = mimetypes.guess_type(path)[0] or 'application/octet-stream'
+    if media_type.startswith('text/') or media_type == 'application/javascript':
+        media_type += '; charset=utf-8'
+    return media_type
+
+
+def select_encoding(asset: Asset, accept_encoding: str) -> str:
+    """Pick the smallest variant the client accepts (br, then gzip, then identity)."""
+    accepted = set()
+    for item in accept_encoding.split(','):
+        coding, _, params = item.strip().partition(';')
+        if params.replace(' ', '') in ('q=0', 'q=0.0', 'q=0.00', 'q=0.000'):
+            continue
+        accepted.add(coding.strip().lower())
+    for encoding in ('br', 'gzip'):
+        if encoding in asset.variants and (encoding in accepted or '*' in accepted):
+            return encoding
+    return 'identity'
+
+
+def etag_matches(if_none_match: str, asset: Asset) -> bool:
+    if if_none_match.strip() == '*':
+        return True
+    etags = {asset.etag(encoding) for encoding in asset.variants}
+    for candidate in if_none_match.split(','):
+        candidate = candidate.strip()
+        if candidate.startswith('W/'):
+            candidate = candidate[2:]
+        if candidate in etags:
+            return True
+    return False
+
+
+class AssetCache:
+    """Serves the files under root from memory.
+
+    Assets are keyed by their path relative to root with '/' separators,
+    e.g. 'home.html' or 'static/app.js'. Only files found by the scan can be
+    served, so request paths never reach the filesystem.
+    """
+
+    def __init__(self, root: str, reload: bool = False, reload_interval: float = 1.0,
+                 static_max_age: int = 31536000):
+        self.root = root
+        self.reload = reload
+        self.reload_interval = reload_interval
+        self.static_max_age = static_max_age
+        self.assets: Dict[str, Asset] = {}
+        self._last_scan = 0.0
+        self._scan_lock = threading.Lock()
+
+    def _scan_files(self) -> Dict[str, str]:
+        files = {}
+        for directory, _, file_names in os.walk(self.root):
+            for file_name in file_names:
+                full_path = os.path.join(directory, file_name)
+                files[os.path.relpath(full_path, self.root).replace(os.sep, '/')] = full_path
+        return files
+
+    def _render_page(self, body: bytes, assets: Dict[str, Asset]) -> bytes:
+        def add_version(match):
+            asset = assets.get(match.group(2))
+            if asset is None:
+                return match.group(0)
+            return f"{match.group(1)}{match.group(2)}?v={asset.version}{match.group(3)}"
+        return _STATIC_REFERENCE_PATTERN.sub(add_version, body.decode('utf-8')).encode('utf-8')
+
+    def load(self):
+        """(Re)build the cache, reusing assets whose file did not change."""
+        with self._scan_lock:
+            files = self._scan_files()
+            assets = {}
+            pages = []
+            loaded = []
+            for path, full_path in files.items():
+                mtime = os.stat(full_path).st_mtime
+                current = self.assets.get(path)
+                if path.endswith('.html'):
+                    pages.append((path, full_path, mtime))
+                    continue
+                if current is not None and current.mtime == mtime:
+                    assets[path] = current
+                    continue
+                with open(full_path, 'rb') as fp:
+                    assets[path] = Asset(path, fp.read(), get_media_type(path), mtime)
+                loaded.append(path)
+            changed = bool(loaded) or bool(set(self.assets) - set(files))
+            # Pages embed the versions of the static files they reference, so
+            # they are re-rendered whenever any static file changed
+            for path, full_path, mtime in pages:
+                current = self.assets.get(path)
+                if current is not None and current.mtime == mtime and not changed:
+                    assets[path] = current
+                    continue
+                with open(full_path, 'rb') as fp:
+                    body = self._render_page(fp.read(), assets)
+                assets[path] = Asset(path, body, get_media_type(path), mtime)
+                loaded.append(path)
+            self.assets = assets
+            self._last_scan = time.monotonic()
+        if loaded:
+            logger.info("Loaded %s of %s UI assets from: %s", len(loaded), len(assets), self.root)
+
+    def get(self, path: str) -> Optional[Asset]:
+        if self.reload and time.monotonic() - self._last_scan >= self.reload_interval:
+            self.load()
+        return self.assets.get(path)
+
+    def response(self, asset: Asset, request: Request, versioned: bool = False) -> Response:
+        """Build the response for asset, or a 304 if the client already has it.
+
+        versioned marks a static file that may be cached for good when the
+        request asks for its current version ('?v=<hash>').
+        """
+        encoding = select_encoding(asset, request.headers.get('accept-encoding', ''))
+        headers = {'ETag': asset.etag(encoding), 'Vary': 'Accept-Encoding'}
+        if versioned and request.query_params.get('v') == asset.version:
+            headers['Cache-Control'] = f"public, max-age={self.static_max_age}, immutable"
+        else:
+            headers['Cache-Control'] = 'no-cache'
+        if_none_match = request.headers.get('if-none-match')
+        if if_none_match and etag_matches(if_none_match, asset):
+            return Response(status_code=304, headers=headers)
+        if encoding != 'identity':
+            headers['Content-Encoding'] = encoding
+        return Response(content=asset.variants[encoding], headers=headers, media_type=asset.media_type)
@@ -0,0 +1,257 @@
+"""Logging setup shared by the services.
+
+Records are handed to a background listener thread through a bounded queue,
+so the request path never formats a message or writes to stderr. On the way
+in, INFO and DEBUG records can be sampled per endpoint and repeated warnings
+are rate limited. Session ids and tokens are redacted by the listener before
+the record is written. Every record carries the trace id of the request it
+was emitted for, so one UI request can be followed across the services.
+A process forked after setup (e.g. a preloaded server worker) starts its own
+listener, since threads do not survive fork().
+
+Configured through environment variables:
+
+- LOG_LEVEL: level of the service loggers (default INFO).
+- LOG_SAMPLE_RATES: comma separated '<path prefix>=<rate>' pairs, e.g.
+  '/api/v1/protected=0.01,/ui/static=0.1'. INFO/DEBUG records emitted while
+  handling a matching request are kept with that probability.
+- LOG_RATE_LIMIT_PER_MINUTE: how many WARNING+ records with the same message
+  template are written per minute before the rest are suppressed (default 20,
+  0 disables rate limiting).
+- LOG_REDACT: set to 'false' to log session ids and tokens in full.
+- LOG_QUEUE_SIZE: records buffered for the listener; when full, new records
+  are dropped instead of blocking (default 10000).
+"""
+import atexit
+import contextvars
+import logging
+import logging.handlers
+import os
+import queue
+import random
+import re
+import secrets
+import sys
+import threading
+import time
+
+_LOG_LEVEL = os.environ.get('LOG_LEVEL', 'INFO').upper()
+_LOG_SAMPLE_RATES = os.environ.get('LOG_SAMPLE_RATES', '')
+_LOG_RATE_LIMIT_PER_MINUTE = int(os.environ.get('LOG_RATE_LIMIT_PER_MINUTE', '20'))
+_LOG_REDACT = os.environ.get('LOG_REDACT', 'true').lower() not in ('0', 'false', 'no')
+_LOG_QUEUE_SIZE = int(os.environ.get('LOG_QUEUE_SIZE', '10000'))
+_LOG_FORMAT = '%(asctime)s - %(name)s - %(levelname)s - [%(trace_id)s] %(message)s'
+_TRACE_ID_HEADER = 'x-trace-id'
+_TRACE_ID_PATTERN = re.compile(r'[A-Za-z0-9_-]{1,64}')
+
+# Path and trace id of the request being handled, set by LogContextMiddleware
+current_request_path = contextvars.ContextVar('current_request_path', default=None)
+current_trace_id = contextvars.ContextVar('current_trace_id', default=None)
+
+
+def parse_sample_rates(value: str) -> list:
+    """Parse '<prefix>=<rate>,...' into (prefix, rate) pairs, longest prefix first."""
+    rates = []
+    for item in value.split(','):
+        item = item.strip()
+        if not item:
+            continue
+        prefix, separator, rate = item.rpartition('=')
+        if not separator or not prefix:
+            raise ValueError(f"Invalid log sample rate entry: {item!r}. Expected '<path prefix>=<rate>'")
+        rates.append((prefix, float(rate)))
+    return sorted(rates, key=lambda pair: len(pair[0]), reverse=True)
+
+
+class SamplingFilter(logging.Filter):
+    """Keep only a fraction of INFO/DEBUG records for configured endpoints."""
+
+    def __init__(self, rates: list):
+        super().__init__()
+        self.rates = rates
+
+    def filter(self, record: logging.LogRecord) -> bool:
+        if record.levelno > logging.INFO or not self.rates:
+            return True
+        path = current_request_path.get()
+        if path is None:
+            return True
+        for prefix, rate in self.rates:
+            if path.startswith(prefix):
+                return rate >= 1.0 or random.random() < rate
+        return True
+
+
+class RateLimitFilter(logging.Filter):
+    """Let through at most limit WARNING+ records per message template per window.
+
+    Works on the unformatted template (record.msg), so it relies on callers
+    using lazy '%s' formatting. The first record after a window with
+    suppressed records reports how many were dropped.
+    """
+
+    def __init__(self, limit: int, window_seconds: float = 60.0, max_keys: int = 1024):
+        super().__init__()
+        self.limit = limit
+        self.window_seconds = window_seconds
+        self.max_keys = max_keys
+        self._windows = {}
+        self._lock = threading.Lock()
+
+    def filter(self, record: logging.LogRecord) -> bool:
+        if record.levelno < logging.WARNING or self.limit <= 0:
+            return True
+        key = (record.name, record.msg)
+        now = time.monotonic()
+        with self._lock:
+            window = self._windows.get(key)
+            if window is None or now - window[0] >= self.window_seconds:
+                suppressed = window[2] if window is not None else 0
+                if window is None and len(self._windows) >= self.max_keys:
+                    self._windows.clear()
+                self._windows[key] = [now, 1, 0]
+                if suppressed:
+                    record.msg = f"{record.msg} [suppressed {suppressed} similar messages in the last window]"
+                return True
+            if window[1] < self.limit:
+                window[1] += 1
+                return True
+            window[2] += 1
+            return False
+
+
+class RedactingFormatter(logging.Formatter):
+    """Mask session ids, CSRF tokens and signed session tokens in formatted records."""
+
+    _PATTERNS = (
+        re.compile(r'\bv1\.[\w-]+\.[\w-]+\.[\w-]+'),
+        re.compile(r'\b[0-9a-f]{32}\b'),
+    )
+
+    def format(self, record: logging.LogRecord) -> str:
+        message = super().format(record)
+        for pattern in self._PATTERNS:
+            message = pattern.sub(lambda match: f"{match.group(0)[:6]}...", message)
+        return message
+
+
+class DeferredQueueHandler(logging.handlers.QueueHandler):
+    """QueueHandler that leaves formatting to the listener thread and never blocks.
+
+    The stock QueueHandler formats the message in the calling thread so the
+    record can be pickled; our queue stays in-process so that is not needed.
+    """
+
+    def __init__(self, log_queue):
+        super().__init__(log_queue)
+        self.dropped = 0
+
+    def prepare(self, record: logging.LogRecord) -> logging.LogRecord:
+        # Context variables are only readable here, in the emitting thread
+        record.trace_id = current_trace_id.get() or '-'
+        return record
+
+    def enqueue(self, record: logging.LogRecord):
+        try:
+            self.queue.put_nowait(record)
+        except queue.Full:
+            self.dropped += 1
+
+
+_queue_handler = None
+_queue_listener = None
+_stream_handler = None
+_setup_lock = threading.Lock()
+
+
+def _start_listener():
+    global _queue_handler, _queue_listener, _stream_handler
+    log_queue = queue.Queue(maxsize=_LOG_QUEUE_SIZE)
+    _stream_handler = logging.StreamHandler(sys.stderr)
+    formatter_class = RedactingFormatter if _LOG_REDACT else logging.Formatter
+    _stream_handler.setFormatter(formatter_class(_LOG_FORMAT))
+    _queue_handler = DeferredQueueHandler(log_queue)
+    _queue_handler.addFilter(SamplingFilter(parse_sample_rates(_LOG_SAMPLE_RATES)))
+    _queue_handler.addFilter(RateLimitFilter(_LOG_RATE_LIMIT_PER_MINUTE))
+    _queue_listener = logging.handlers.QueueListener(log_queue, _stream_handler, respect_handler_level=True)
+    _queue_listener.start()
+    atexit.register(stop_logging)
+
+
+def _restart_listener_in_child():
+    """Give a forked child its own queue and listener thread; the parent's thread was not copied."""
+    global _queue_listener, _setup_lock
+    _setup_lock = threading.Lock()
+    if _queue_handler is None or _queue_listener is None:
+        return
+    # Records queued in the parent before the fork are written by the parent
+    log_queue = queue.Queue(maxsize=_LOG_QUEUE_SIZE)
+    _queue_handler.queue = log_queue
+    _queue_listener = logging.handlers.QueueListener(log_queue, _stream_handler, respect_handler_level=True)
+    _queue_listener.start()
+
+
+if hasattr(os, 'register_at_fork'):
+    os.register_at_fork(after_in_child=_restart_listener_in_child)
+
+
+def stop_logging():
+    """Flush queued records and stop the listener thread."""
+    global _queue_listener
+    if _queue_listener is not None:
+        _queue_listener.stop()
+        _queue_listener = None
+
+
+def get_logger(name: str) -> logging.Logger:
+    """Return a service logger wired to the shared queue handler."""
+    with _setup_lock:
+        if _queue_handler is None:
+            _start_listener()
+    logger = logging.getLogger(name)
+    logger.setLevel(_LOG_LEVEL)
+    if _queue_handler not in logger.handlers:
+        logger.addHandler(_queue_handler)
+    return logger
+
+
+def get_trace_id(scope) -> str:
+    """Return the X-Trace-Id sent by the caller if it is well formed, else a new one."""
+    for key, value in scope['headers']:
+        if key == _TRACE_ID_HEADER.encode():
+            trace_id = value.decode('latin-1')
+            if _TRACE_ID_PATTERN.fullmatch(trace_id):
+                return trace_id
+            break
+    return secrets.token_hex(8)
+
+
+class LogContextMiddleware:
+    """ASGI middleware that records the request path and trace id of each request.
+
+    The path drives per-endpoint log sampling. The trace id is taken from the
+    X-Trace-Id request header (or generated), attached to every log record and
+    echoed in the X-Trace-Id response header.
+    """
+
+    def __init__(self, app):
+        self.app = app
+
+    async def __call__(self, scope, receive, send):
+        if scope['type'] != 'http':
+            return await self.app(scope, receive, send)
+        trace_id = get_trace_id(scope)
+        trace_id_header = (_TRACE_ID_HEADER.encode(), trace_id.encode())
+
+        async def send_with_trace_id(message):
+            if message['type'] == 'http.response.start':
+                message['headers'] = list(message.get('headers', [])) + [trace_id_header]
+            await send(message)
+
+        path_token = current_request_path.set(scope['path'])
+        trace_token = current_trace_id.set(trace_id)
+        try:
+            await self.app(scope, receive, send_with_trace_id)
+        finally:
+            current_trace_id.reset(trace_token)
+            current_request_path.reset(path_token)
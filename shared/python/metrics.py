@@ -0,0 +1,252 @@
+"""Request metrics shared by the services, exposed in the Prometheus text format.
+
+MetricsMiddleware records, per method and route template:
+
+- http_requests_total: requests by status code.
+- http_request_duration_seconds: latency histogram.
+- http_requests_in_flight: requests being handled right now.
+
+Code that wants its time accounted separately wraps it in span(name). Spans
+feed the span_duration_seconds histogram and are reported back to the caller
+in a Server-Timing response header, which together with the X-Trace-Id set by
+LogContextMiddleware lets one UI request be broken down across services.
+
+Metrics are only updated from the event loop thread, so they take no locks.
+"""
+import bisect
+import contextlib
+import contextvars
+import functools
+import math
+import time
+from typing import Callable, Dict, Optional, Sequence, Tuple
+
+_DEFAULT_BUCKETS = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+
+# Spans recorded while handling the current request, set by MetricsMiddleware
+current_spans = contextvars.ContextVar('current_spans', default=None)
+
+
+def format_value(value: float) -> str:
+    if value == math.inf:
+        return '+Inf'
+    if float(value).is_integer():
+        return str(int(value))
+    return repr(float(value))
+
+
+def format_labels(label_names: Sequence[str], label_values: Sequence, extra: str = '') -> str:
+    pairs = [f'{name}="{escape_label_value(str(value))}"' for name, value in zip(label_names, label_values)]
+    if extra:
+        pairs.append(extra)
+    return '{' + ','.join(pairs) + '}' if pairs else ''
+
+
+def escape_label_value(value: str) -> str:
+    return value.replace('\\', '\\\\').replace('\n', '\\n').replace('"', '\\"')
+
+
+class Metric:
+    kind = 'untyped'
+
+    def __init__(self, name: str, help_text: str, label_names: Sequence[str] = ()):
+        self.name = name
+        self.help_text = help_text
+        self.label_names = tuple(label_names)
+
+    def header(self) -> list:
+        return [f"# HELP {self.name} {self.help_text}", f"# TYPE {self.name} {self.kind}"]
+
+    def render(self) -> list:
+        raise NotImplementedError
+
+
+class Counter(Metric):
+    kind = 'counter'
+
+    def __init__(self, name: str, help_text: str, label_names: Sequence[str] = ()):
+        super().__init__(name, help_text, label_names)
+        self._values: Dict[Tuple, float] = {}
+
+    def inc(self, *label_values, amount: float = 1):
+        self._values[label_values] = self._values.get(label_values, 0) + amount
+
+    def render(self) -> list:
+        return self.header() + [f"{self.name}{format_labels(self.label_names, labels)} {format_value(value)}"
+                                for labels, value in sorted(self._values.items())]
+
+
+class Gauge(Counter):
+    kind = 'gauge'
+
+    def dec(self, *label_values, amount: float = 1):
+        self.inc(*label_values, amount=-amount)
+
+    def set(self, *label_values, value: float):
+        self._values[label_values] = value
+
+
+class Histogram(Metric):
+    kind = 'histogram'
+
+    def __init__(self, name: str, help_text: str, label_names: Sequence[str] = (),
+                 buckets: Sequence[float] = _DEFAULT_BUCKETS):
+        super().__init__(name, help_text, label_names)
+        self.buckets = tuple(sorted(buckets))
+        # label values -> [per-bucket counts (last one is +Inf), sum, count]
+        self._series: Dict[Tuple, list] = {}
+
+    def observe(self, value: float, *label_values):
+        series = self._series.get(label_values)
+        if series is None:
+            series = self._series[label_values] = [[0] * (len(self.buckets) + 1), 0.0, 0]
+        series[0][bisect.bisect_left(self.buckets, value)] += 1
+        series[1] += value
+        series[2] += 1
+
+    def render(self) -> list:
+        lines = self.header()
+        for labels, (counts, total, count) in sorted(self._series.items()):
+            cumulative = 0
+            for upper_bound, bucket_count in zip(self.buckets + (math.inf,), counts):
+                cumulative += bucket_count
+                le = f'le="{format_value(upper_bound)}"'
+                lines.append(f"{self.name}_bucket{format_labels(self.label_names, labels, le)} {cumulative}")
+            lines.append(f"{self.name}_sum{format_labels(self.label_names, labels)} {format_value(total)}")
+            lines.append(f"{self.name}_count{format_labels(self.label_names, labels)} {count}")
+        return lines
+
+
+class CallbackMetric(Metric):
+    """A gauge or counter whose value is read from a callback at scrape time.
+
+    The callback returns a number, or a {label values tuple: number} dict.
+    """
+
+    def __init__(self, name: str, help_text: str, callback: Callable, kind: str = 'gauge',
+                 label_names: Sequence[str] = ()):
+        super().__init__(name, help_text, label_names)
+        self.kind = kind
+        self.callback = callback
+
+    def render(self) -> list:
+        values = self.callback()
+        if not isinstance(values, dict):
+            values = {(): values}
+        return self.header() + [f"{self.name}{format_labels(self.label_names, labels)} {format_value(value)}"
+                                for labels, value in sorted(values.items())]
+
+
+class MetricsRegistry:
+    def __init__(self):
+        self._metrics: Dict[str, Metric] = {}
+
+    def register(self, metric: Metric) -> Metric:
+        if metric.name in self._metrics:
+            raise ValueError(f"Metric already registered: {metric.name}")
+        self._metrics[metric.name] = metric
+        return metric
+
+    def counter(self, name: str, help_text: str, label_names: Sequence[str] = ()) -> Counter:
+        return self.register(Counter(name, help_text, label_names))
+
+    def gauge(self, name: str, help_text: str, label_names: Sequence[str] = ()) -> Gauge:
+        return self.register(Gauge(name, help_text, label_names))
+
+    def histogram(self, name: str, help_text: str, label_names: Sequence[str] = (),
+                  buckets: Sequence[float] = _DEFAULT_BUCKETS) -> Histogram:
+        return self.register(Histogram(name, help_text, label_names, buckets))
+
+    def callback(self, name: str, help_text: str, callback: Callable, kind: str = 'gauge',
+                 label_names: Sequence[str] = ()) -> CallbackMetric:
+        return self.register(CallbackMetric(name, help_text, callback, kind, label_names))
+
+    def render(self) -> str:
+        lines = []
+        for metric in self._metrics.values():
+            lines.extend(metric.render())
+        return '\n'.join(lines) + '\n'
+
+
+registry = MetricsRegistry()
+http_requests_total = registry.counter('http_requests_total', 'HTTP requests handled.',
+                                       ('method', 'route', 'status'))
+http_request_duration_seconds = registry.histogram('http_request_duration_seconds', 'HTTP request latency.',
+                                                   ('method', 'route'))
+http_requests_in_flight = registry.gauge('http_requests_in_flight', 'HTTP requests being handled.')
+span_duration_seconds = registry.histogram('span_duration_seconds', 'Time spent in named spans of request handling.',
+                                           ('span',))
+
+
+@contextlib.contextmanager
+def span(name: str):
+    """Time the wrapped block as span name, e.g. 'session_store_get'."""
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        duration = time.perf_counter() - start
+        span_duration_seconds.observe(duration, name)
+        spans = current_spans.get()
+        if spans is not None:
+            spans[name] = spans.get(name, 0.0) + duration
+
+
+def timed(name: str):
+    """Decorator timing every call of a coroutine function as span name."""
+    def decorator(fn):
+        @functools.wraps(fn)
+        async def wrapper(*args, **kwargs):
+            with span(name):
+                return await fn(*args, **kwargs)
+        return wrapper
+    return decorator
+
+
+def format_server_timing(spans: Dict[str, float]) -> str:
+    return ', '.join(f"{name};dur={duration * 1000:.2f}" for name, duration in spans.items())
+
+
+def get_route_template(scope) -> Optional[str]:
+    route = scope.get('route')
+    return getattr(route, 'path', None)
+
+
+class MetricsMiddleware:
+    """ASGI middleware recording request count, latency and in-flight requests.
+
+    Requests are labelled with the route template (e.g. '/ui/{page}') so the
+    number of series stays bounded; requests no route matched are labelled
+    'unmatched'.
+    """
+
+    def __init__(self, app):
+        self.app = app
+
+    async def __call__(self, scope, receive, send):
+        if scope['type'] != 'http':
+            return await self.app(scope, receive, send)
+        spans = {}
+        status_code = 500
+
+        async def send_with_server_timing(message):
+            nonlocal status_code
+            if message['type'] == 'http.response.start':
+                status_code = message['status']
+                if spans:
+                    message['headers'] = list(message.get('headers', [])) + [
+                        (b'server-timing', format_server_timing(spans).encode())]
+            await send(message)
+
+        token = current_spans.set(spans)
+        http_requests_in_flight.inc()
+        start = time.perf_counter()
+        try:
+            await self.app(scope, receive, send_with_server_timing)
+        finally:
+            duration = time.perf_counter() - start
+            http_requests_in_flight.dec()
+            current_spans.reset(token)
+            route = get_route_template(scope) or 'unmatched'
+            http_requests_total.inc(scope['method'], route, str(status_code))
+            http_request_duration_seconds.observe(duration, scope['method'], route)